@@ -14,6 +14,10 @@ def write_pxd(pxdname, files):
 		code = re.sub('/\*([^*]|[\r\n]|(\*+([^*/]|[\r\n])))*\*+/', '', code)
 		code = re.sub('; +', ';', code)
 		code = re.sub('(//|#)[^\n]+\n', '', code)
+		# Cython cannot refer to a struct by its tag inside its own
+		# ctypedef, so self-referencing members use the typedef name
+		for tag, name in re.findall('typedef struct (\w+) {[^}]*} *(\w+);', code):
+			code = code.replace('struct %s*' % tag, name + '*')
 		code = code.replace('{', ':;').replace('typedef', 'ctypedef')
 		f.close()
 		code_lines = code.split(';')
@@ -55,5 +59,5 @@ def write_pxd(pxdname, files):
 	f.close()
 
 write_pxd('pawpyc_extern.pxd',
-	['utils', 'projector', 'pseudoprojector', 'reader', 'density', 'sbt', 'linalg', 'radial', 'momentum'])
+	['utils', 'gsphere', 'projector', 'pseudoprojector', 'reader', 'density', 'sbt', 'linalg', 'radial', 'momentum', 'snapshot'])
 write_pxd('tests/testc_extern.pxd', ['tests/tests', 'utils'])
@@ -8,7 +8,7 @@ import yaml
 import matplotlib.pyplot as plt 
 import numpy as np 
 import os, subprocess
-from pymatgen.io.vasp.outputs import Vasprun
+from pawpyseed.core.vasprun import read_vasprun
 from pymatgen.io.vasp.inputs import Poscar
 from pymatgen import Spin
 
@@ -309,7 +309,7 @@ class BulkCharacter(PawpyData):
 		bcs = {}
 
 		for wf_dir, pr in generator:
-			vr = Vasprun(os.path.join(wf_dir, 'vasprun.xml'))
+			vr = read_vasprun(wf_dir)
 			bg, cbm, vbm, _ = vr.eigenvalue_band_properties
 			dos = vr.tdos
 			data, energy_levels = pr.defect_band_analysis(num_above_ef=5, num_below_ef=5,
@@ -343,7 +343,7 @@ class BasisExpansion(PawpyData):
 
 		for wf_dir, pr in generator:
 
-			vr = Vasprun(os.path.join(wf_dir, 'vasprun.xml'))
+			vr = read_vasprun(wf_dir)
 			bg, cbm, vbm, _ = vr.eigenvalue_band_properties
 			dos = vr.tdos
 			basis = pr.basis
@@ -5,7 +5,7 @@ import shutil
 from shutil import rmtree
 from monty.shutil import decompress_dir, decompress_file
 
-from pymatgen.io.vasp import Vasprun
+from pawpyseed.core.vasprun import read_vasprun
 
 from pawpyseed.core.wavefunction import Wavefunction
 from pawpyseed.core.projector import Projector
@@ -72,7 +72,7 @@ class DefectWorkflowWavefunctionHandle(object):
         # ASSUMING KYLE PATH ALREADY SET UP, RETURNS A BAND_DICT to be used by run_pawpy
         # (band numbers are keys, contains maxmin window of band energies (along with occupation),
         #  and stores percentage of band character after pawpy is run...)
-        vr = Vasprun(os.path.join(path, 'kyle_file', 'vasprun.xml'))
+        vr = read_vasprun(os.path.join(path, 'kyle_file', 'vasprun.xml'))
         max_num = 0
         band_dict = {bandindex: {'max_eigen': [-10000., 0.], 'min_eigen': [10000., 0.],
                                 'VB_projection': None, 'CB_projection': None}
@@ -109,7 +109,7 @@ class DefectWorkflowWavefunctionHandle(object):
             bulk_dirs.append(launch_dir)
             if not vbm:
                 # need to check different filenames
-                vr = Vasprun(os.path.join(launch_dir, 'vasprun.xml'))
+                vr = read_vasprun(os.path.join(launch_dir, 'vasprun.xml'))
                 vbm = vr.eigenvalue_band_properties[2]
                 print('\twill use vbm value of ',vbm)
         for sc_size, size_set in self.dwo.defect_fw_sets.items():
@@ -0,0 +1,234 @@
+#include <stdio.h>
+#include <stdlib.h>
+#include <string.h>
+#include <math.h>
+#include <omp.h>
+#include "utils.h"
+#include "gsphere.h"
+
+#define PI 3.14159265358979323846
+#define CCONST 0.262465831
+#define GSPHERE_TOL 1e-10
+#define MAX_UNUSED_GSPHERES 64
+
+gsphere_t** gsphere_cache = NULL;
+int gsphere_cache_len = 0;
+int gsphere_cache_cap = 0;
+
+int gsphere_order(int lo, int hi, int* order) {
+	int n = 0;
+	for (int g = max(lo, 0); g <= hi; g++) order[n++] = g;
+	for (int g = lo; g <= min(hi, -1); g++) order[n++] = g;
+	return n;
+}
+
+int* make_gsphere(double* reclattice, double encut, double* k,
+	int num_components, int* num_waves, int* G_bounds) {
+
+	double* b1 = reclattice;
+	double* b2 = reclattice+3;
+	double* b3 = reclattice+6;
+	double gmax = pow(encut * CCONST, 0.5) * (1 + 1e-8);
+
+	// |(k+G).a_i| = 2pi|k_i+G_i| <= gmax|a_i|, where
+	// |a_i| = 2pi|b_j x b_k| / |b_1.(b_2 x b_3)|
+	double vtemp[3];
+	double vol = fabs(determinant(reclattice));
+	int lo[3], hi[3];
+	for (int i = 0; i < 3; i++) {
+		vcross(vtemp, reclattice + 3*((i+1)%3), reclattice + 3*((i+2)%3));
+		double extent = gmax * mag(vtemp) / vol;
+		lo[i] = (int) floor(-k[i] - extent) - 1;
+		hi[i] = (int) ceil(-k[i] + extent) + 1;
+	}
+
+	int* order1 = (int*) malloc((hi[0]-lo[0]+1) * sizeof(int));
+	int* order2 = (int*) malloc((hi[1]-lo[1]+1) * sizeof(int));
+	int* order3 = (int*) malloc((hi[2]-lo[2]+1) * sizeof(int));
+	int n2 = gsphere_order(lo[1], hi[1], order2);
+	int n3 = gsphere_order(lo[2], hi[2], order3);
+	double etots[hi[0]-lo[0]+1];
+
+	int cap = 1024;
+	int* igall = (int*) malloc(3 * cap * sizeof(int));
+	CHECK_ALLOCATION(igall);
+	for (int i = 0; i < 6; i++) G_bounds[i] = 0;
+	int ncnt = 0;
+
+	double A = dot(b1, b1);
+	for (int i3 = 0; i3 < n3; i3++) {
+		int ig3p = order3[i3];
+		for (int i2 = 0; i2 < n2; i2++) {
+			int ig2p = order2[i2];
+			// solve |v0 + x b1|^2 = gmax^2 for the range of ig1
+			double v0[3];
+			for (int j = 0; j < 3; j++) {
+				v0[j] = k[0] * b1[j] + (k[1]+ig2p) * b2[j] + (k[2]+ig3p) * b3[j];
+			}
+			double B = dot(v0, b1);
+			double disc = B * B - A * (dot(v0, v0) - gmax * gmax);
+			if (disc < 0) continue;
+			disc = pow(disc, 0.5);
+			int lo1 = max(lo[0], (int) floor((-B - disc) / A) - 1);
+			int hi1 = min(hi[0], (int) ceil((-B + disc) / A) + 1);
+			int n1 = gsphere_order(lo1, hi1, order1);
+
+			// same expression as the original WaveTrans loop,
+			// so plane waves on the cutoff are treated identically
+			for (int i1 = 0; i1 < n1; i1++) {
+				int ig1p = order1[i1];
+				double sumkg[3];
+				for (int j = 0; j < 3; j++) {
+					sumkg[j] = (k[0]+ig1p) * b1[j]
+								+ (k[1]+ig2p) * b2[j]
+								+ (k[2]+ig3p) * b3[j];
+				}
+				double gtot = sqrt(dot(sumkg, sumkg));
+				etots[i1] = gtot * gtot / CCONST;
+			}
+			for (int i1 = 0; i1 < n1; i1++) {
+				if (etots[i1] <= encut) {
+					if (ncnt == cap) {
+						cap *= 2;
+						igall = (int*) realloc(igall, 3 * cap * sizeof(int));
+						CHECK_ALLOCATION(igall);
+					}
+					int ig1p = order1[i1];
+					igall[ncnt*3+0] = ig1p;
+					igall[ncnt*3+1] = ig2p;
+					igall[ncnt*3+2] = ig3p;
+					G_bounds[0] = min(G_bounds[0], ig1p);
+					G_bounds[1] = max(G_bounds[1], ig1p);
+					G_bounds[2] = min(G_bounds[2], ig2p);
+					G_bounds[3] = max(G_bounds[3], ig2p);
+					G_bounds[4] = min(G_bounds[4], ig3p);
+					G_bounds[5] = max(G_bounds[5], ig3p);
+					ncnt++;
+				}
+			}
+		}
+	}
+	free(order1);
+	free(order2);
+	free(order3);
+
+	int* Gs = (int*) malloc(3 * ncnt * num_components * sizeof(int));
+	CHECK_ALLOCATION(Gs);
+	for (int i = 0; i < num_components; i++) {
+		memcpy(Gs + 3*ncnt*i, igall, 3 * ncnt * sizeof(int));
+	}
+	free(igall);
+	*num_waves = ncnt * num_components;
+	return Gs;
+}
+
+int gsphere_matches(gsphere_t* entry, double* reclattice, double encut,
+	double* k, int num_components) {
+
+	if (entry->num_components != num_components) return 0;
+	if (fabs(entry->encut - encut) > GSPHERE_TOL) return 0;
+	for (int i = 0; i < 3; i++) {
+		if (fabs(entry->k[i] - k[i]) > GSPHERE_TOL) return 0;
+	}
+	for (int i = 0; i < 9; i++) {
+		if (fabs(entry->reclattice[i] - reclattice[i]) > GSPHERE_TOL) return 0;
+	}
+	return 1;
+}
+
+int* get_gsphere(double* reclattice, double encut, double* k,
+	int num_components, int* num_waves, int* G_bounds) {
+
+	int* Gs = NULL;
+	#pragma omp critical(gsphere)
+	{
+		for (int i = 0; i < gsphere_cache_len; i++) {
+			gsphere_t* entry = gsphere_cache[i];
+			if (gsphere_matches(entry, reclattice, encut, k, num_components)) {
+				entry->refcount++;
+				*num_waves = entry->num_waves;
+				for (int j = 0; j < 6; j++) G_bounds[j] = entry->G_bounds[j];
+				Gs = entry->Gs;
+				break;
+			}
+		}
+	}
+	if (Gs != NULL) {
+		return Gs;
+	}
+
+	gsphere_t* entry = (gsphere_t*) malloc(sizeof(gsphere_t));
+	CHECK_ALLOCATION(entry);
+	for (int i = 0; i < 9; i++) entry->reclattice[i] = reclattice[i];
+	for (int i = 0; i < 3; i++) entry->k[i] = k[i];
+	entry->encut = encut;
+	entry->num_components = num_components;
+	entry->refcount = 1;
+	entry->Gs = make_gsphere(reclattice, encut, k, num_components,
+		&(entry->num_waves), entry->G_bounds);
+	*num_waves = entry->num_waves;
+	for (int j = 0; j < 6; j++) G_bounds[j] = entry->G_bounds[j];
+
+	#pragma omp critical(gsphere)
+	{
+		if (gsphere_cache_len == gsphere_cache_cap) {
+			gsphere_cache_cap = 2 * gsphere_cache_cap + 16;
+			gsphere_cache = (gsphere_t**) realloc(gsphere_cache,
+				gsphere_cache_cap * sizeof(gsphere_t*));
+			CHECK_ALLOCATION(gsphere_cache);
+		}
+		gsphere_cache[gsphere_cache_len++] = entry;
+	}
+	return entry->Gs;
+}
+
+void remove_gsphere(int i) {
+	free(gsphere_cache[i]->Gs);
+	free(gsphere_cache[i]);
+	for (int j = i + 1; j < gsphere_cache_len; j++) {
+		gsphere_cache[j-1] = gsphere_cache[j];
+	}
+	gsphere_cache_len--;
+}
+
+void release_gsphere(int* Gs) {
+	int found = 0;
+	#pragma omp critical(gsphere)
+	{
+		int num_unused = 0;
+		for (int i = 0; i < gsphere_cache_len; i++) {
+			if (gsphere_cache[i]->Gs == Gs) {
+				gsphere_cache[i]->refcount--;
+				found = 1;
+			}
+			if (gsphere_cache[i]->refcount == 0) {
+				num_unused++;
+			}
+		}
+		// evict the oldest unused lists
+		for (int i = 0; i < gsphere_cache_len && num_unused > MAX_UNUSED_GSPHERES;) {
+			if (gsphere_cache[i]->refcount == 0) {
+				remove_gsphere(i);
+				num_unused--;
+			} else {
+				i++;
+			}
+		}
+	}
+	if (!found) {
+		free(Gs);
+	}
+}
+
+void clear_gsphere_cache(void) {
+	#pragma omp critical(gsphere)
+	{
+		for (int i = 0; i < gsphere_cache_len;) {
+			if (gsphere_cache[i]->refcount == 0) {
+				remove_gsphere(i);
+			} else {
+				i++;
+			}
+		}
+	}
+}
@@ -0,0 +1,66 @@
+/** \file
+Enumeration of the plane-wave basis (the "G-sphere") of each k-point.
+The plane waves with kinetic energy up to encut are generated in the same order
+as VASP stores the coefficients in the WAVECAR, and the resulting index
+lists are cached so that k-points with the same lattice, cutoff and
+k-vector (for example, repeated loads of the same structure) share one
+list instead of recomputing it.
+*/
+
+#ifndef GSPHERE_H
+#define GSPHERE_H
+
+/**
+One cached plane-wave basis. Gs holds num_waves sets of three integer
+coordinates (in units of the reciprocal lattice vectors).
+*/
+typedef struct gsphere {
+	double reclattice[9]; ///< reciprocal lattice (with 2pi factor)
+	double encut; ///< plane-wave cutoff
+	double k[3]; ///< fractional k-point
+	int num_components; ///< 2 for noncollinear (the list is stored twice), 1 otherwise
+	int num_waves; ///< length of Gs (divided by 3)
+	int G_bounds[6]; ///< xmin, xmax, ymin, ymax, zmin, zmax of Gs
+	int refcount; ///< number of kpoint_t objects using Gs
+	int* Gs; ///< plane-wave coordinates
+} gsphere_t;
+
+/**
+Fills order with the integers in [lo, hi] in the order used by VASP
+(0, 1, ..., hi, lo, lo+1, ..., -1) and returns the number of integers.
+*/
+int gsphere_order(int lo, int hi, int* order);
+
+/**
+Enumerates the plane waves with kinetic energy up to encut without using
+the cache. Returns a new list of length 3 * num_waves and stores
+num_waves and the G bounds (which always include 0) to the
+output pointers.
+*/
+int* make_gsphere(double* reclattice, double encut, double* k,
+	int num_components, int* num_waves, int* G_bounds);
+
+/**
+Returns the plane-wave basis for the k-point k, computing it with
+make_gsphere on the first call for a given reclattice, encut and k,
+and returning the cached list afterward. num_components=2
+returns the noncollinear basis (the list repeated for both spinor
+components). The list must not be modified and must be released with
+release_gsphere instead of free. Thread-safe.
+*/
+int* get_gsphere(double* reclattice, double encut, double* k,
+	int num_components, int* num_waves, int* G_bounds);
+
+/**
+Releases a list returned by get_gsphere. Lists that did not come from
+get_gsphere are freed. Unused lists are kept in the cache
+until the cache grows too large.
+*/
+void release_gsphere(int* Gs);
+
+/**
+Frees all cached lists that are no longer used by any k-point.
+*/
+void clear_gsphere_cache(void);
+
+#endif
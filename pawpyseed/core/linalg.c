@@ -11,13 +11,151 @@
 
 #define PI 3.14159265359
 
-void fft3d(double complex* x, int* G_bounds, double* lattice,
-	double* kpt, int* Gs, float complex* Cs, int num_waves, int* fftg) {
+#define MAX_FFT_PLANS 8
+#define NUM_FFT_BUFFERS 2
+#define MAX_FFT_BATCH 16
+#define FFT_BATCH_BYTES (32l << 20)
+
+/*
+FFT plans and workspaces of one thread. A committed descriptor
+is only used by the thread that created it.
+*/
+typedef struct fft_thread_data {
+	int num_plans;
+	int next_plan;
+	int plan_fftg[MAX_FFT_PLANS][3];
+	double plan_vol[MAX_FFT_PLANS];
+	int plan_num_transforms[MAX_FFT_PLANS];
+	DFTI_DESCRIPTOR_HANDLE plans[MAX_FFT_PLANS];
+	double complex* buffers[NUM_FFT_BUFFERS];
+	long buffer_sizes[NUM_FFT_BUFFERS];
+} fft_thread_data_t;
+
+static fft_thread_data_t** fft_thread_data = NULL;
+static int num_fft_thread_data = 0;
+
+static fft_thread_data_t* get_fft_thread_data(void) {
+	int thread = omp_get_thread_num();
+	fft_thread_data_t* data = NULL;
+	#pragma omp critical(fft_thread_data)
+	{
+		if (thread >= num_fft_thread_data) {
+			int num = thread + 1;
+			if (num < omp_get_max_threads()) num = omp_get_max_threads();
+			fft_thread_data = (fft_thread_data_t**) realloc(fft_thread_data,
+				num * sizeof(fft_thread_data_t*));
+			CHECK_ALLOCATION(fft_thread_data);
+			for (int i = num_fft_thread_data; i < num; i++) {
+				fft_thread_data[i] = NULL;
+			}
+			num_fft_thread_data = num;
+		}
+		if (fft_thread_data[thread] == NULL) {
+			fft_thread_data[thread] = (fft_thread_data_t*) calloc(1, sizeof(fft_thread_data_t));
+			CHECK_ALLOCATION(fft_thread_data[thread]);
+		}
+		data = fft_thread_data[thread];
+	}
+	return data;
+}
+
+/*
+Returns a committed descriptor for num_transforms 3D FFTs on grid fftg,
+stored one after the other, with the backward scale used by fft3d and the
+forward scale used by fwd_fft3d for a cell of volume vol.
+Descriptors are cached for each thread.
+*/
+static DFTI_DESCRIPTOR_HANDLE get_fft_plan(int* fftg, double vol, int num_transforms) {
+	fft_thread_data_t* data = get_fft_thread_data();
+	for (int i = 0; i < data->num_plans; i++) {
+		if (data->plan_fftg[i][0] == fftg[0] && data->plan_fftg[i][1] == fftg[1]
+			&& data->plan_fftg[i][2] == fftg[2] && data->plan_vol[i] == vol
+			&& data->plan_num_transforms[i] == num_transforms) {
+			return data->plans[i];
+		}
+	}
+
+	int i = data->next_plan;
+	if (data->num_plans < MAX_FFT_PLANS) {
+		data->num_plans++;
+	}
+	else {
+		DftiFreeDescriptor(data->plans + i);
+	}
+	data->next_plan = (i + 1) % MAX_FFT_PLANS;
 
 	MKL_LONG status = 0;
-	DFTI_DESCRIPTOR_HANDLE handle = 0;
 	MKL_LONG dim = 3;
 	MKL_LONG length[3] = {fftg[0], fftg[1], fftg[2]};
+	DFTI_DESCRIPTOR_HANDLE handle = 0;
+	status = DftiCreateDescriptor(&handle, DFTI_DOUBLE, DFTI_COMPLEX, dim, length);
+	CHECK_STATUS(status);
+	status = DftiSetValue(handle, DFTI_BACKWARD_SCALE, pow(vol, -0.5));
+	CHECK_STATUS(status);
+	status = DftiSetValue(handle, DFTI_FORWARD_SCALE, pow(vol, 0.5)/fftg[0]/fftg[1]/fftg[2]);
+	CHECK_STATUS(status);
+	if (num_transforms > 1) {
+		MKL_LONG distance = (MKL_LONG) fftg[0] * fftg[1] * fftg[2];
+		status = DftiSetValue(handle, DFTI_NUMBER_OF_TRANSFORMS, (MKL_LONG) num_transforms);
+		CHECK_STATUS(status);
+		status = DftiSetValue(handle, DFTI_INPUT_DISTANCE, distance);
+		CHECK_STATUS(status);
+		status = DftiSetValue(handle, DFTI_OUTPUT_DISTANCE, distance);
+		CHECK_STATUS(status);
+	}
+	status = DftiCommitDescriptor(handle);
+	CHECK_STATUS(status);
+	for (int d = 0; d < 3; d++) {
+		data->plan_fftg[i][d] = fftg[d];
+	}
+	data->plan_vol[i] = vol;
+	data->plan_num_transforms[i] = num_transforms;
+	data->plans[i] = handle;
+	return handle;
+}
+
+double complex* fft_workspace(int num, int* fftg, int count) {
+	fft_thread_data_t* data = get_fft_thread_data();
+	long size = (long) fftg[0] * fftg[1] * fftg[2] * count;
+	if (data->buffer_sizes[num] < size) {
+		mkl_free(data->buffers[num]);
+		data->buffers[num] = (double complex*) mkl_malloc(size * sizeof(double complex), 64);
+		CHECK_ALLOCATION(data->buffers[num]);
+		data->buffer_sizes[num] = size;
+	}
+	return data->buffers[num];
+}
+
+void free_fft_workspaces(void) {
+	for (int t = 0; t < num_fft_thread_data; t++) {
+		fft_thread_data_t* data = fft_thread_data[t];
+		if (data == NULL) continue;
+		for (int i = 0; i < data->num_plans; i++) {
+			DftiFreeDescriptor(data->plans + i);
+		}
+		for (int i = 0; i < NUM_FFT_BUFFERS; i++) {
+			mkl_free(data->buffers[i]);
+		}
+		free(data);
+	}
+	free(fft_thread_data);
+	fft_thread_data = NULL;
+	num_fft_thread_data = 0;
+}
+
+int fft_batch_size(int* fftg, int max_transforms) {
+	long grid_bytes = (long) fftg[0] * fftg[1] * fftg[2] * sizeof(double complex);
+	int size = (int) (FFT_BATCH_BYTES / grid_bytes);
+	if (size > MAX_FFT_BATCH) size = MAX_FFT_BATCH;
+	if (size > max_transforms) size = max_transforms;
+	if (size < 1) size = 1;
+	return size;
+}
+
+void fft3d(double complex* x, int* G_bounds, double* lattice,
+	double* kpt, int* Gs, float complex* Cs, int num_waves, int* fftg) {
+
+	MKL_LONG status = 0;
 
 	int gridsize = fftg[0] * fftg[1] * fftg[2];
 	for (int w = 0; w < gridsize; w++) {
@@ -30,47 +168,73 @@ void fft3d(double complex* x, int* G_bounds, double* lattice,
 		g3 = (Gs[3*w+2]+fftg[2]) % fftg[2];
 		x[g1*fftg[1]*fftg[2] + g2*fftg[2] + g3] = Cs[w];
 	}
-	double inv_sqrt_vol = pow(determinant(lattice), -0.5);
 
-	status = DftiCreateDescriptor(&handle, DFTI_DOUBLE, DFTI_COMPLEX, dim, length);
-	CHECK_STATUS(status);
-	status = DftiSetValue(handle, DFTI_BACKWARD_SCALE, inv_sqrt_vol);
-	CHECK_STATUS(status);
-	status = DftiCommitDescriptor(handle);
-	CHECK_STATUS(status);
+	DFTI_DESCRIPTOR_HANDLE handle = get_fft_plan(fftg, determinant(lattice), 1);
 	status = DftiComputeBackward(handle, x);
 	CHECK_STATUS(status);
-	DftiFreeDescriptor(&handle);
 }
 
 void fwd_fft3d(double complex* x, int* G_bounds, double* lattice,
 	double* kpt, int* Gs, float complex* Cs, int num_waves, int* fftg) {
 
 	MKL_LONG status = 0;
-	DFTI_DESCRIPTOR_HANDLE handle = 0;
-	MKL_LONG dim = 3;
-	MKL_LONG length[3] = {fftg[0], fftg[1], fftg[2]};
-
-	int gridsize = fftg[0] * fftg[1] * fftg[2];
 	int g1, g2, g3;
 
-	double sqrt_vol = pow(determinant(lattice), 0.5);
-
-	status = DftiCreateDescriptor(&handle, DFTI_DOUBLE, DFTI_COMPLEX, dim, length);
-	CHECK_STATUS(status);
-	status = DftiSetValue(handle, DFTI_FORWARD_SCALE, sqrt_vol/fftg[0]/fftg[1]/fftg[2]);
+	DFTI_DESCRIPTOR_HANDLE handle = get_fft_plan(fftg, determinant(lattice), 1);
+	status = DftiComputeForward(handle, x);
 	CHECK_STATUS(status);
-	status = DftiCommitDescriptor(handle);
+
+	for (int w = 0; w < num_waves; w++) {
+		g1 = (Gs[3*w+0]+fftg[0]) % fftg[0];
+		g2 = (Gs[3*w+1]+fftg[1]) % fftg[1];
+		g3 = (Gs[3*w+2]+fftg[2]) % fftg[2];
+		Cs[w] = x[g1*fftg[1]*fftg[2] + g2*fftg[2] + g3];
+	}
+}
+
+void fft3d_batch(double complex* x, double* lattice, int* Gs,
+	float complex** Cs, int num_waves, int num_transforms, int* fftg) {
+
+	MKL_LONG status = 0;
+
+	long gridsize = (long) fftg[0] * fftg[1] * fftg[2];
+	for (long w = 0; w < gridsize * num_transforms; w++) {
+		x[w] = 0;
+	}
+	int g1, g2, g3;
+	for (int w = 0; w < num_waves; w++) {
+		g1 = (Gs[3*w+0]+fftg[0]) % fftg[0];
+		g2 = (Gs[3*w+1]+fftg[1]) % fftg[1];
+		g3 = (Gs[3*w+2]+fftg[2]) % fftg[2];
+		long index = g1*fftg[1]*fftg[2] + g2*fftg[2] + g3;
+		for (int t = 0; t < num_transforms; t++) {
+			x[t * gridsize + index] = Cs[t][w];
+		}
+	}
+
+	DFTI_DESCRIPTOR_HANDLE handle = get_fft_plan(fftg, determinant(lattice), num_transforms);
+	status = DftiComputeBackward(handle, x);
 	CHECK_STATUS(status);
+}
+
+void fwd_fft3d_batch(double complex* x, double* lattice, int* Gs,
+	float complex** Cs, int num_waves, int num_transforms, int* fftg) {
+
+	MKL_LONG status = 0;
+
+	long gridsize = (long) fftg[0] * fftg[1] * fftg[2];
+	DFTI_DESCRIPTOR_HANDLE handle = get_fft_plan(fftg, determinant(lattice), num_transforms);
 	status = DftiComputeForward(handle, x);
 	CHECK_STATUS(status);
 
+	int g1, g2, g3;
 	for (int w = 0; w < num_waves; w++) {
 		g1 = (Gs[3*w+0]+fftg[0]) % fftg[0];
 		g2 = (Gs[3*w+1]+fftg[1]) % fftg[1];
 		g3 = (Gs[3*w+2]+fftg[2]) % fftg[2];
-		Cs[w] = x[g1*fftg[1]*fftg[2] + g2*fftg[2] + g3];
+		long index = g1*fftg[1]*fftg[2] + g2*fftg[2] + g3;
+		for (int t = 0; t < num_transforms; t++) {
+			Cs[t][w] = x[t * gridsize + index];
+		}
 	}
-	
-	DftiFreeDescriptor(&handle);
 }
@@ -19,4 +19,45 @@ void fft3d(double complex* x, int* G_bounds, double* lattice,
 void fwd_fft3d(double complex* x, int* G_bounds, double* lattice,
 	double* kpt, int* Gs, float complex* Cs, int num_waves, int* fftg);
 
+/**
+Same as fft3d, but for num_transforms sets of coefficients Cs[t]
+with the same plane waves Gs, which are transformed with a single
+batched FFT. The real space values of set t are stored in
+x[t*gridsize:(t+1)*gridsize], where gridsize=fftg[0]*fftg[1]*fftg[2].
+*/
+void fft3d_batch(double complex* x, double* lattice, int* Gs,
+	float complex** Cs, int num_waves, int num_transforms, int* fftg);
+
+/**
+Same as fwd_fft3d, but for num_transforms grids stored one after
+the other in x (see fft3d_batch). The coefficients of grid t are
+stored in Cs[t].
+*/
+void fwd_fft3d_batch(double complex* x, double* lattice, int* Gs,
+	float complex** Cs, int num_waves, int num_transforms, int* fftg);
+
+/**
+Returns the number of grids (at most max_transforms) to transform
+at once with fft3d_batch or fwd_fft3d_batch, which is limited so that
+the buffer for the grids stays small.
+*/
+int fft_batch_size(int* fftg, int max_transforms);
+
+/**
+Returns a 64-byte aligned buffer of count*fftg[0]*fftg[1]*fftg[2] values
+belonging to the calling thread, for use as the x argument of fft3d,
+fwd_fft3d, fft3d_batch and fwd_fft3d_batch. num (0 or 1) selects one
+of two buffers, so that two can be used at once. The buffers (and the FFT plans used by fft3d
+and fwd_fft3d) are kept and reused by later calls from the same thread,
+including in later parallel loops, so the contents of the buffer are
+undefined and it must not be freed by the caller.
+*/
+double complex* fft_workspace(int num, int* fftg, int count);
+
+/**
+Frees the buffers returned by fft_workspace and the cached FFT plans
+of every thread. Must not be called from inside a parallel region.
+*/
+void free_fft_workspaces(void);
+
 #endif
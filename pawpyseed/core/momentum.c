@@ -1,9 +1,11 @@
 #include <stdio.h>
 #include <stdlib.h>
+#include <string.h>
 #include <complex.h>
 #include <math.h>
 #include <mkl.h>
 #include "utils.h"
+#include "gsphere.h"
 #include "reader.h"
 #include "sbt.h"
 #include "momentum.h"
@@ -368,45 +370,12 @@ void list_to_grid_map(int* grid, int* G_bounds, int* gdim, int* igall, int num_w
 
 int get_momentum_grid(int* igall, pswf_t* wf, double nb1max, double nb2max, double nb3max, double encut) {
 
-	double* b1 = wf->reclattice + 0;
-	double* b2 = wf->reclattice + 3;
-	double* b3 = wf->reclattice + 6;
-
-	int ncnt = -1;
-	for (int ig3 = 0; ig3 <= 2 * nb3max; ig3++) {
-		int ig3p = ig3;
-		if (ig3 > nb3max) ig3p = ig3 - 2 * nb3max - 1;
-		for (int ig2 = 0; ig2 <= 2 * nb2max; ig2++) {
-			int ig2p = ig2;
-			if (ig2 > nb2max) ig2p = ig2 - 2 * nb2max - 1;
-			for (int ig1 = 0; ig1 <= 2 * nb1max; ig1++) {
-				int ig1p = ig1;
-				if (ig1 > nb1max) ig1p = ig1 - 2 * nb1max - 1;
-				double sumkg[3];
-				for (int j = 0; j < 3; j++) {
-					sumkg[j] = (ig1p) * b1[j]
-								+ (ig2p) * b2[j]
-								+ (ig3p) * b3[j];
-				}
-				double gtot = mag(sumkg);
-				double etot = pow(gtot,2.0) / c;
-				//printf("%lf %lf\n", etot, gtot);
-				if (etot <= encut) {
-					ncnt++;
-					igall[ncnt*3+0] = ig1p;
-					igall[ncnt*3+1] = ig2p;
-					igall[ncnt*3+2] = ig3p;
-					//if (ig1p < wf->G_bounds[0]) wf->G_bounds[0] = ig1p;
-					//else if (ig1p > wf->G_bounds[1]) wf->G_bounds[1] = ig1p;
-					//if (ig2p < wf->G_bounds[2]) wf->G_bounds[2] = ig2p;
-					//else if (ig2p > wf->G_bounds[3]) wf->G_bounds[3] = ig2p;
-					//if (ig3p < wf->G_bounds[4]) wf->G_bounds[4] = ig3p;
-					//else if (ig3p > wf->G_bounds[5]) wf->G_bounds[5] = ig3p;
-				}
-			}
-		}
-	}
-	ncnt++;
+	double k[3] = {0, 0, 0};
+	int G_bounds[6];
+	int ncnt = 0;
+	int* Gs = get_gsphere(wf->reclattice, encut, k, 1, &ncnt, G_bounds);
+	memcpy(igall, Gs, 3 * ncnt * sizeof(int));
+	release_gsphere(Gs);
 
 	return ncnt;
 }
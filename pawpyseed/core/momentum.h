@@ -67,6 +67,11 @@ void get_momentum_matrix(double complex* matrix, int numg, int* igall,
 void momentum_grid_size(pswf_t* wf, double* nb1max, double* nb2max, double* nb3max,
 						int* npmax, double encut);
 
+/**
+Stores the G-vectors with kinetic energy up to encut to igall, in the
+order used by VASP, and returns the number of G-vectors. nb1max, nb2max and
+nb3max are no longer used, since the bounds are found by get_gsphere.
+*/
 int get_momentum_grid(int* igall, pswf_t* wf, double nb1max, double nb2max, double nb3max, double encut);
 
 void grid_bounds(int* G_bounds, int* gdim, int* igall, int num_waves);
@@ -11,6 +11,7 @@ class NCLWavefunction(pawpyc.CNCLWavefunction, Wavefunction):
 				partials waves, for the structure
 			dim (pymatgen.io.vasp.outputs.Outcar OR np.ndarry OR list of length 3):
 				Outcar object for reading ngf or the dimensions NG* of the FFT grid
+			symprec (float, 1e-4): precision tolerance for symmetry operations
 			setup_projectors (bool, False): Whether to set up the core region
 				components of the wavefunctions. Pawpyseed will set up the projectors
 				automatically when they are first needed, so this generally
@@ -23,6 +24,7 @@ class NCLWavefunction(pawpyc.CNCLWavefunction, Wavefunction):
 		if not self.ncl:
 			raise PAWpyError("Pseudowavefunction is collinear! Call Wavefunction(...) instead")
 		self.structure = struct
+		self.symprec = symprec
 		self.cr = cr
 		self.dim = np.array(dim).astype(np.int32)
 		if setup_projectors:
@@ -30,7 +32,8 @@ class NCLWavefunction(pawpyc.CNCLWavefunction, Wavefunction):
 
 	@staticmethod
 	def from_files(struct="CONTCAR", wavecar="WAVECAR", cr="POTCAR",
-		vr="vasprun.xml", setup_projectors=False):
+		vr="vasprun.xml", setup_projectors=False, lazy=False,
+		bands=None, energy_window=None):
 		"""
 		Construct a Wavefunction object from file paths.
 
@@ -44,20 +47,35 @@ class NCLWavefunction(pawpyc.CNCLWavefunction, Wavefunction):
 				components of the wavefunctions. Pawpyseed will set up the projectors
 				automatically when they are first needed, so this generally
 				can be left as False.
+			lazy (bool, False): Whether to memory map the WAVECAR and only
+				read the plane-wave coefficients of a band from disk when
+				they are first used. Useful for very large WAVECARs.
+				Ignored for compressed WAVECARs.
+			bands (int or (int, int), None): If not None, only read this
+				band, or the bands from bands[0] to bands[1] (inclusive,
+				0-indexed), from the WAVECAR. The band indices of the
+				resulting object then start at 0 at bands[0]; the WAVECAR
+				index of band 0 is stored in the band_start attribute.
+			energy_window ((float, float), None): If not None, only read the
+				bands with energies (in eV, same reference as the
+				eigenvalues in vasprun.xml) between energy_window[0] and
+				energy_window[1] at any k-point, along with any bands
+				in between them. Can be combined with bands.
 
 		Returns:
 			Wavefunction object
 		"""
-		vr = Vasprun(vr)
+		vr = read_vasprun(vr)
 		dim = np.array([vr.parameters["NGX"], vr.parameters["NGY"], vr.parameters["NGZ"]])
 		symprec = vr.parameters["SYMPREC"]
-		pwf = pawpyc.PWFPointer(wavecar, vr)
+		pwf = pawpyc.PWFPointer(wavecar, vr, lazy, bands, energy_window)
 		return NCLWavefunction(Poscar.from_file(struct).structure,
 			pwf, CoreRegion(Potcar.from_file(cr)),
 			dim, symprec, setup_projectors)
 
 	@staticmethod
-	def from_directory(path, setup_projectors = False):
+	def from_directory(path, setup_projectors = False, lazy = False,
+		bands = None, energy_window = None):
 		"""
 		Assumes VASP output has the default filenames and is located
 		in the directory specificed by path.
@@ -68,6 +86,12 @@ class NCLWavefunction(pawpyc.CNCLWavefunction, Wavefunction):
 				components of the wavefunctions. Pawpyseed will set up the projectors
 				automatically when they are first needed, so this generally
 				can be left as False.
+			lazy (bool, False): Whether to memory map the WAVECAR,
+				see from_files
+			bands (int or (int, int), None): Range of bands to read,
+				see from_files
+			energy_window ((float, float), None): Energy window of bands
+				to read, see from_files
 
 		Returns:
 			Wavefunction object
@@ -76,11 +100,23 @@ class NCLWavefunction(pawpyc.CNCLWavefunction, Wavefunction):
 		for d in ["CONTCAR", "WAVECAR", "POTCAR", "vasprun.xml"]:
 			filepaths.append(str(os.path.join(path, d)))
 		args = filepaths + [setup_projectors]
-		return NCLWavefunction.from_files(*args)
+		return NCLWavefunction.from_files(*args, lazy=lazy,
+			bands=bands, energy_window=energy_window)
 
 	def desymmetrized_copy(self, allkpts = None, weights = None):
 		raise NotImplementedError()
 
+	def projections(self, k, s=0, spin_component=0):
+		"""
+		Same as Wavefunction.projections, but spin_component can be 1 or 2
+		to get the projections of the spin up or spin down
+		part of each band instead.
+		"""
+		if not self.projector_owner:
+			self._make_c_projectors(compute_projections=False)
+		self._evaluate_projections(k, s)
+		return self._get_projections(k, s, spin_component)
+
 	def write_state_realspace(self, b, k, s, fileprefix = "", dim=None, scale = 1,
 								remove_phase=False):
 		"""
@@ -106,7 +142,7 @@ class NCLWavefunction(pawpyc.CNCLWavefunction, Wavefunction):
 				with complex double values for the realspace wavefunction
 			The wavefunction is written in two files with z the slow index.
 		"""
-		self.check_c_projectors()
+		self.check_band_projectors(b, k, s)
 		if dim is not None:
 			self.update_dim(np.array(dim))
 		filename_base = "%sB%dK%dS%d" % (fileprefix, b, k, s)
@@ -16,15 +16,26 @@ cdef class PWFPointer:
         structure, kpts, band_props, allkpts, weights, symprec,
         time_reversal_symmetry)
 
+cdef class PPotPointer:
+
+    cdef ppc.ppot_t* ptr
+    cdef object __weakref__
+
+    @staticmethod
+    cdef PPotPointer from_pseudopotential(pp, double grid_encut)
+
 cdef class PseudoWavefunction:
 
     cdef ppc.pswf_t* wf_ptr
     cdef readonly int nband
+    cdef readonly int band_start
     cdef readonly int nwk
     cdef readonly int nspin
     cdef readonly int ncl
     cdef readonly np.ndarray kws
     cdef readonly np.ndarray kpts
+    cdef np.ndarray _eigenvalues
+    cdef np.ndarray _occupations
 
 cdef class CWavefunction(PseudoWavefunction):
 
@@ -36,6 +47,7 @@ cdef class CWavefunction(PseudoWavefunction):
     cdef double[::1] coords
     cdef int number_projector_elements
     cdef readonly int projector_owner
+    cdef list _ppots
 
 cdef class CProjector:
 
@@ -56,6 +68,8 @@ cdef class CProjector:
     cdef int num_N_RS_R
     cdef int num_N_RS_S
 
+    cdef ppc.overlap_context_t* ctx
+
 cdef class CMomentumMatrix:
 
     cdef public CWavefunction wf
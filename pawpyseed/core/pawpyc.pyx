@@ -15,16 +15,18 @@ from cpython cimport array
 from libc.stdlib cimport malloc, free
 from libc.stdio cimport FILE
 from pymatgen.core.structure import Structure
-from pymatgen.io.vasp.outputs import Vasprun
-from monty.io import zopen
+from pawpyseed.core.vasprun import read_vasprun
 import numpy as np
 from numpy.testing import assert_almost_equal
 cimport numpy as np
 import time
 import sys
+import weakref
 from libc.stdint cimport uintptr_t
 from pawpyseed.core.symmetry import *
 
+np.import_array()
+
 ###################
 #  TIMER SECTION  #
 ###################
@@ -47,6 +49,19 @@ class Timer:
 #  MISCELLANEOUS PYTHON UTILS  #
 ################################  
 
+cdef np.ndarray buffer_view(void* data, np.npy_intp nbytes, owner):
+	"""
+	Returns a read-only uint8 array of the nbytes bytes at data,
+	without copying them. The array keeps owner, the object that
+	owns data, alive for as long as the array (or any array
+	constructed from it) exists.
+	"""
+	cdef np.ndarray arr = np.PyArray_SimpleNewFromData(1, &nbytes,
+		np.NPY_UINT8, data)
+	np.set_array_base(arr, owner)
+	arr.flags.writeable = False
+	return arr
+
 def el(site):
 	"""
 	Return the element symbol of a pymatgen
@@ -185,6 +200,63 @@ cpdef reciprocal_offsite_wave_overlap(np.ndarray[double, ndim=1] dcoord,
 
 	return res
 
+def read_wavecar_header(filename):
+	"""
+	Reads the metadata of a WAVECAR (plain, gzip or bzip2) from its header
+	records, without reading any plane-wave coefficients.
+
+	Returns:
+		dict with the keys nspin, nwk, nband, nprec (int), encut (float),
+		lattice (3x3 array), kpts (nwk x 3 array), num_waves (length nwk
+		array), energies and occupations (nspin x nwk x nband arrays)
+	"""
+	cdef ppc.wavecar_header_t* header = ppc.read_wavecar_header(
+		str(filename).encode('utf-8'))
+	if header is NULL:
+		raise IOError("Could not read WAVECAR %s" % filename)
+	cdef int nwk = header.nwk
+	cdef int nbk = header.nspin * nwk * header.nband
+	shape = (header.nspin, nwk, header.nband)
+	res = {
+		'nspin' : header.nspin,
+		'nwk' : nwk,
+		'nband' : header.nband,
+		'nprec' : header.nprec,
+		'encut' : header.encut,
+		'lattice' : np.array([header.lattice[i] for i in range(9)]).reshape(3, 3),
+		'kpts' : np.array(<double[:3*nwk]> header.kpts).reshape(nwk, 3),
+		'num_waves' : np.array(<int[:nwk]> header.num_waves),
+		'energies' : np.array(<double[:nbk]> header.energies).reshape(shape),
+		'occupations' : np.array(<double[:nbk]> header.occs).reshape(shape),
+	}
+	ppc.free_wavecar_header(header)
+	return res
+
+def free_fft_workspaces():
+	"""
+	Frees the FFT plans and grid-sized workspaces that each thread keeps
+	for reuse between band projections and overlap setups, e.g. after all
+	Projector objects for a structure have been set up. They are
+	allocated again when they are next needed.
+	"""
+	ppc.free_fft_workspaces()
+
+def set_projector_memory_budget(long num_bytes):
+	"""
+	Sets the maximum number of bytes used to store the real space
+	projector values of the sites of a wavefunction. If the values at
+	every site do not fit, projections are evaluated for one block of
+	sites at a time, at the cost of one extra FFT of each band per block.
+	A budget of zero or less means no limit. The default is 2 GB.
+	"""
+	ppc.set_projector_memory_budget(num_bytes)
+
+def get_projector_memory_budget():
+	"""
+	Returns the memory budget set by set_projector_memory_budget, in bytes.
+	"""
+	return ppc.get_projector_memory_budget()
+
 ############################
 #  PAWPYSEED BASE CLASSES  #
 ############################
@@ -197,28 +269,91 @@ cdef class PWFPointer:
 	objects without symmetry-reduced k-point sampling.
 	"""
 
-	def __init__(self, filename = None, vr = None):
+	def __init__(self, filename = None, vr = None, lazy = False,
+		bands = None, energy_window = None):
+		"""
+		Arguments:
+			filename (str): WAVECAR file path
+			vr (str, Vasprun or VasprunData): vasprun.xml file path, or
+				the result of reading it with pymatgen or read_vasprun
+			lazy (bool, False): If True, memory map the WAVECAR so that
+				band coefficients are only read from disk when they are
+				used. Ignored for compressed WAVECARs.
+			bands (int or (int, int), None): If not None, only read
+				this band, or the bands from bands[0] to bands[1] (inclusive,
+				0-indexed). The records of the other bands are skipped.
+			energy_window ((float, float), None): If not None, only read
+				the smallest range of bands that contains every band with an
+				energy (in eV) between energy_window[0] and energy_window[1]
+				at any k-point. Can be combined with bands.
+		"""
 		cdef double[::1] kws
+		cdef int band_min = 0
+		cdef int band_max = -1
+		cdef double emin = 1
+		cdef double emax = 0
 		if filename == None or vr == None:
 			self.ptr = NULL
 		else:
 			filename = str(filename)
 			if type(vr) == str:
-				vr = Vasprun(vr) 
+				vr = read_vasprun(vr)
 			self.weights = np.array(vr.actual_kpoints_weights, dtype=np.float64)
 			self.kpts = np.array(vr.actual_kpoints, dtype=np.float64)
 			self.band_props = np.array(vr.eigenvalue_band_properties)
 			kws = self.weights
-			if '.gz' in filename or '.bz2' in filename:
-				f = zopen(filename, 'rb')
-				contents = f.read()
-				f.close()
-				self.ptr = ppc.read_wavefunctions_from_str(
-					contents, &kws[0])
+			if bands is not None or energy_window is not None:
+				if bands is not None:
+					if type(bands) == int:
+						bands = (bands, bands)
+					band_min, band_max = bands
+					if band_min < 0 or band_max < band_min:
+						raise ValueError("Invalid band range")
+				if energy_window is not None:
+					emin, emax = energy_window
+					if emax < emin:
+						raise ValueError("Invalid energy window")
+				self.ptr = ppc.read_wavefunctions_bands(filename.encode('utf-8'),
+					&kws[0], lazy, band_min, band_max, emin, emax)
+				if self.ptr is NULL:
+					raise IOError("Could not read the selected bands of WAVECAR %s" % filename)
+			elif '.gz' in filename or '.bz2' in filename:
+				self.ptr = ppc.read_wavefunctions_compressed(
+					filename.encode('utf-8'), &kws[0])
+				if self.ptr is NULL:
+					raise IOError("Could not read WAVECAR %s" % filename)
+			elif lazy:
+				self.ptr = ppc.read_wavefunctions_mmap(filename.encode('utf-8'), &kws[0])
+				if self.ptr is NULL:
+					raise IOError("Could not map WAVECAR %s" % filename)
 			else:
 				self.ptr = ppc.read_wavefunctions(filename.encode('utf-8'), &kws[0])
 			sys.stdout.flush()
 
+	@staticmethod
+	def from_snapshot(filename, long offset, kpts, weights, band_props):
+		"""
+		Returns a PWFPointer for a snapshot written by
+		CWavefunction._write_snapshot. The snapshot is memory
+		mapped, so band coefficients are only read from disk
+		when they are used.
+
+		Arguments:
+			filename (str): snapshot file path
+			offset (int): byte offset of the snapshot in the file
+			kpts, weights, band_props: same as the attributes of
+				the PWFPointer the snapshot was made from
+		"""
+		filename = str(filename)
+		cdef PWFPointer pwfp = PWFPointer()
+		pwfp.ptr = ppc.read_pswf_snapshot(filename.encode('utf-8'), offset)
+		if pwfp.ptr is NULL:
+			raise IOError("Could not read wavefunction snapshot %s" % filename)
+		pwfp.kpts = np.array(kpts, dtype=np.float64)
+		pwfp.weights = np.array(weights, dtype=np.float64)
+		pwfp.band_props = np.array(band_props)
+		return pwfp
+
 	@staticmethod
 	cdef PWFPointer from_pointer_and_kpts(ppc.pswf_t* ptr,
 		structure, kpts, band_props, allkpts, weights, symprec,
@@ -262,6 +397,61 @@ cdef class PWFPointer:
 		return pwfp
 
 
+_PPOT_CACHE = weakref.WeakValueDictionary()
+
+cdef class PPotPointer:
+	"""
+	Container class for a pointer to a single ppot_t object in C,
+	which holds the projector functions and partial waves of one
+	element at one grid_encut. Use get_ppot_pointer to obtain one, so
+	that all wavefunctions in the process set up with the same
+	pseudopotential and grid_encut share the same radial data.
+	The ppot_t is freed when the last reference to its PPotPointer
+	(held by each CWavefunction using it) is released.
+	"""
+
+	def __dealloc__(self):
+		if self.ptr != NULL:
+			ppc.free_ppot_list(self.ptr, 1)
+
+	@staticmethod
+	cdef PPotPointer from_pseudopotential(pp, double grid_encut):
+		cdef int[::1] clabels = np.array([0, len(pp.ls), pp.ndata,
+			len(pp.grid)], dtype=np.intc)
+		cdef int[::1] ls = np.array(pp.ls, dtype=np.intc)
+		cdef double[::1] wgrid = np.ascontiguousarray(pp.grid, dtype=np.double)
+		cdef double[::1] projectors = np.concatenate(
+			pp.realprojs[:len(pp.ls)]).astype(np.double)
+		cdef double[::1] aewaves = np.concatenate(
+			pp.aewaves[:len(pp.ls)]).astype(np.double)
+		cdef double[::1] pswaves = np.concatenate(
+			pp.pswaves[:len(pp.ls)]).astype(np.double)
+		cdef double[::1] rmax = np.array([pp.rmax], dtype=np.double)
+
+		cdef PPotPointer pptr = PPotPointer()
+		pptr.ptr = ppc.get_projector_list(1, &clabels[0], &ls[0],
+			&wgrid[0], &projectors[0], &aewaves[0], &pswaves[0],
+			&rmax[0], grid_encut)
+		return pptr
+
+def get_ppot_pointer(pp, double grid_encut):
+	"""
+	Returns a PPotPointer for the Pseudopotential pp and grid_encut.
+	If pp has a hash attribute (see load_pseudopotential), the result
+	is shared with every other caller in the process that uses the same
+	POTCAR and grid_encut, as long as one of them holds a reference to it.
+	"""
+	key = getattr(pp, 'hash', None)
+	if key is None:
+		return PPotPointer.from_pseudopotential(pp, grid_encut)
+	key = (key, grid_encut)
+	pptr = _PPOT_CACHE.get(key)
+	if pptr is None:
+		pptr = PPotPointer.from_pseudopotential(pp, grid_encut)
+		_PPOT_CACHE[key] = pptr
+	return pptr
+
+
 cdef class PseudoWavefunction:
 	"""
 	THIS CLASS IS NOT USEFUL ON ITS OWN. IF YOU WANT TO WORK WITH
@@ -279,8 +469,13 @@ cdef class PseudoWavefunction:
 		wf_ptr (ctypes POINTER): c pointer to pswf_t object
 		ncl (bool): Whether the pseudowavefunction is from a noncollinear
 			VASP calculation
+		band_start (int): index in the WAVECAR of band 0, which is
+			nonzero if only a range of bands was read. Band arguments
+			to methods are indices into the bands that were read.
 		band_props (list): [band gap, conduction band minimum,
 			valence band maximum, whether the band gap is direct]
+		eigenvalues (np.array): (nspin, nwk, nband) band energies
+		occupations (np.array): (nspin, nwk, nband) band occupations
 	"""
 
 	def __init__(self, PWFPointer pwf):
@@ -295,6 +490,7 @@ cdef class PseudoWavefunction:
 		self.kws = pwf.weights.copy(order='C')
 		self.ncl = ppc.is_ncl(self.wf_ptr) > 0
 		self.nband = ppc.get_nband(self.wf_ptr)
+		self.band_start = ppc.get_band_start(self.wf_ptr)
 		self.nwk = ppc.get_nwk(self.wf_ptr)
 		self.nspin = ppc.get_nspin(self.wf_ptr)
 		self.encut = ppc.get_encut(self.wf_ptr)
@@ -303,6 +499,81 @@ cdef class PseudoWavefunction:
 	def __dealloc__(self):
 		ppc.free_pswf(self.wf_ptr)
 
+	def _check_kpoint_and_spin(self, int k, int s):
+		if k < 0 or k >= self.nwk:
+			raise ValueError("Invalid k-point choice")
+		if s < 0 or s >= self.nspin:
+			raise ValueError("Invalid spin choice")
+
+	def coefficients(self, int k, int s = 0):
+		"""
+		Returns the plane-wave coefficients of every band at k-point k
+		and spin s as a read-only complex64 array of shape
+		(nband, number of plane waves at k). The array is a view of the
+		coefficients stored by the wavefunction, not a copy, so for
+		memory-mapped wavefunctions the coefficients are only read from
+		disk when the array is used.
+
+		Arguments:
+			k (int): k-point index
+			s (int, 0): spin index
+		"""
+		self._check_kpoint_and_spin(k, s)
+		cdef ppc.kpoint_t* kpt = self.wf_ptr.kpts[k + s * self.nwk]
+		cdef long nw = kpt.num_waves
+		cdef long stride = nw * sizeof(float complex)
+		cdef int b
+		if self.nband > 1:
+			# bands read lazily from a WAVECAR are one record apart
+			stride = <char*> kpt.bands[1].Cs - <char*> kpt.bands[0].Cs
+			for b in range(1, self.nband):
+				if <char*> kpt.bands[b].Cs - <char*> kpt.bands[b-1].Cs != stride:
+					return np.array([<float complex[:nw]> kpt.bands[b].Cs\
+									for b in range(self.nband)])
+		buf = buffer_view(kpt.bands[0].Cs,
+			(self.nband - 1) * stride + nw * sizeof(float complex), self)
+		return np.ndarray((self.nband, nw), dtype=np.complex64, buffer=buf,
+			strides=(stride, sizeof(float complex)))
+
+	def _band_property_arrays(self):
+		cdef int s, k, b
+		cdef ppc.band_t* band
+		cdef double[:,:,::1] energies
+		cdef double[:,:,::1] occs
+		if self._eigenvalues is None:
+			shape = (self.nspin, self.nwk, self.nband)
+			self._eigenvalues = np.zeros(shape, dtype=np.float64)
+			self._occupations = np.zeros(shape, dtype=np.float64)
+			energies = self._eigenvalues
+			occs = self._occupations
+			for s in range(self.nspin):
+				for k in range(self.nwk):
+					for b in range(self.nband):
+						band = self.wf_ptr.kpts[k + s * self.nwk].bands[b]
+						energies[s,k,b] = band.energy
+						occs[s,k,b] = band.occ
+			self._eigenvalues.flags.writeable = False
+			self._occupations.flags.writeable = False
+		return self._eigenvalues, self._occupations
+
+	@property
+	def eigenvalues(self):
+		"""
+		Read-only array of shape (nspin, nwk, nband) with the
+		energy (in eV) of each band at each k-point. The array
+		is gathered once and shared by all later calls.
+		"""
+		return self._band_property_arrays()[0]
+
+	@property
+	def occupations(self):
+		"""
+		Read-only array of shape (nspin, nwk, nband) with the
+		occupation of each band at each k-point. The array
+		is gathered once and shared by all later calls.
+		"""
+		return self._band_property_arrays()[1]
+
 	def pseudoprojection(self, band_num, PseudoWavefunction basis, flip_spin=False):
 		"""
 		Computes <psibt_n1k|psit_n2k> for all n1 and k
@@ -319,6 +590,31 @@ cdef class PseudoWavefunction:
 		ppc.pseudoprojection(&resv[0], basis.wf_ptr, self.wf_ptr, band_num, flip_spin)
 		return res
 
+	def pseudoprojection_matrix(self, bands, PseudoWavefunction basis, flip_spin=False):
+		"""
+		Same as pseudoprojection for each band in bands, but the overlaps
+		of all of the bands are calculated together as matrix products of
+		the plane wave coefficients at each k-point.
+
+		Arguments:
+			bands (list of int): bands of self to project onto basis
+			basis (Pseudowavefunction): pseudowavefunctions onto whose bands
+				the bands of self are projected
+
+		Returns:
+			(np.array): array of shape (len(bands), basis.nband * nwk * nspin),
+				where row i is pseudoprojection(bands[i], basis, flip_spin)
+		"""
+		cdef int[::1] bandv = np.array(bands, dtype=np.int32)
+		res = np.zeros((bandv.shape[0], basis.nband * basis.nwk * basis.nspin),
+			dtype = np.complex128)
+		cdef double complex[:,::1] resv = res
+		if bandv.shape[0] == 0:
+			return res
+		ppc.pseudoprojection_matrix(&resv[0,0], basis.wf_ptr, self.wf_ptr,
+			bandv.shape[0], &bandv[0], flip_spin)
+		return res
+
 
 cdef class CWavefunction(PseudoWavefunction):
 	"""
@@ -345,49 +641,30 @@ cdef class CWavefunction(PseudoWavefunction):
 		super(CWavefunction, self).__init__(pwf)
 
 	def _c_projector_setup(self, int num_elems, int num_sites,
-							double grid_encut, nums, coords, dim, pps):
+							double grid_encut, nums, coords, dim, pps,
+							compute_projections = True, recip = False):
 		"""
 		Sets up the projector functions for AE components.
+		If compute_projections is False, the projections <p_i|psit_nk>
+		are not evaluated yet, but only when they are needed
+		(see _evaluate_projections). Projections that have already
+		been loaded into the bands (e.g. from a snapshot) are never
+		evaluated again. If recip is True, the projections are evaluated
+		in reciprocal space instead of real space.
 		"""
 
 		start = time.monotonic()
-		clabels = np.array([], np.intc)
-		ls = np.array([], np.intc)
-		projectors = np.array([], np.double)
-		aewaves = np.array([], np.double)
-		pswaves = np.array([], np.double)
-		wgrids = np.array([], np.double)
-		augs = np.array([], np.double)
-		rmaxs = np.array([], np.double)
-
-		for num in sorted(pps.keys()):
-			pp = pps[num]
-			clabels = np.append(clabels, [num, len(pp.ls), pp.ndata, len(pp.grid)])
-			rmaxs = np.append(rmaxs, pp.rmax)
-			ls = np.append(ls, pp.ls)
-			wgrids = np.append(wgrids, pp.grid)
-			augs = np.append(augs, pp.augs)
-			for i in range(len(pp.ls)):
-				proj = pp.realprojs[i]
-				aepw = pp.aewaves[i]
-				pspw = pp.pswaves[i]
-				projectors = np.append(projectors, proj)
-				aewaves = np.append(aewaves, aepw)
-				pswaves = np.append(pswaves, pspw)
-
-		cdef int[::1] clabels_v = clabels.astype(np.intc)
-		cdef int[::1] ls_v = ls.astype(np.intc)
-		cdef double[::1] wgrids_v = wgrids.astype(np.double)
-		cdef double[::1] projectors_v = projectors.astype(np.double)
-		cdef double[::1] aewaves_v = aewaves.astype(np.double)
-		cdef double[::1] pswaves_v = pswaves.astype(np.double)
-		cdef double[::1] rmaxs_v = rmaxs.astype(np.double)
-
 		print ("GRID ENCUT", grid_encut)
-		cdef ppc.ppot_t* projector_list = ppc.get_projector_list(
-							num_elems, &clabels_v[0], &ls_v[0], &wgrids_v[0],
-							&projectors_v[0], &aewaves_v[0], &pswaves_v[0],
-							&rmaxs_v[0], grid_encut)
+		self._ppots = [get_ppot_pointer(pps[num], grid_encut)\
+						for num in sorted(pps.keys())]
+		cdef ppc.ppot_t** pp_ptrs = <ppc.ppot_t**> malloc(
+			num_elems * sizeof(ppc.ppot_t*))
+		cdef int i
+		for i in range(num_elems):
+			pp_ptrs[i] = (<PPotPointer> self._ppots[i]).ptr
+		cdef ppc.ppot_t* projector_list = ppc.share_projector_list(
+			pp_ptrs, num_elems)
+		free(pp_ptrs)
 		end = time.monotonic()
 		print('--------------\nran get_projector_list in %f seconds\n---------------' % (end-start))
 
@@ -398,13 +675,116 @@ cdef class CWavefunction(PseudoWavefunction):
 
 		print("STARTING PROJSETUP")
 		sys.stdout.flush()
-		ppc.setup_projections(
+		ppc.init_projections(
 			self.wf_ptr, projector_list,
 			num_elems, num_sites, &self.dimv[0],
-			&self.nums[0], &self.coords[0]
+			&self.nums[0], &self.coords[0], 1 if recip else 0
 			)
-
 		self.projector_owner = 1
+		if compute_projections:
+			self._evaluate_projections()
+
+	def _evaluate_projections(self, int k = -1, int s = 0, int band = -1):
+		"""
+		Evaluates the projections <p_i|psit_nk> that have not been
+		evaluated yet. If k is -1, this is done for every band and
+		k-point, otherwise only for k-point k and spin s, and only for
+		the band with index band if band is not -1.
+		The projectors must be set up (see _c_projector_setup).
+		"""
+		if not self.projector_owner:
+			raise ValueError("Projectors have not been set up")
+		if k == -1:
+			ppc.evaluate_all_projections(self.wf_ptr)
+			return
+		self._check_kpoint_and_spin(k, s)
+		if band == -1:
+			ppc.evaluate_projections(self.wf_ptr, k + s * self.nwk, 0, self.nband)
+		elif band < 0 or band >= self.nband:
+			raise ValueError("Invalid band index %d" % band)
+		else:
+			ppc.evaluate_projections(self.wf_ptr, k + s * self.nwk, band, 1)
+
+	def _write_snapshot(self, filename, long offset):
+		"""
+		Writes a snapshot of the plane-wave coefficients, k-points,
+		energies, occupations and (if set up) projections
+		to filename, starting at offset (a multiple of 64).
+		The file must exist. Returns the size of the file.
+		"""
+		filename = str(filename)
+		cdef long size = ppc.write_pswf_snapshot(self.wf_ptr,
+			filename.encode('utf-8'), offset)
+		if size < 0:
+			raise IOError("Could not write wavefunction snapshot %s" % filename)
+		return size
+
+	def _projection_size(self):
+		cdef ppc.projection_t* projs = self.wf_ptr.kpts[0].bands[0].projections
+		cdef int size = 0
+		for i in range(self.wf_ptr.num_sites):
+			size += projs[i].total_projs
+		return size
+
+	def _get_projections(self, int k, int s, int spin_component = 0):
+		"""
+		Returns a read-only view of the projections <p_i|psit_nk> of every
+		band at k-point k and spin s, with shape (nband, number of projectors
+		in the structure). spin_component is 0 for the projections of the
+		whole band, and 1 or 2 for the spin up or spin down projections of
+		a noncollinear wavefunction.
+		"""
+		self._check_kpoint_and_spin(k, s)
+		if self.wf_ptr.proj_block is NULL:
+			raise ValueError("Projections have not been set up")
+		if spin_component < 0 or spin_component > (2 if self.ncl else 0):
+			raise ValueError("Invalid spin component")
+		cdef long size = self._projection_size()
+		cdef long nk = self.nwk * self.nspin
+		cdef long offset = (spin_component * nk + k + s * self.nwk) * self.nband * size
+		buf = buffer_view(self.wf_ptr.overlap_block + offset,
+			self.nband * size * sizeof(double complex), self)
+		return np.ndarray((self.nband, size), dtype=np.complex128, buffer=buf)
+
+	def _get_projection_indices(self):
+		"""
+		Returns an array of shape (number of projectors in the structure, 4)
+		with the site index and the n (projector function index), l and m
+		of each column of the arrays returned by _get_projections.
+		"""
+		if self.wf_ptr.proj_block is NULL:
+			raise ValueError("Projections have not been set up")
+		cdef ppc.projection_t* projs = self.wf_ptr.kpts[0].bands[0].projections
+		res = np.zeros((self._projection_size(), 4), dtype=np.int32)
+		cdef int[:,::1] resv = res
+		cdef int row = 0
+		for i in range(self.wf_ptr.num_sites):
+			for p in range(projs[i].total_projs):
+				resv[row,0] = i
+				resv[row,1] = projs[i].ns[p]
+				resv[row,2] = projs[i].ls[p]
+				resv[row,3] = projs[i].ms[p]
+				row += 1
+		return res
+
+	def _overlap_cache_info(self):
+		"""
+		Returns the number of cached projections onto partial waves,
+		the number of cached sets of augmentation frequencies, and the
+		number of times overlap setups have reused one of them
+		(for testing the caches kept for Projector setups).
+		"""
+		cdef int num_wp = 0
+		cdef int num_aug = 0
+		cdef ppc.wave_proj_cache_t* wp_entry = self.wf_ptr.wp_cache
+		cdef ppc.aug_freqs_cache_t* aug_entry = self.wf_ptr.aug_cache
+		while wp_entry is not NULL:
+			num_wp += 1
+			wp_entry = wp_entry.next
+		while aug_entry is not NULL:
+			num_aug += 1
+			aug_entry = aug_entry.next
+		return num_wp, num_aug, self.wf_ptr.wp_hits
 
 	def update_dimv(self, dim):
 		dim = np.array(dim, dtype = np.int32, order = 'C', copy = False)
@@ -525,12 +905,7 @@ cdef class CWavefunction(PseudoWavefunction):
 							time_reversal_symmetry)
 
 	def _get_occs(self):
-		nk = self.nwk * self.nspin
-		res = np.zeros(self.nband * nk, dtype=np.float64, order='C')
-		for k in range(nk):
-			for b in range(self.nband):
-				res[b * nk + k] = self.wf_ptr.kpts[k].bands[b].occ
-		return res
+		return self.occupations.transpose(2, 0, 1).flatten()
 
 	def _get_energy_list(self, bands):
 		"""
@@ -540,13 +915,11 @@ cdef class CWavefunction(PseudoWavefunction):
 		for b in bands:
 			if b < 0 or b >= self.nband:
 				raise ValueError("Invalid band choice")
+		energies = self.eigenvalues.reshape(-1, self.nband)
+		occs = self.occupations.reshape(-1, self.nband)
 		energy_list = {}
 		for b in bands:
-			energy_list[b] = []
-			for s in range(self.nspin):
-				for k in range(self.nwk):
-					energy_list[b].append([ppc.get_energy(self.wf_ptr, b, k, s),\
-										ppc.get_occ(self.wf_ptr, b, k, s)])
+			energy_list[b] = np.stack((energies[:,b], occs[:,b]), axis=1).tolist()
 		return energy_list
 
 
@@ -639,6 +1012,12 @@ cdef class CProjector:
 		self.wf = wf
 		self.basis = basis
 
+	def __cinit__(self):
+		self.ctx = NULL
+
+	def __dealloc__(self):
+		ppc.free_overlap_context(self.ctx)
+
 	#-------------------------------------------------#
 	# HELPER FUNCTION ROUTINES FOR OVERLAP EVALUATION #
 	#-------------------------------------------------#
@@ -665,21 +1044,27 @@ cdef class CProjector:
 		cdef int* N_RS_R = NULL if self.num_N_RS_R == 0 else &self.N_RS_R[0]
 		cdef int* N_RS_S = NULL if self.num_N_RS_S == 0 else &self.N_RS_S[0]
 		
-		# choose function
+		# drop the state of any previous setup, then choose function
+		ppc.free_overlap_context(self.ctx)
+		self.ctx = NULL
 		if recip:
-			ppc.overlap_setup_recip(self.basis.wf_ptr, self.wf.wf_ptr,
+			self.ctx = ppc.overlap_setup_recip(self.basis.wf_ptr, self.wf.wf_ptr,
 				&self.basis.nums[0], &self.wf.nums[0], &self.basis.coords[0], &self.wf.coords[0],
 				N_R, N_S, N_RS_R, N_RS_S,
 				self.num_N_R, self.num_N_S, self.num_N_RS_R)
 		else:
-			ppc.overlap_setup_real(self.basis.wf_ptr, self.wf.wf_ptr,
+			self.ctx = ppc.overlap_setup_real(self.basis.wf_ptr, self.wf.wf_ptr,
 				&self.basis.nums[0], &self.wf.nums[0], &self.basis.coords[0], &self.wf.coords[0],
 				N_R, N_S, N_RS_R, N_RS_S,
 				self.num_N_R, self.num_N_S, self.num_N_RS_R)
 
 	def _add_augmentation_terms(self, np.ndarray[double complex, ndim=1] res, band_num, flip_spin):
+		self._add_augmentation_terms_block(res, [band_num], flip_spin)
+
+	def _add_augmentation_terms_block(self, np.ndarray res, bands, flip_spin):
 		
-		cdef double complex[::1] resv = res
+		cdef double complex[::1] resv = res.reshape(-1)
+		cdef int[::1] bandv = np.array(bands, dtype=np.int32)
 
 		# set up site lists
 		cdef int* M_R = NULL if self.num_M_R == 0 else &self.M_R[0]
@@ -690,15 +1075,20 @@ cdef class CProjector:
 		cdef int* N_RS_S = NULL if self.num_N_RS_S == 0 else &self.N_RS_S[0]
 
 		# call compensation terms C routine
-		ppc.compensation_terms(&resv[0], band_num, self.wf.wf_ptr, self.basis.wf_ptr,
+		ppc.compensation_terms_block(&resv[0], bandv.shape[0], &bandv[0],
+			self.wf.wf_ptr, self.basis.wf_ptr, self.ctx,
 			self.num_M_R, self.num_N_R, self.num_N_S, self.num_N_RS_R,
 			M_R, M_S, N_R, N_S, N_RS_R, N_RS_S,
 			&self.wf.nums[0], &self.wf.coords[0], &self.basis.nums[0], &self.basis.coords[0],
 			&self.wf.dimv[0], int(flip_spin))
 
 	def _projection_recip(self, np.ndarray[double complex, ndim=1] res, band_num, flip_spin):
+		self._projection_recip_block(res, [band_num], flip_spin)
+
+	def _projection_recip_block(self, np.ndarray res, bands, flip_spin):
 		
-		cdef double complex[::1] resv = res
+		cdef double complex[::1] resv = res.reshape(-1)
+		cdef int[::1] bandv = np.array(bands, dtype=np.int32)
 
 		# set up site lists
 		cdef int* M_R = NULL if self.num_M_R == 0 else &self.M_R[0]
@@ -709,7 +1099,8 @@ cdef class CProjector:
 		cdef int* N_RS_S = NULL if self.num_N_RS_S == 0 else &self.N_RS_S[0]
 
 		# call compensation terms C routine
-		ppc.compensation_terms_recip(&resv[0], band_num, self.wf.wf_ptr, self.basis.wf_ptr,
+		ppc.compensation_terms_recip_block(&resv[0], bandv.shape[0], &bandv[0],
+			self.wf.wf_ptr, self.basis.wf_ptr, self.ctx,
 			self.num_M_R, self.num_N_R, self.num_N_S, self.num_N_RS_R,
 			M_R, M_S, N_R, N_S, N_RS_R, N_RS_S,
 			&self.wf.nums[0], &self.wf.coords[0], &self.basis.nums[0], &self.basis.coords[0],
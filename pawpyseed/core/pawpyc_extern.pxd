@@ -20,6 +20,8 @@ cdef extern from "utils.h":
         double** smooth_diffwave_spline
         double* dense_kwave
         double** dense_kwave_spline
+        double* kproj
+        double** kproj_spline
     ctypedef struct  ppot_t:
         int num_projs
         int total_projs
@@ -38,6 +40,10 @@ cdef extern from "utils.h":
         double* proj_grid
         double* smooth_grid
         double* dense_kgrid
+        int kproj_gridsize
+        double kproj_max
+        double* kproj_grid
+        int shared_data
     ctypedef struct  projection_t:
         int num_projs
         int total_projs
@@ -69,26 +75,9 @@ cdef extern from "utils.h":
         double weight
         int num_bands
         band_t** bands
+        band_t* band_block
+        float complex* coeffs
         rayleigh_set_t** expansion
-    ctypedef struct  pswf_t:
-        double encut
-        int num_elems
-        int* num_projs
-        int num_sites
-        ppot_t* pps
-        int* G_bounds
-        kpoint_t** kpts
-        int nspin
-        int nband
-        int nwk
-        double* lattice
-        double* reclattice
-        int* fftg
-        int is_ncl
-        int wp_num
-        int num_aug_overlap_sites
-        double* dcoords
-        double complex** overlaps
     ctypedef struct  projgrid_t:
         double complex* values
     ctypedef struct  real_proj_t:
@@ -108,6 +97,57 @@ cdef extern from "utils.h":
         int* indices
         double* paths
         real_proj_t* projs
+    ctypedef struct  wave_proj_cache_t:
+        int elem
+        double coord[3]
+        int fftg[3]
+        int total_projs
+        int refs
+        int cached
+        long last_use
+        double complex* overlaps
+        wave_proj_cache_t* next
+    ctypedef struct  aug_freqs_cache_t:
+        int num_sites
+        int* sites
+        int refs
+        int cached
+        long last_use
+        int num_states
+        long size
+        float complex** CAs
+        aug_freqs_cache_t* next
+    ctypedef struct  pswf_t:
+        double encut
+        int num_elems
+        int* num_projs
+        int num_sites
+        ppot_t* pps
+        int* G_bounds
+        kpoint_t** kpts
+        int nspin
+        int nband
+        int band_start
+        int nwk
+        double* lattice
+        double* reclattice
+        int* fftg
+        int is_ncl
+        char* wc_map
+        long wc_map_size
+        projection_t* proj_block
+        double complex* overlap_block
+        int* nlm_block
+        char* proj_done
+        int proj_method
+        int* proj_labels
+        double* proj_coords
+        real_proj_site_t* proj_sites
+        int wp_num
+        wave_proj_cache_t* wp_cache
+        aug_freqs_cache_t* aug_cache
+        long wp_clock
+        long wp_hits
     cdef void affine_transform(double* out, double* op, double* inv)
     cdef void rotation_transform(double* out, double* op, double* inv)
     cdef int min(int a, int b)
@@ -124,7 +164,12 @@ cdef extern from "utils.h":
     cdef double complex trilinear_interpolate(double complex* c, double* frac, int* fftg)
     cdef void free_projection_list(projection_t* projlist, int num)
     cdef void clean_wave_projections(pswf_t* wf)
+    cdef void free_aug_freqs_entry(aug_freqs_cache_t* entry)
+    cdef void free_overlap_caches(pswf_t* wf)
     cdef void free_kpoint(kpoint_t* kpt, int num_elems, int num_sites, int wp_num, int* num_projs)
+    cdef void alloc_kpoint_bands(kpoint_t* kpt, int num_bands, int alloc_coeffs)
+    cdef void alloc_projection_block(pswf_t* wf, int* num_projs, int* total_projs,
+        int* ns, int* ls, int* ms)
     cdef void free_ppot(ppot_t* pp)
     cdef void free_real_proj(real_proj_t* proj)
     cdef void free_real_proj_site(real_proj_site_t* site)
@@ -134,6 +179,7 @@ cdef extern from "utils.h":
     cdef void free_ppot_list(ppot_t* pps, int length)
     cdef double* get_occs(pswf_t* wf)
     cdef int get_nband(pswf_t* wf)
+    cdef int get_band_start(pswf_t* wf)
     cdef int get_nwk(pswf_t* wf)
     cdef int get_nspin(pswf_t* wf)
     cdef int is_ncl(pswf_t* wf)
@@ -163,9 +209,11 @@ cdef extern from "utils.h":
         int l, int m, double* pos)
     cdef void setup_site(real_proj_site_t* sites, ppot_t* pps, int num_sites, int* site_nums,
         int* labels, double* coords, double* lattice, int* fftg, int pr0_pw1)
+    cdef void free_site_templates(funcset_t* funcs)
     cdef double** spline_coeff(double* x, double* y, int N)
     cdef double spline_integral(double* x, double* a, double** s, int size)
     cdef void frac_from_index(int index, double* coord, int* fftg)
+    cdef void direction(double* cart, double* dir)
     cdef double sph_bessel(double k, double r, int l)
     cdef double sbf(double x, int l)
     cdef pswf_t* expand_symm_wf(pswf_t* rwf, int num_kpts, int* maps,
@@ -175,17 +223,53 @@ cdef extern from "utils.h":
     cdef void CHECK_STATUS(int status)
     
 
+cdef extern from "gsphere.h":
+
+    ctypedef struct  gsphere_t:
+        double reclattice[9]
+        double encut
+        double k[3]
+        int num_components
+        int num_waves
+        int G_bounds[6]
+        int refcount
+        int* Gs
+    cdef int gsphere_order(int lo, int hi, int* order)
+    cdef int* make_gsphere(double* reclattice, double encut, double* k,
+        int num_components, int* num_waves, int* G_bounds)
+    cdef int* get_gsphere(double* reclattice, double encut, double* k,
+        int num_components, int* num_waves, int* G_bounds)
+    cdef void release_gsphere(int* Gs)
+    cdef void clear_gsphere_cache()
+    
+
 cdef extern from "projector.h":
 
+    ctypedef struct  overlap_context_t:
+        int num_N_R
+        int num_N_S
+        int num_N_RS
+        wave_proj_cache_t** wp_R
+        wave_proj_cache_t** wp_S
+        aug_freqs_cache_t* CAs_R
+        aug_freqs_cache_t* CAs_S
+        double* dcoords
+        double complex** overlaps
     cdef ppot_t* get_projector_list(int num_els, int* labels, int* ls, double* wave_grids,
         double* projectors, double* aewaves, double* pswaves, double* rmaxs, double grid_encut)
+    cdef ppot_t* share_projector_list(ppot_t** pp_ptrs, int num_els)
     cdef real_proj_site_t* projector_values(int num_sites, int* labels, double* coords,
         double* lattice, double* reclattice, ppot_t* pps, int* fftg)
     cdef real_proj_site_t* smooth_pw_values(int num_N, int* Nlst, int* labels, double* coords,
         double* lattice, double* reclattice, ppot_t* pps, int* fftg)
+    cdef projection_t* new_projection_list(real_proj_site_t* sites, int num_sites)
+    cdef void alloc_site_projection_block(pswf_t* wf, ppot_t* pps, int num_sites, int* labels)
     cdef void onto_projector_helper(band_t* band, double complex* x, real_proj_site_t* sites,
         int num_sites, double* lattice, double* reclattice, double* kpt, int num_cart_gridpts,
         int* fftg, projection_t* projections)
+    cdef void onto_projector_helper_block(double complex* x, int num_bands,
+        projection_t** projections, real_proj_site_t* sites, int num_sites,
+        double* lattice, double* reclattice, double* kpt, int num_cart_gridpts, int* fftg)
     cdef void get_aug_freqs_helper(band_t* band, double complex* x, real_proj_site_t* sites,
         int num_sites, double* lattice, double* reclattice, double* kpt, int num_cart_gridpts,
         int* fftg, projection_t* projections)
@@ -197,26 +281,62 @@ cdef extern from "projector.h":
         int* G_bounds, double* lattice, double* reclattice, int num_cart_gridpts, int* fftg)
     cdef void get_aug_freqs(kpoint_t* kpt, int band_num, real_proj_site_t* sites, int num_sites,
         int* G_bounds, double* lattice, double* reclattice, int num_cart_gridpts, int* fftg)
+    cdef int band_block_size(int num_bands, int num_kpts, int* fftg)
+    cdef void onto_projector_block(kpoint_t* kpt, int band_start, int num_bands,
+        real_proj_site_t* sites, int num_sites, int* G_bounds, double* lattice,
+        double* reclattice, int num_cart_gridpts, int* fftg)
+    cdef void onto_projector_ncl_block(kpoint_t* kpt, int band_start, int num_bands,
+        real_proj_site_t* sites, int num_sites, int* G_bounds, double* lattice,
+        double* reclattice, int num_cart_gridpts, int* fftg)
+    cdef void onto_smoothpw_block(kpoint_t* kpt, int band_start, int num_bands,
+        real_proj_site_t* sites, int num_sites, int* G_bounds, double* lattice,
+        double* reclattice, int num_cart_gridpts, int* fftg)
+    cdef void get_aug_freqs_block(kpoint_t* kpt, int band_start, int num_bands,
+        real_proj_site_t* sites, int num_sites, int* G_bounds, double* lattice,
+        double* reclattice, int num_cart_gridpts, int* fftg)
     cdef void add_num_cart_gridpts(ppot_t* pp_ptr, double* lattice, int* fftg)
     cdef void make_pwave_overlap_matrices(ppot_t* pp_ptr)
+    cdef int set_projector_list(pswf_t* wf, ppot_t* pps, int num_elems,
+        int num_sites, int* fftg)
+    cdef void init_projections(pswf_t* wf, ppot_t* pps, int num_elems,
+        int num_sites, int* fftg, int* labels, double* coords, int recip)
+    cdef void evaluate_projections(pswf_t* wf, int kpt_num, int band_start, int num_bands)
+    cdef void set_projector_memory_budget(long num_bytes)
+    cdef long get_projector_memory_budget()
+    cdef void evaluate_all_projections(pswf_t* wf)
     cdef void setup_projections(pswf_t* wf, ppot_t* pps, int num_elems,
         int num_sites, int* fftg, int* labels, double* coords)
-    cdef void overlap_setup_real(pswf_t* wf_R, pswf_t* wf_S,
+    cdef void setup_projections_recip(pswf_t* wf, ppot_t* pps, int num_elems,
+        int num_sites, int* fftg, int* labels, double* coords)
+    cdef overlap_context_t* overlap_setup_real(pswf_t* wf_R, pswf_t* wf_S,
         int* labels_R, int* labels_S, double* coords_R, double* coords_S,
         int* N_R, int* N_S, int* N_RS_R, int* N_RS_S, int num_N_R, int num_N_S, int num_N_RS)
-    cdef void overlap_setup_recip(pswf_t* wf_R, pswf_t* wf_S,
+    cdef overlap_context_t* overlap_setup_recip(pswf_t* wf_R, pswf_t* wf_S,
         int* labels_R, int* labels_S, double* coords_R, double* coords_S,
         int* N_R, int* N_S, int* N_RS_R, int* N_RS_S, int num_N_R, int num_N_S, int num_N_RS)
+    cdef void free_overlap_context(overlap_context_t* ctx)
     cdef void compensation_terms(double complex* overlap, int BAND_NUM, pswf_t* wf_S, pswf_t* wf_R,
-        int num_M, int num_N_R, int num_N_S, int num_N_RS,
+        overlap_context_t* ctx, int num_M, int num_N_R, int num_N_S, int num_N_RS,
         int* M_R, int* M_S, int* N_R, int* N_S, int* N_RS_R, int* N_RS_S,
         int* proj_labels, double* proj_coords, int* ref_labels, double* ref_coords,
         int* fft_grid, int spin_flip)
     cdef void compensation_terms_recip(double complex* overlap, int BAND_NUM, pswf_t* wf_S, pswf_t* wf_R,
-        int num_M, int num_N_R, int num_N_S, int num_N_RS,
+        overlap_context_t* ctx, int num_M, int num_N_R, int num_N_S, int num_N_RS,
         int* M_R, int* M_S, int* N_R, int* N_S, int* N_RS_R, int* N_RS_S,
         int* proj_labels, double* proj_coords, int* ref_labels, double* ref_coords,
         int* fft_grid, int spin_flip)
+    cdef void compensation_terms_block(double complex* overlap, int num_bands, int* bands,
+        pswf_t* wf_S, pswf_t* wf_R, overlap_context_t* ctx,
+        int num_M, int num_N_R, int num_N_S, int num_N_RS,
+        int* M_R, int* M_S, int* N_R, int* N_S, int* N_RS_R, int* N_RS_S,
+        int* proj_labels, double* proj_coords, int* ref_labels, double* ref_coords,
+        int* fft_grid, int flip_spin)
+    cdef void compensation_terms_recip_block(double complex* overlap, int num_bands, int* bands,
+        pswf_t* wf_S, pswf_t* wf_R, overlap_context_t* ctx,
+        int num_M, int num_N_R, int num_N_S, int num_N_RS,
+        int* M_R, int* M_S, int* N_R, int* N_S, int* N_RS_R, int* N_RS_S,
+        int* proj_labels, double* proj_coords, int* ref_labels, double* ref_coords,
+        int* fft_grid, int flip_spin)
     cdef double* besselt(double* r, double* k, double* f, double encut, int N, int l)
     
 
@@ -225,6 +345,8 @@ cdef extern from "pseudoprojector.h":
     cdef void vc_pseudoprojection(pswf_t* wf_ref, pswf_t* wf_proj, int BAND_NUM, double* results)
     cdef void pseudoprojection(double complex* projections, pswf_t* wf_ref, pswf_t* wf_proj, int BAND_NUM,
                             int flip_spin)
+    cdef void pseudoprojection_matrix(double complex* projections, pswf_t* wf_ref, pswf_t* wf_proj,
+        int num_bands, int* bands, int flip_spin)
     
 
 cdef extern from "reader.h":
@@ -234,17 +356,45 @@ cdef extern from "reader.h":
         FILE* fp
         char* start
         char* curr
+        long size
+        void* zfp
+        long pos
+        int error
+    ctypedef struct  wavecar_header_t:
+        int nrecl
+        int nspin
+        int nprec
+        int nwk
+        int nband
+        double encut
+        double lattice[9]
+        double* kpts
+        int* num_waves
+        double* energies
+        double* occs
     cdef WAVECAR* wcopen(char* f, int type)
+    cdef long wcdecompress(void* ptr0, long nbytes, WAVECAR* wc)
     cdef void wcseek(WAVECAR* wc, long loc)
     cdef void wcread(void* ptr0, long size, long nmemb, WAVECAR* wc)
+    cdef void wcpread(void* ptr0, long size, long nmemb, long loc, WAVECAR* wc)
     cdef void wcclose(WAVECAR* wc)
     cdef void setup(int nspin, int nwk, int nband,
         double* nb1, double* nb2, double* nb3, int* np, double ecut,
         double* lattice, double* reclattice)
+    cdef int wavecar_band_range(WAVECAR* wc, long nrecl, int nkpts, int nband,
+        double emin, double emax, int* band_min, int* band_max)
     cdef pswf_t* read_wavecar(WAVECAR* wc, double* kpt_weights)
+    cdef pswf_t* read_wavecar_bands(WAVECAR* wc, double* kpt_weights,
+        int band_min, int band_max, double emin, double emax)
     cdef pswf_t* read_wavefunctions(char* filename, double* kpt_weights)
+    cdef pswf_t* read_wavefunctions_mmap(char* filename, double* kpt_weights)
+    cdef pswf_t* read_wavefunctions_compressed(char* filename, double* kpt_weights)
+    cdef int wavecar_file_type(char* filename, int lazy)
+    cdef pswf_t* read_wavefunctions_bands(char* filename, double* kpt_weights, int lazy,
+        int band_min, int band_max, double emin, double emax)
+    cdef wavecar_header_t* read_wavecar_header(char* filename)
+    cdef void free_wavecar_header(wavecar_header_t* header)
     cdef pswf_t* read_wavefunctions_from_str(char* start, double* kpt_weights)
-    cdef kpoint_t** read_one_band(int* G_bounds, double* kpt_weights, int* ns, int* nk, int* nb, int BAND_NUM, char* filename)
     
 
 cdef extern from "density.h":
@@ -303,6 +453,13 @@ cdef extern from "linalg.h":
         double* kpt, int* Gs, float complex* Cs, int num_waves, int* fftg)
     cdef void fwd_fft3d(double complex* x, int* G_bounds, double* lattice,
         double* kpt, int* Gs, float complex* Cs, int num_waves, int* fftg)
+    cdef void fft3d_batch(double complex* x, double* lattice, int* Gs,
+        float complex** Cs, int num_waves, int num_transforms, int* fftg)
+    cdef void fwd_fft3d_batch(double complex* x, double* lattice, int* Gs,
+        float complex** Cs, int num_waves, int num_transforms, int* fftg)
+    cdef int fft_batch_size(int* fftg, int max_transforms)
+    cdef double complex* fft_workspace(int num, int* fftg, int count)
+    cdef void free_fft_workspaces()
     
 
 cdef extern from "radial.h":
@@ -314,6 +471,9 @@ cdef extern from "radial.h":
         double* k1, double* f1, double** s1, int size1,
         double* k2, double* f2, double** s2, int size2,
         double* lattice, int l1, int m1, int l2, int m2)
+    cdef void reciprocal_offsite_overlap_matrix(double complex* overlaps, double* dcoord,
+        ppot_t* pp1, ppot_t* pp2)
+    cdef void free_offsite_tables(funcset_t* funcs)
     
 
 cdef extern from "momentum.h":
@@ -369,4 +529,22 @@ cdef extern from "momentum.h":
         int l, int m, double* pos)
     cdef double complex quick_overlap(int* dG, double complex* C1s, double complex* C2s, int numg,
         int* Gs, int* gmap, int* G_bounds, int* gdim)
+    
+
+cdef extern from "snapshot.h":
+
+    ctypedef struct  snapshot_header_t:
+        long nspin
+        long nwk
+        long nband
+        long band_start
+        long is_ncl
+        long num_sites
+        long has_projections
+        double encut
+        double lattice[9]
+        double reclattice[9]
+        long G_bounds[6]
+    cdef long write_pswf_snapshot(pswf_t* wf, char* filename, long offset)
+    cdef pswf_t* read_pswf_snapshot(char* filename, long offset)
     
\ No newline at end of file
@@ -1,5 +1,6 @@
 #include <stdio.h>
 #include <stdlib.h>
+#include <string.h>
 #include <complex.h>
 #include <math.h>
 #include <omp.h>
@@ -16,6 +17,66 @@
 #define c 0.262465831
 #define PI 3.14159265358979323846
 #define DENSE_GRID_SCALE 1
+#define KPROJ_GRIDSIZE 1000
+#define KPROJ_QUAD_SCALE 8
+#define RECIP_BLOCK_BYTES (64L << 20)
+#define DEFAULT_PROJECTOR_MEMORY (2L << 30)
+#define COMPENSATION_BLOCK_BYTES (16L << 20)
+#define WAVE_PROJ_COORD_TOL 1e-8
+
+static long projector_memory_budget = DEFAULT_PROJECTOR_MEMORY;
+
+/*
+Tabulates the spherical Bessel transforms
+kproj(q) = int_0^rmax proj(r) j_l(qr) r^2 dr
+of the projector functions of pp on a linear grid from 0 to
+twice the radius of the FFT grid sphere, using Simpson's rule
+on a grid KPROJ_QUAD_SCALE times finer than proj_grid.
+*/
+static void make_recip_projectors(ppot_t* pp, double grid_encut) {
+	int size = pp->proj_gridsize;
+	int num_quad = (size - 1) * KPROJ_QUAD_SCALE + 1;
+	double h = pp->proj_grid[size-1] / (num_quad - 1);
+	double* rs = (double*) malloc(num_quad * sizeof(double));
+	double* weights = (double*) malloc(num_quad * sizeof(double));
+	double* vals = (double*) malloc(num_quad * sizeof(double));
+	CHECK_ALLOCATION(rs);
+	CHECK_ALLOCATION(weights);
+	CHECK_ALLOCATION(vals);
+	for (int i = 0; i < num_quad; i++) {
+		rs[i] = h * i;
+		weights[i] = h / 3 * ((i == 0 || i == num_quad-1) ? 1 : (i % 2 ? 4 : 2));
+	}
+
+	pp->kproj_gridsize = KPROJ_GRIDSIZE;
+	pp->kproj_max = 2 * pow(c*grid_encut, 0.5);
+	pp->kproj_grid = (double*) malloc(KPROJ_GRIDSIZE * sizeof(double));
+	CHECK_ALLOCATION(pp->kproj_grid);
+	for (int j = 0; j < KPROJ_GRIDSIZE; j++) {
+		pp->kproj_grid[j] = pp->kproj_max / KPROJ_GRIDSIZE * j;
+	}
+	for (int k = 0; k < pp->num_projs; k++) {
+		funcset_t* funcs = pp->funcs + k;
+		for (int i = 0; i < num_quad; i++) {
+			vals[i] = weights[i] * rs[i] * rs[i] * proj_interpolate(rs[i], pp->rmax,
+				size, pp->proj_grid, funcs->proj, funcs->proj_spline);
+		}
+		funcs->kproj = (double*) malloc(KPROJ_GRIDSIZE * sizeof(double));
+		CHECK_ALLOCATION(funcs->kproj);
+		#pragma omp parallel for
+		for (int j = 0; j < KPROJ_GRIDSIZE; j++) {
+			double total = 0;
+			for (int i = 0; i < num_quad; i++) {
+				total += vals[i] * sbf(pp->kproj_grid[j] * rs[i], funcs->l);
+			}
+			funcs->kproj[j] = total;
+		}
+		funcs->kproj_spline = spline_coeff(pp->kproj_grid, funcs->kproj, KPROJ_GRIDSIZE);
+	}
+	free(rs);
+	free(weights);
+	free(vals);
+}
 
 ppot_t* get_projector_list(int num_els, int* labels, int* ls, double* wave_grids,
 	double* projectors, double* aewaves, double* pswaves, double* rmaxs, double grid_encut) {
@@ -34,6 +95,7 @@ ppot_t* get_projector_list(int num_els, int* labels, int* ls, double* wave_grids
 		pps[i].proj_gridsize = labels[4*i+2];
 		pps[i].wave_gridsize = labels[4*i+3];
 		pps[i].total_projs = 0;
+		pps[i].shared_data = 0;
 		pps[i].wave_grid = (double*) malloc((pps[i].wave_gridsize)*sizeof(double));
 		pps[i].kwave_grid = (double*) malloc((pps[i].wave_gridsize)*sizeof(double));
 		CHECK_ALLOCATION(pps[i].wave_grid);
@@ -138,12 +200,23 @@ ppot_t* get_projector_list(int num_els, int* labels, int* ls, double* wave_grids
 		free_sbt_descriptor(d);
 		pps[i].funcs = funcs;
 		make_pwave_overlap_matrices(pps+i);
+		make_recip_projectors(pps+i, grid_encut);
 	}
 	mkl_free_buffers();
 	printf("finished making projector list\n");
 	return pps;
 }
 
+ppot_t* share_projector_list(ppot_t** pp_ptrs, int num_els) {
+	ppot_t* pps = (ppot_t*) malloc(num_els * sizeof(ppot_t));
+	CHECK_ALLOCATION(pps);
+	for (int i = 0; i < num_els; i++) {
+		pps[i] = *(pp_ptrs[i]);
+		pps[i].shared_data = 1;
+	}
+	return pps;
+}
+
 double* besselt(double* r, double* k, double* f, double encut, int N, int l) {
 	
 	double kmax = pow(encut*c, 0.5);
@@ -189,28 +262,10 @@ real_proj_site_t* smooth_pw_values(int num_N, int* Nlst, int* labels, double* co
 	return sites;
 }
 
-void onto_projector_helper(band_t* band, double complex* x, real_proj_site_t* sites,
-	int num_sites, double* lattice, double* reclattice, double* kpt, int num_cart_gridpts,
-	int* fftg, projection_t* projections) {
-
-	double dv = determinant(lattice) / fftg[0] / fftg[1] / fftg[2];
-
-	double kdotr = 0;
-
-	double kpt_cart[3] = {0,0,0};
-	kpt_cart[0] = kpt[0];
-	kpt_cart[1] = kpt[1];
-	kpt_cart[2] = kpt[2];
-	frac_to_cartesian(kpt_cart, reclattice);
-	double complex overlap;
-	double complex* values;
-	double complex* xvals = (double complex*) malloc(num_cart_gridpts * sizeof(double complex));
-	int* indices;
-
-	int num_indices, index;
+projection_t* new_projection_list(real_proj_site_t* sites, int num_sites) {
+	projection_t* projections = (projection_t*) malloc(num_sites * sizeof(projection_t));
+	CHECK_ALLOCATION(projections);
 	for (int s = 0; s < num_sites; s++) {
-		num_indices = sites[s].num_indices;
-		indices = sites[s].indices;
 		projections[s].num_projs = sites[s].num_projs;
 		projections[s].total_projs = sites[s].total_projs;
 		projections[s].ns = malloc(sites[s].total_projs * sizeof(int));
@@ -221,21 +276,119 @@ void onto_projector_helper(band_t* band, double complex* x, real_proj_site_t* si
 		CHECK_ALLOCATION(projections[s].ls);
 		CHECK_ALLOCATION(projections[s].ms);
 		CHECK_ALLOCATION(projections[s].overlaps);
-		for (int i = 0; i < num_indices; i++) {
-			index = indices[i];
-			kdotr = dot(kpt_cart, sites[s].paths+i*3);
-			xvals[i] = x[index] * dv * cexp(I * kdotr);
-		}
 		for (int p = 0; p < sites[s].total_projs; p++) {
 			projections[s].ns[p] = sites[s].projs[p].func_num;
 			projections[s].ls[p] = sites[s].projs[p].l;
 			projections[s].ms[p] = sites[s].projs[p].m;
-			values = sites[s].projs[p].values;
-			cblas_zdotc_sub(num_indices, values, 1, xvals, 1, &overlap);
-			projections[s].overlaps[p] = overlap;
 		}
 	}
+	return projections;
+}
+
+void alloc_site_projection_block(pswf_t* wf, ppot_t* pps, int num_sites, int* labels) {
+	int* num_projs = (int*) malloc(num_sites * sizeof(int));
+	int* total_projs = (int*) malloc(num_sites * sizeof(int));
+	CHECK_ALLOCATION(num_projs);
+	CHECK_ALLOCATION(total_projs);
+	int nlm_size = 0;
+	for (int s = 0; s < num_sites; s++) {
+		num_projs[s] = pps[labels[s]].num_projs;
+		total_projs[s] = pps[labels[s]].total_projs;
+		nlm_size += total_projs[s];
+	}
+	int* nlms = (int*) malloc(3 * nlm_size * sizeof(int));
+	CHECK_ALLOCATION(nlms);
+	int offset = 0;
+	for (int s = 0; s < num_sites; s++) {
+		ppot_t* pp = pps + labels[s];
+		for (int j = 0; j < pp->num_projs; j++) {
+			for (int m = -pp->funcs[j].l; m <= pp->funcs[j].l; m++) {
+				nlms[offset] = j;
+				nlms[nlm_size + offset] = pp->funcs[j].l;
+				nlms[2 * nlm_size + offset] = m;
+				offset++;
+			}
+		}
+	}
+	alloc_projection_block(wf, num_projs, total_projs,
+		nlms, nlms + nlm_size, nlms + 2 * nlm_size);
+	free(num_projs);
+	free(total_projs);
+	free(nlms);
+}
+
+void onto_projector_helper_block(double complex* x, int num_bands,
+	projection_t** projections, real_proj_site_t* sites, int num_sites,
+	double* lattice, double* reclattice, double* kpt, int num_cart_gridpts, int* fftg) {
+
+	long gridsize = (long) fftg[0] * fftg[1] * fftg[2];
+	double dv = determinant(lattice) / fftg[0] / fftg[1] / fftg[2];
+
+	double kpt_cart[3] = {0,0,0};
+	kpt_cart[0] = kpt[0];
+	kpt_cart[1] = kpt[1];
+	kpt_cart[2] = kpt[2];
+	frac_to_cartesian(kpt_cart, reclattice);
+	int max_projs = 0;
+	for (int s = 0; s < num_sites; s++) {
+		max_projs = max(max_projs, sites[s].total_projs);
+	}
+	double complex* phases = (double complex*) malloc(num_cart_gridpts * sizeof(double complex));
+	double complex* xvals = (double complex*) malloc(
+		(long) num_bands * num_cart_gridpts * sizeof(double complex));
+	double complex* overlaps = (double complex*) malloc(
+		max(num_bands * max_projs, 1) * sizeof(double complex));
+	CHECK_ALLOCATION(phases);
+	CHECK_ALLOCATION(xvals);
+	CHECK_ALLOCATION(overlaps);
+	double complex one = 1;
+	double complex zero = 0;
+
+	for (int s = 0; s < num_sites; s++) {
+		int num_indices = sites[s].num_indices;
+		int total_projs = sites[s].total_projs;
+		int* indices = sites[s].indices;
+		if (num_indices == 0 || total_projs == 0) {
+			for (int b = 0; b < num_bands; b++) {
+				for (int p = 0; p < total_projs; p++) {
+					projections[b][s].overlaps[p] = 0;
+				}
+			}
+			continue;
+		}
+		for (int i = 0; i < num_indices; i++) {
+			phases[i] = dv * cexp(I * dot(kpt_cart, sites[s].paths+i*3));
+		}
+		// gather the grid points in the sphere into a
+		// [num_bands][num_indices] matrix, with the phases applied
+		for (int b = 0; b < num_bands; b++) {
+			double complex* xb = x + b * gridsize;
+			double complex* row = xvals + (long) b * num_indices;
+			for (int i = 0; i < num_indices; i++) {
+				row[i] = xb[indices[i]] * phases[i];
+			}
+		}
+		// overlaps[b][p] = sum_i conj(values[p][i]) xvals[b][i], where the
+		// values of the projectors form a [total_projs][num_indices] block
+		cblas_zgemm(CblasRowMajor, CblasNoTrans, CblasConjTrans,
+			num_bands, total_projs, num_indices, &one, xvals, num_indices,
+			sites[s].projs[0].values, num_indices, &zero, overlaps, total_projs);
+		for (int b = 0; b < num_bands; b++) {
+			memcpy(projections[b][s].overlaps, overlaps + b * total_projs,
+				total_projs * sizeof(double complex));
+		}
+	}
+	free(phases);
 	free(xvals);
+	free(overlaps);
+}
+
+void onto_projector_helper(band_t* band, double complex* x, real_proj_site_t* sites,
+	int num_sites, double* lattice, double* reclattice, double* kpt, int num_cart_gridpts,
+	int* fftg, projection_t* projections) {
+
+	onto_projector_helper_block(x, 1, &projections, sites, num_sites,
+		lattice, reclattice, kpt, num_cart_gridpts, fftg);
 }
 
 void get_aug_freqs_helper(band_t* band, double complex* x, real_proj_site_t* sites,
@@ -293,112 +446,159 @@ void get_aug_freqs_helper(band_t* band, double complex* x, real_proj_site_t* sit
 	}
 }
 
-void onto_projector(kpoint_t* kpt, int band_num, real_proj_site_t* sites, int num_sites,
-	int* G_bounds, double* lattice, double* reclattice, int num_cart_gridpts, int* fftg) {
-
-	double* k = kpt->k;
-	int* Gs = kpt->Gs;
-	float complex* Cs = kpt->bands[band_num]->Cs;
-	int num_waves = kpt->num_waves;
-	
-	double complex* x = (double complex*) mkl_calloc(fftg[0]*fftg[1]*fftg[2],
-		sizeof(double complex), 64);
-	CHECK_ALLOCATION(x);
-	fft3d(x, G_bounds, lattice, k, Gs, Cs, num_waves, fftg);
-
-	band_t* band = kpt->bands[band_num];
-	band->projections = (projection_t*) malloc(num_sites * sizeof(projection_t));
-	CHECK_ALLOCATION (band->projections);
+int band_block_size(int num_bands, int num_kpts, int* fftg) {
+	int block = fft_batch_size(fftg, num_bands);
+	int min_tasks = 4 * omp_get_max_threads();
+	while (block > 1 && num_kpts * ((num_bands + block - 1) / block) < min_tasks) {
+		block /= 2;
+	}
+	return block;
+}
 
-	onto_projector_helper(kpt->bands[band_num], x, sites, num_sites,
-		lattice, reclattice, k, num_cart_gridpts, fftg, band->projections);
+/*
+FFTs the num_bands sets of coefficients Cs (num_waves each, with the
+plane waves of kpt) in one batch, and stores the projections of each
+onto the functions of sites in projections[b].
+*/
+static void onto_projector_bands(kpoint_t* kpt, int num_bands, float complex** Cs,
+	int num_waves, projection_t** projections, real_proj_site_t* sites, int num_sites,
+	double* lattice, double* reclattice, int num_cart_gridpts, int* fftg) {
+
+	double complex* x = fft_workspace(0, fftg, num_bands);
+	fft3d_batch(x, lattice, kpt->Gs, Cs, num_waves, num_bands, fftg);
+	onto_projector_helper_block(x, num_bands, projections, sites, num_sites,
+		lattice, reclattice, kpt->k, num_cart_gridpts, fftg);
+}
 
-	//kpt->bands[band_num]->CRs = x;
-	mkl_free(x);
+void onto_projector_block(kpoint_t* kpt, int band_start, int num_bands,
+	real_proj_site_t* sites, int num_sites, int* G_bounds, double* lattice,
+	double* reclattice, int num_cart_gridpts, int* fftg) {
+
+	float complex** Cs = (float complex**) malloc(num_bands * sizeof(float complex*));
+	projection_t** projections = (projection_t**) malloc(num_bands * sizeof(projection_t*));
+	CHECK_ALLOCATION(Cs);
+	CHECK_ALLOCATION(projections);
+	for (int b = 0; b < num_bands; b++) {
+		band_t* band = kpt->bands[band_start + b];
+		if (band->projections == NULL) {
+			band->projections = new_projection_list(sites, num_sites);
+		}
+		Cs[b] = band->Cs;
+		projections[b] = band->projections;
+	}
+	onto_projector_bands(kpt, num_bands, Cs, kpt->num_waves, projections,
+		sites, num_sites, lattice, reclattice, num_cart_gridpts, fftg);
+	free(Cs);
+	free(projections);
 }
 
-void onto_projector_ncl(kpoint_t* kpt, int band_num, real_proj_site_t* sites, int num_sites,
-	int* G_bounds, double* lattice, double* reclattice, int num_cart_gridpts, int* fftg) {
+void onto_projector_ncl_block(kpoint_t* kpt, int band_start, int num_bands,
+	real_proj_site_t* sites, int num_sites, int* G_bounds, double* lattice,
+	double* reclattice, int num_cart_gridpts, int* fftg) {
 
-	double* k = kpt->k;
-	int* Gs = kpt->Gs;
-	float complex* Cs = kpt->bands[band_num]->Cs;
 	int num_waves = kpt->num_waves;
+	float complex** Cs = (float complex**) malloc(num_bands * sizeof(float complex*));
+	projection_t** projections = (projection_t**) malloc(num_bands * sizeof(projection_t*));
+	CHECK_ALLOCATION(Cs);
+	CHECK_ALLOCATION(projections);
+	for (int b = 0; b < num_bands; b++) {
+		band_t* band = kpt->bands[band_start + b];
+		if (band->up_projections == NULL) {
+			band->up_projections = new_projection_list(sites, num_sites);
+		}
+		if (band->down_projections == NULL) {
+			band->down_projections = new_projection_list(sites, num_sites);
+		}
+		Cs[b] = band->Cs;
+		projections[b] = band->up_projections;
+	}
+	onto_projector_bands(kpt, num_bands, Cs, num_waves/2, projections,
+		sites, num_sites, lattice, reclattice, num_cart_gridpts, fftg);
+	for (int b = 0; b < num_bands; b++) {
+		band_t* band = kpt->bands[band_start + b];
+		Cs[b] = band->Cs + num_waves/2;
+		projections[b] = band->down_projections;
+	}
+	onto_projector_bands(kpt, num_bands, Cs, num_waves/2, projections,
+		sites, num_sites, lattice, reclattice, num_cart_gridpts, fftg);
+	free(Cs);
+	free(projections);
+}
 
-	double complex* xup = (double complex*) mkl_calloc(fftg[0]*fftg[1]*fftg[2],
-		sizeof(double complex), 64);
-	double complex* xdown = (double complex*) mkl_calloc(fftg[0]*fftg[1]*fftg[2],
-		sizeof(double complex), 64);
-	CHECK_ALLOCATION(xup);
-	CHECK_ALLOCATION(xdown);
-	fft3d(xup, G_bounds, lattice, k, Gs, Cs, num_waves/2, fftg);
-	fft3d(xdown, G_bounds, lattice, k, Gs, Cs+num_waves/2, num_waves/2, fftg);
-
-	band_t* band = kpt->bands[band_num];
-	band->up_projections =
-		(projection_t*) malloc(num_sites * sizeof(projection_t));
-	band->down_projections =
-		(projection_t*) malloc(num_sites * sizeof(projection_t));
-	onto_projector_helper(kpt->bands[band_num], xup, sites, num_sites,
-		lattice, reclattice, k, num_cart_gridpts, fftg, band->up_projections);
-	onto_projector_helper(kpt->bands[band_num], xdown, sites, num_sites,
-		lattice, reclattice, k, num_cart_gridpts, fftg, band->down_projections);
+void onto_smoothpw_block(kpoint_t* kpt, int band_start, int num_bands,
+	real_proj_site_t* sites, int num_sites, int* G_bounds, double* lattice,
+	double* reclattice, int num_cart_gridpts, int* fftg) {
+
+	float complex** Cs = (float complex**) malloc(num_bands * sizeof(float complex*));
+	projection_t** projections = (projection_t**) malloc(num_bands * sizeof(projection_t*));
+	CHECK_ALLOCATION(Cs);
+	CHECK_ALLOCATION(projections);
+	for (int b = 0; b < num_bands; b++) {
+		band_t* band = kpt->bands[band_start + b];
+		band->wave_projections = new_projection_list(sites, num_sites);
+		Cs[b] = band->Cs;
+		projections[b] = band->wave_projections;
+	}
+	onto_projector_bands(kpt, num_bands, Cs, kpt->num_waves, projections,
+		sites, num_sites, lattice, reclattice, num_cart_gridpts, fftg);
+	free(Cs);
+	free(projections);
 }
 
-void onto_smoothpw(kpoint_t* kpt, int band_num, real_proj_site_t* sites, int num_sites,
+void get_aug_freqs_block(kpoint_t* kpt, int band_start, int num_bands,
+	real_proj_site_t* sites, int num_sites, int* G_bounds, double* lattice,
+	double* reclattice, int num_cart_gridpts, int* fftg) {
+
+	long gridsize = (long) fftg[0] * fftg[1] * fftg[2];
+	float complex** CAs = (float complex**) malloc(num_bands * sizeof(float complex*));
+	CHECK_ALLOCATION(CAs);
+	double complex* x = fft_workspace(0, fftg, num_bands);
+	int num_new = 0;
+	for (int b = 0; b < num_bands; b++) {
+		band_t* band = kpt->bands[band_start + b];
+		if (band->CAs != NULL) {
+			continue;
+		}
+		get_aug_freqs_helper(band, x + num_new * gridsize, sites, num_sites,
+			lattice, reclattice, kpt->k, num_cart_gridpts, fftg, band->projections);
+		band->CAs = (float complex*) mkl_calloc(kpt->num_waves, sizeof(float complex), 64);
+		CAs[num_new] = band->CAs;
+		num_new++;
+	}
+	if (num_new > 0) {
+		fwd_fft3d_batch(x, lattice, kpt->Gs, CAs, kpt->num_waves, num_new, fftg);
+	}
+	free(CAs);
+}
+
+void onto_projector(kpoint_t* kpt, int band_num, real_proj_site_t* sites, int num_sites,
 	int* G_bounds, double* lattice, double* reclattice, int num_cart_gridpts, int* fftg) {
 
-	double* k = kpt->k;
-	int* Gs = kpt->Gs;
-	float complex* Cs = kpt->bands[band_num]->Cs;
-	int num_waves = kpt->num_waves;
+	onto_projector_block(kpt, band_num, 1, sites, num_sites,
+		G_bounds, lattice, reclattice, num_cart_gridpts, fftg);
+}
 
-	double complex* x = (double complex*) mkl_calloc(fftg[0]*fftg[1]*fftg[2], sizeof(double complex), 64);
-	CHECK_ALLOCATION(x);
-	fft3d(x, G_bounds, lattice, k, Gs, Cs, num_waves, fftg);
+void onto_projector_ncl(kpoint_t* kpt, int band_num, real_proj_site_t* sites, int num_sites,
+	int* G_bounds, double* lattice, double* reclattice, int num_cart_gridpts, int* fftg) {
 
-	band_t* band = kpt->bands[band_num];
-	band->wave_projections = (projection_t*) malloc(num_sites * sizeof(projection_t));
-	CHECK_ALLOCATION (band->wave_projections);
+	onto_projector_ncl_block(kpt, band_num, 1, sites, num_sites,
+		G_bounds, lattice, reclattice, num_cart_gridpts, fftg);
+}
 
-	onto_projector_helper(kpt->bands[band_num], x, sites, num_sites,
-		lattice, reclattice, k, num_cart_gridpts, fftg, band->wave_projections);
+void onto_smoothpw(kpoint_t* kpt, int band_num, real_proj_site_t* sites, int num_sites,
+	int* G_bounds, double* lattice, double* reclattice, int num_cart_gridpts, int* fftg) {
 
-	mkl_free(x);
+	onto_smoothpw_block(kpt, band_num, 1, sites, num_sites,
+		G_bounds, lattice, reclattice, num_cart_gridpts, fftg);
 }
 
 void get_aug_freqs(kpoint_t* kpt, int band_num, real_proj_site_t* sites, int num_sites,
 	int* G_bounds, double* lattice, double* reclattice, int num_cart_gridpts, int* fftg) {
 
-	if (kpt->bands[band_num]->CAs != NULL) {
-		return;
-	}
-
-	double* k = kpt->k;
-	int* Gs = kpt->Gs;
-	float complex* Cs = kpt->bands[band_num]->Cs;
-	int num_waves = kpt->num_waves;
-
-	double complex* x = (double complex*) mkl_calloc(fftg[0]*fftg[1]*fftg[2], sizeof(double complex), 64);
-	CHECK_ALLOCATION(x);
-
-	band_t* band = kpt->bands[band_num];
-
-	get_aug_freqs_helper(kpt->bands[band_num], x, sites, num_sites,
-		lattice, reclattice, k, num_cart_gridpts, fftg, band->projections);
-
-	band->CAs = (float complex*) mkl_calloc(kpt->num_waves, sizeof(float complex), 64);
-	fwd_fft3d(x, G_bounds, lattice, k, Gs, band->CAs, num_waves, fftg);
-	//for (int w = 0; w < kpt->num_waves; w++) {
-	//	band->CAs[w] += band->Cs[w];
-	//		printf("%f %f %f %f\n", creal(band->CAs[w]), cimag(band->CAs[w]),
-	//		creal(band->Cs[w]), cimag(band->Cs[w]));
-	//}
-
-	mkl_free(x);
+	get_aug_freqs_block(kpt, band_num, 1, sites, num_sites,
+		G_bounds, lattice, reclattice, num_cart_gridpts, fftg);
 }
 
-
 void add_num_cart_gridpts(ppot_t* pp_ptr, double* lattice, int* fftg) {
 
 	ppot_t pp = *pp_ptr;
@@ -496,18 +696,17 @@ void make_pwave_overlap_matrices(ppot_t* pp_ptr) {
 	pp_ptr->diff_overlap_matrix = diov;
 }
 
-void setup_projections(pswf_t* wf, ppot_t* pps, int num_elems,
-	int num_sites, int* fftg, int* labels, double* coords) {
+int set_projector_list(pswf_t* wf, ppot_t* pps, int num_elems,
+	int num_sites, int* fftg) {
 
 	wf->num_sites = num_sites;
 	wf->fftg = (int*) malloc(3*sizeof(int));
+	CHECK_ALLOCATION(wf->fftg);
 	wf->fftg[0] = fftg[0];
 	wf->fftg[1] = fftg[1];
 	wf->fftg[2] = fftg[2];
 	wf->num_elems = num_elems;
-	wf->num_sites = num_sites;
 	wf->pps = pps;
-	printf("started setup_proj\n");
 	int num_cart_gridpts = 0;
 	for (int p = 0; p < num_elems; p++) {
 		add_num_cart_gridpts(pps+p, wf->lattice, fftg);
@@ -515,215 +714,862 @@ void setup_projections(pswf_t* wf, ppot_t* pps, int num_elems,
 			num_cart_gridpts = pps[p].num_cart_gridpts;
 		}
 	}
-	int NUM_KPTS = wf->nwk * wf->nspin;
-	int NUM_BANDS = wf->nband;
-	printf("calculating projector_values\n");
-	real_proj_site_t* sites = projector_values(num_sites, labels, coords,
-		wf->lattice, wf->reclattice, pps, fftg);
-	printf("onto_projector calcs\n");
-#if defined(_OPENMP)
-	omp_set_num_threads(omp_get_max_threads());
-#endif
-	#pragma omp parallel for 
-	for (int w = 0; w < NUM_BANDS * NUM_KPTS; w++) {
-		kpoint_t* kpt = wf->kpts[w % NUM_KPTS];
-		int band_num = w / NUM_KPTS;
-		onto_projector(kpt, band_num, sites, num_sites,
-			wf->G_bounds, wf->lattice, wf->reclattice, num_cart_gridpts, fftg);
-		if (wf->is_ncl) {
-			onto_projector_ncl(kpt, band_num, sites, num_sites,
-				wf->G_bounds, wf->lattice, wf->reclattice, num_cart_gridpts, fftg);
+	return num_cart_gridpts;
+}
+
+/*
+Fills the num_waves x total_projs row major matrix P, where
+P[w][i] = 4pi/sqrt(vol) i^l conj(Y_lm(k+G_w)) kproj_i(|k+G_w|) exp(iG_w.R_i)
+for the projector i={R,epsilon,l,m} in the structure, so that
+the projections of a band with plane wave coefficients C are C P.
+The phase convention matches onto_projector_helper_block.
+*/
+static void recip_projector_matrix(double complex* P, kpoint_t* kpt, int num_waves,
+	ppot_t* pps, int num_elems, int num_sites, int* labels, double* coords,
+	double* reclattice, double vol, int total_projs) {
+
+	int max_elem_projs = 0;
+	for (int e = 0; e < num_elems; e++) {
+		max_elem_projs = max(max_elem_projs, pps[e].total_projs);
+	}
+	double complex prefac = 4 * PI / pow(vol, 0.5);
+	double complex ipow[4] = {1, I, -1, -I};
+
+	#pragma omp parallel
+	{
+		double complex* elem_vals = (double complex*) malloc(
+			num_elems * max_elem_projs * sizeof(double complex));
+		CHECK_ALLOCATION(elem_vals);
+		double kG[3];
+		double dir[2];
+		#pragma omp for
+		for (int w = 0; w < num_waves; w++) {
+			int* G = kpt->Gs + 3*w;
+			kG[0] = kpt->k[0] + G[0];
+			kG[1] = kpt->k[1] + G[1];
+			kG[2] = kpt->k[2] + G[2];
+			frac_to_cartesian(kG, reclattice);
+			double q = mag(kG);
+			if (q == 0) {
+				dir[0] = 0;
+				dir[1] = 0;
+			} else {
+				direction(kG, dir);
+			}
+			for (int e = 0; e < num_elems; e++) {
+				ppot_t* pp = pps + e;
+				double complex* vals = elem_vals + e * max_elem_projs;
+				int n = 0;
+				for (int j = 0; j < pp->num_projs; j++) {
+					funcset_t funcs = pp->funcs[j];
+					double complex radial = prefac * ipow[funcs.l % 4]
+						* proj_interpolate(q, pp->kproj_max, pp->kproj_gridsize,
+						pp->kproj_grid, funcs.kproj, funcs.kproj_spline);
+					for (int m = -funcs.l; m <= funcs.l; m++) {
+						vals[n] = radial * conj(Ylm(funcs.l, m, dir[0], dir[1]));
+						n++;
+					}
+				}
+			}
+			double complex* row = P + (long) w * total_projs;
+			for (int s = 0; s < num_sites; s++) {
+				double complex phase = cexp(2 * PI * I * (G[0] * coords[3*s+0]
+					+ G[1] * coords[3*s+1] + G[2] * coords[3*s+2]));
+				double complex* vals = elem_vals + labels[s] * max_elem_projs;
+				for (int p = 0; p < pps[labels[s]].total_projs; p++) {
+					row[p] = vals[p] * phase;
+				}
+				row += pps[labels[s]].total_projs;
+			}
 		}
+		free(elem_vals);
 	}
-	printf("Done \n");
-	free_real_proj_site_list(sites, num_sites);	
 }
 
-void overlap_setup_real(pswf_t* wf_R, pswf_t* wf_S,
-	int* labels_R, int* labels_S, double* coords_R, double* coords_S,
-	int* N_R, int* N_S, int* N_RS_R, int* N_RS_S, int num_N_R, int num_N_S, int num_N_RS) {
+/*
+Evaluates the projections of bands band_start to band_start+num_bands-1
+of kpt in reciprocal space (see setup_projections_recip).
+*/
+static void onto_projector_recip_block(pswf_t* wf, kpoint_t* kpt,
+	int band_start, int num_bands) {
 
-	clean_wave_projections(wf_R);
-	clean_wave_projections(wf_S);
+	int num_waves = kpt->num_waves;
+	int num_pws = wf->is_ncl ? num_waves / 2 : num_waves;
+	int total_projs = 0;
+	for (int s = 0; s < wf->num_sites; s++) {
+		total_projs += wf->pps[wf->proj_labels[s]].total_projs;
+	}
+	double complex* P = (double complex*) mkl_malloc(
+		(long) num_pws * total_projs * sizeof(double complex), 64);
+	CHECK_ALLOCATION(P);
+	recip_projector_matrix(P, kpt, num_pws, wf->pps, wf->num_elems, wf->num_sites,
+		wf->proj_labels, wf->proj_coords, wf->reclattice, determinant(wf->lattice),
+		total_projs);
+
+	int block = RECIP_BLOCK_BYTES / ((long) num_waves * sizeof(double complex));
+	block = max(1, min(block, num_bands));
+	double complex* Cs = (double complex*) mkl_malloc(
+		(long) block * num_waves * sizeof(double complex), 64);
+	CHECK_ALLOCATION(Cs);
+	double complex one = 1;
+	double complex zero = 0;
+	for (int start = band_start; start < band_start + num_bands; start += block) {
+		int nb = min(block, band_start + num_bands - start);
+		#pragma omp parallel for
+		for (int b = 0; b < nb; b++) {
+			float complex* C = kpt->bands[start + b]->Cs;
+			double complex* row = Cs + (long) b * num_waves;
+			for (int w = 0; w < num_waves; w++) {
+				row[w] = C[w];
+			}
+		}
+		band_t* band = kpt->bands[start];
+		double complex* overlaps = band->projections[0].overlaps;
+		if (!wf->is_ncl) {
+			cblas_zgemm(CblasRowMajor, CblasNoTrans, CblasNoTrans,
+				nb, total_projs, num_waves, &one, Cs, num_waves,
+				P, total_projs, &zero, overlaps, total_projs);
+			continue;
+		}
+		double complex* up = band->up_projections[0].overlaps;
+		double complex* down = band->down_projections[0].overlaps;
+		cblas_zgemm(CblasRowMajor, CblasNoTrans, CblasNoTrans,
+			nb, total_projs, num_pws, &one, Cs, num_waves,
+			P, total_projs, &zero, up, total_projs);
+		cblas_zgemm(CblasRowMajor, CblasNoTrans, CblasNoTrans,
+			nb, total_projs, num_pws, &one, Cs + num_pws, num_waves,
+			P, total_projs, &zero, down, total_projs);
+		// onto_projector_block puts both components on the same FFT grid,
+		// so the down component overwrites the up component there
+		memcpy(overlaps, down, (long) nb * total_projs * sizeof(double complex));
+	}
+	mkl_free(Cs);
+	mkl_free(P);
+}
 
-	wf_R->wp_num = num_N_S;
-	wf_S->wp_num = num_N_R;
+/*
+Narrows the bands band_start to band_start+num_bands-1 of k-point
+kpt_num to the smallest range containing all of the bands whose
+projections have not been evaluated. Returns 0 if there are none.
+*/
+static int missing_band_range(pswf_t* wf, int kpt_num, int* band_start, int* num_bands) {
+	char* done = wf->proj_done + (long) kpt_num * wf->nband;
+	int first = *band_start;
+	int last = *band_start + *num_bands - 1;
+	while (first <= last && done[first]) first++;
+	while (last >= first && done[last]) last--;
+	*band_start = first;
+	*num_bands = last - first + 1;
+	return *num_bands > 0;
+}
 
-	double complex** overlaps = NULL;
-	if (num_N_RS > 0) {
-		overlaps = (double complex**) malloc(num_N_RS * sizeof(double complex*));
-		CHECK_ALLOCATION(overlaps);
+/*
+Sets up the real space projector values at each site of wf,
+if they have not been set up yet.
+*/
+static void check_projection_sites(pswf_t* wf) {
+	if (wf->proj_sites == NULL) {
+		wf->proj_sites = projector_values(wf->num_sites, wf->proj_labels,
+			wf->proj_coords, wf->lattice, wf->reclattice, wf->pps, wf->fftg);
 	}
+}
 
-	printf("STARTING OVERLAP_SETUP\n");
-	int NUM_KPTS = wf_R->nwk * wf_R->nspin;
-	int NUM_BANDS = wf_S->nband;
-	int max_num_indices = 0;
-	if (num_N_R > 0) {
-		real_proj_site_t* sites_N_R = smooth_pw_values(num_N_R, N_R, labels_R, coords_R,
-			wf_S->lattice, wf_S->reclattice, wf_R->pps, wf_S->fftg);
-		for (int s = 0; s < num_N_R; s++) {
-			if (sites_N_R[s].num_indices > max_num_indices) {
-				max_num_indices = sites_N_R[s].num_indices;
-			}
+void init_projections(pswf_t* wf, ppot_t* pps, int num_elems,
+	int num_sites, int* fftg, int* labels, double* coords, int recip) {
+
+	set_projector_list(wf, pps, num_elems, num_sites, fftg);
+	long num_bands = (long) wf->nwk * wf->nspin * wf->nband;
+	wf->proj_method = recip;
+	wf->proj_labels = (int*) malloc(num_sites * sizeof(int));
+	wf->proj_coords = (double*) malloc(3 * num_sites * sizeof(double));
+	wf->proj_done = (char*) malloc(num_bands * sizeof(char));
+	CHECK_ALLOCATION(wf->proj_labels);
+	CHECK_ALLOCATION(wf->proj_coords);
+	CHECK_ALLOCATION(wf->proj_done);
+	memcpy(wf->proj_labels, labels, num_sites * sizeof(int));
+	memcpy(wf->proj_coords, coords, 3 * num_sites * sizeof(double));
+	// projections that are already stored, e.g. read from a snapshot,
+	// do not need to be evaluated
+	memset(wf->proj_done, wf->proj_block != NULL, num_bands);
+	alloc_site_projection_block(wf, pps, num_sites, labels);
+}
+
+/*
+Marks the projections of bands band_start to band_start+num_bands-1
+of k-point kpt_num of wf as evaluated.
+*/
+static void mark_evaluated(pswf_t* wf, int kpt_num, int band_start, int num_bands) {
+	memset(wf->proj_done + (long) kpt_num * wf->nband + band_start, 1, num_bands);
+}
+
+/*
+Upper bound on the memory used by the real space projector values
+of a site of the element pp (see setup_site).
+*/
+static long site_table_size(ppot_t* pp) {
+	return (long) pp->num_cart_gridpts * (sizeof(int) + 3 * sizeof(double)
+		+ pp->total_projs * sizeof(double complex));
+}
+
+void set_projector_memory_budget(long num_bytes) {
+	projector_memory_budget = num_bytes;
+}
+
+long get_projector_memory_budget(void) {
+	return projector_memory_budget;
+}
+
+/*
+Evaluates the projections onto the num_sites sites in sites, which are
+sites site_start to site_start+num_sites-1 of wf, for bands band_start
+to band_start+num_bands-1 of kpt.
+*/
+static void onto_projector_sites(pswf_t* wf, kpoint_t* kpt, int band_start, int num_bands,
+	real_proj_site_t* sites, int site_start, int num_sites, int num_cart_gridpts) {
+
+	int num_waves = kpt->num_waves;
+	float complex** Cs = (float complex**) malloc(num_bands * sizeof(float complex*));
+	projection_t** projections = (projection_t**) malloc(num_bands * sizeof(projection_t*));
+	CHECK_ALLOCATION(Cs);
+	CHECK_ALLOCATION(projections);
+	for (int b = 0; b < num_bands; b++) {
+		Cs[b] = kpt->bands[band_start + b]->Cs;
+		projections[b] = kpt->bands[band_start + b]->projections + site_start;
+	}
+	onto_projector_bands(kpt, num_bands, Cs, num_waves, projections,
+		sites, num_sites, wf->lattice, wf->reclattice, num_cart_gridpts, wf->fftg);
+	if (wf->is_ncl) {
+		for (int b = 0; b < num_bands; b++) {
+			projections[b] = kpt->bands[band_start + b]->up_projections + site_start;
 		}
-#if defined(_OPENMP)
-		omp_set_num_threads(omp_get_max_threads());
-#endif
-		#pragma omp parallel for
-		for (int w = 0; w < NUM_BANDS * NUM_KPTS; w++) {
-			kpoint_t* kpt_S = wf_S->kpts[w%NUM_KPTS];
-	
-			onto_smoothpw(kpt_S, w/NUM_KPTS, sites_N_R, num_N_R,
-				wf_S->G_bounds, wf_S->lattice, wf_S->reclattice, max_num_indices, wf_S->fftg);
+		onto_projector_bands(kpt, num_bands, Cs, num_waves/2, projections,
+			sites, num_sites, wf->lattice, wf->reclattice, num_cart_gridpts, wf->fftg);
+		for (int b = 0; b < num_bands; b++) {
+			Cs[b] += num_waves/2;
+			projections[b] = kpt->bands[band_start + b]->down_projections + site_start;
 		}
-		free_real_proj_site_list(sites_N_R, num_N_R);
+		onto_projector_bands(kpt, num_bands, Cs, num_waves/2, projections,
+			sites, num_sites, wf->lattice, wf->reclattice, num_cart_gridpts, wf->fftg);
 	}
-	max_num_indices = 0;
-	printf("PART 1 DONE\n");
-	if (num_N_S > 0) {
-		real_proj_site_t* sites_N_S = smooth_pw_values(num_N_S, N_S, labels_S, coords_S,
-			wf_R->lattice, wf_R->reclattice, wf_S->pps, wf_R->fftg);
-		NUM_BANDS = wf_R->nband;
-		for (int s = 0; s < num_N_S; s++) {
-            if (sites_N_S[s].num_indices > max_num_indices) {
-                max_num_indices = sites_N_S[s].num_indices;
-            }
-        }
-#if defined(_OPENMP)
-		omp_set_num_threads(omp_get_max_threads());
-#endif
-		#pragma omp parallel for
-		for (int w = 0; w < NUM_BANDS * NUM_KPTS; w++) {
-			kpoint_t* kpt_R = wf_R->kpts[w%NUM_KPTS];
+	free(Cs);
+	free(projections);
+}
 
-			onto_smoothpw(kpt_R, w/NUM_KPTS, sites_N_S, num_N_S,
-				wf_R->G_bounds, wf_R->lattice, wf_R->reclattice, max_num_indices, wf_R->fftg);
-		}
-		free_real_proj_site_list(sites_N_S, num_N_S);
+/*
+Evaluates the projections of wf in real space for num_tasks blocks of bands,
+where block t is bands tasks[3*t+1] to tasks[3*t+1]+tasks[3*t+2]-1 of k-point
+tasks[3*t]. If the projector values at every site fit in the memory budget
+(see set_projector_memory_budget), they are kept in wf->proj_sites.
+Otherwise, they are set up for as many sites at a time as fit in the budget,
+and the bands are transformed to real space once for each such block of sites.
+*/
+static void evaluate_real_tasks(pswf_t* wf, int num_tasks, int* tasks) {
+	int num_cart_gridpts = 0;
+	long total_size = 0;
+	for (int p = 0; p < wf->num_elems; p++) {
+		num_cart_gridpts = max(num_cart_gridpts, wf->pps[p].num_cart_gridpts);
 	}
-	printf("PART 2 DONE\n");
-	
-	double* dcoords =  NULL;
-	if (num_N_RS > 0) {
-		dcoords = (double*) malloc(3 * num_N_RS * sizeof(double));
-		CHECK_ALLOCATION(dcoords);
+	for (int s = 0; s < wf->num_sites; s++) {
+		total_size += site_table_size(wf->pps + wf->proj_labels[s]);
 	}
 #if defined(_OPENMP)
 	omp_set_num_threads(omp_get_max_threads());
 #endif
-	#pragma omp parallel for
-	for (int i = 0; i < num_N_RS; i++) {
-		double R = 0;
-		int l1, l2;
-		int s1 = N_RS_R[i];
-		int s2 = N_RS_S[i];
-		ppot_t pp1 = wf_R->pps[labels_R[s1]];
-		ppot_t pp2 = wf_S->pps[labels_S[s2]];
-		// CALCULATE THE DIFF COORD HERE, PASS TO offsite_wave_overlap AND SAVE IT FOR USE IN compensation_terms
-		overlaps[i] = (double complex*) calloc(pp1.total_projs * pp2.total_projs, sizeof(double complex));
-		CHECK_ALLOCATION(overlaps[i]);
-		double* coord1 = coords_R + 3 * s1;
-		double* coord2 = coords_S + 3 * s2;
-		min_cart_path(coord2, coord1, wf_R->lattice, dcoords + 3*i, &R);
-		int tj = 0;
-		for (int j = 0; j < pp1.num_projs; j++) {
-			l1 = pp1.funcs[j].l;
-			for (int m1 = -l1; m1 <= l1; m1++) {
-				int tk = 0;
-				for (int k = 0; k < pp2.num_projs; k++) {
-					l2 = pp2.funcs[k].l;
-					for (int m2 = -l2; m2 <= l2; m2++) {
-						overlaps[i][tj*pp2.total_projs+tk] = conj(
-                            reciprocal_offsite_wave_overlap(dcoords + 3*i,
-                            pp1.kwave_grid, pp1.funcs[j].kwave,
-                            pp1.funcs[j].kwave_spline, pp1.wave_gridsize,
-                            pp2.kwave_grid, pp2.funcs[k].kwave,
-                            pp2.funcs[k].kwave_spline, pp2.wave_gridsize,
-                            wf_R->lattice, l1, m1, l2, m2)
-                            );
-						tk++;
-					}
+
+	if (wf->proj_sites != NULL || projector_memory_budget <= 0
+		|| total_size <= projector_memory_budget) {
+		check_projection_sites(wf);
+		#pragma omp parallel for schedule(dynamic)
+		for (int t = 0; t < num_tasks; t++) {
+			kpoint_t* kpt = wf->kpts[tasks[3*t]];
+			onto_projector_sites(wf, kpt, tasks[3*t+1], tasks[3*t+2],
+				wf->proj_sites, 0, wf->num_sites, num_cart_gridpts);
+		}
+	} else {
+		int* site_nums = (int*) malloc(wf->num_sites * sizeof(int));
+		CHECK_ALLOCATION(site_nums);
+		int num_block_sites = 0;
+		for (int site_start = 0; site_start < wf->num_sites; site_start += num_block_sites) {
+			long size = 0;
+			num_block_sites = 0;
+			while (site_start + num_block_sites < wf->num_sites) {
+				long site_size = site_table_size(wf->pps
+					+ wf->proj_labels[site_start + num_block_sites]);
+				if (num_block_sites > 0 && size + site_size > projector_memory_budget) {
+					break;
 				}
-				tj++;
+				site_nums[num_block_sites] = site_start + num_block_sites;
+				size += site_size;
+				num_block_sites++;
 			}
+			real_proj_site_t* sites = (real_proj_site_t*) malloc(
+				num_block_sites * sizeof(real_proj_site_t));
+			CHECK_ALLOCATION(sites);
+			setup_site(sites, wf->pps, num_block_sites, site_nums, wf->proj_labels,
+				wf->proj_coords, wf->lattice, wf->fftg, 0);
+			#pragma omp parallel for schedule(dynamic)
+			for (int t = 0; t < num_tasks; t++) {
+				kpoint_t* kpt = wf->kpts[tasks[3*t]];
+				onto_projector_sites(wf, kpt, tasks[3*t+1], tasks[3*t+2],
+					sites, site_start, num_block_sites, num_cart_gridpts);
+			}
+			free_real_proj_site_list(sites, num_block_sites);
 		}
+		free(site_nums);
+	}
+
+	for (int t = 0; t < num_tasks; t++) {
+		mark_evaluated(wf, tasks[3*t], tasks[3*t+1], tasks[3*t+2]);
 	}
-	wf_S->overlaps = overlaps;
-	wf_S->dcoords = dcoords;
-	wf_S->num_aug_overlap_sites = num_N_RS;
-	wf_R->num_aug_overlap_sites = num_N_RS;
-	printf("PART 3 DONE\nFINISHED OVERLAP SETUP\n");
 }
 
-void overlap_setup_recip(pswf_t* wf_R, pswf_t* wf_S,
-	int* labels_R, int* labels_S, double* coords_R, double* coords_S,
-	int* N_R, int* N_S, int* N_RS_R, int* N_RS_S, int num_N_R, int num_N_S, int num_N_RS) {
+void evaluate_projections(pswf_t* wf, int kpt_num, int band_start, int num_bands) {
+	if (!missing_band_range(wf, kpt_num, &band_start, &num_bands)) {
+		return;
+	}
+	if (wf->proj_method == 1) {
+		onto_projector_recip_block(wf, wf->kpts[kpt_num], band_start, num_bands);
+		mark_evaluated(wf, kpt_num, band_start, num_bands);
+		return;
+	}
+	int block = band_block_size(num_bands, 1, wf->fftg);
+	int num_tasks = (num_bands + block - 1) / block;
+	int* tasks = (int*) malloc(3 * num_tasks * sizeof(int));
+	CHECK_ALLOCATION(tasks);
+	for (int t = 0; t < num_tasks; t++) {
+		tasks[3*t] = kpt_num;
+		tasks[3*t+1] = band_start + t * block;
+		tasks[3*t+2] = min(block, num_bands - t * block);
+	}
+	evaluate_real_tasks(wf, num_tasks, tasks);
+	free(tasks);
+}
 
-	clean_wave_projections(wf_R);
-	clean_wave_projections(wf_S);
+void evaluate_all_projections(pswf_t* wf) {
+	int NUM_KPTS = wf->nwk * wf->nspin;
+	int NUM_BANDS = wf->nband;
+	if (wf->proj_method == 1) {
+		for (int k = 0; k < NUM_KPTS; k++) {
+			evaluate_projections(wf, k, 0, NUM_BANDS);
+		}
+		return;
+	}
+	int block = band_block_size(NUM_BANDS, NUM_KPTS, wf->fftg);
+	int num_blocks = (NUM_BANDS + block - 1) / block;
+	int* tasks = (int*) malloc(3 * num_blocks * NUM_KPTS * sizeof(int));
+	CHECK_ALLOCATION(tasks);
+	int num_tasks = 0;
+	for (int w = 0; w < num_blocks * NUM_KPTS; w++) {
+		int k = w % NUM_KPTS;
+		int band_start = (w / NUM_KPTS) * block;
+		int num_bands = min(block, NUM_BANDS - band_start);
+		if (missing_band_range(wf, k, &band_start, &num_bands)) {
+			tasks[3*num_tasks] = k;
+			tasks[3*num_tasks+1] = band_start;
+			tasks[3*num_tasks+2] = num_bands;
+			num_tasks++;
+		}
+	}
+	if (num_tasks > 0) {
+		evaluate_real_tasks(wf, num_tasks, tasks);
+	}
+	free(tasks);
+}
 
-	wf_R->wp_num = num_N_S;
-	wf_S->wp_num = num_N_R;
+void setup_projections(pswf_t* wf, ppot_t* pps, int num_elems,
+	int num_sites, int* fftg, int* labels, double* coords) {
 
-	double complex** overlaps = NULL;
-	if (num_N_RS > 0) {
-		overlaps = (double complex**) malloc(num_N_RS * sizeof(double complex*));
-		CHECK_ALLOCATION(overlaps);
+	init_projections(wf, pps, num_elems, num_sites, fftg, labels, coords, 0);
+	evaluate_all_projections(wf);
+}
+
+void setup_projections_recip(pswf_t* wf, ppot_t* pps, int num_elems,
+	int num_sites, int* fftg, int* labels, double* coords) {
+
+	init_projections(wf, pps, num_elems, num_sites, fftg, labels, coords, 1);
+	evaluate_all_projections(wf);
+}
+
+/*
+Returns 1 if the smooth partial waves (see smooth_pw_values) of pp1 and pp2
+are the same, so that projections onto one can be used for the other.
+*/
+static int same_smooth_waves(ppot_t* pp1, ppot_t* pp2) {
+	if (pp1 == pp2) {
+		return 1;
+	}
+	if (pp1->num_projs != pp2->num_projs || pp1->total_projs != pp2->total_projs
+		|| pp1->proj_gridsize != pp2->proj_gridsize || pp1->wave_rmax != pp2->wave_rmax) {
+		return 0;
 	}
+	size_t size = pp1->proj_gridsize * sizeof(double);
+	if (memcmp(pp1->smooth_grid, pp2->smooth_grid, size) != 0) {
+		return 0;
+	}
+	for (int j = 0; j < pp1->num_projs; j++) {
+		if (pp1->funcs[j].l != pp2->funcs[j].l || memcmp(pp1->funcs[j].smooth_diffwave,
+			pp2->funcs[j].smooth_diffwave, size) != 0) {
+			return 0;
+		}
+	}
+	return 1;
+}
 
-	printf("STARTING OVERLAP_SETUP RECIP\n");
-	int NUM_KPTS = wf_R->nwk * wf_R->nspin;
-	int NUM_BANDS = wf_R->nband;
-	int max_num_indices = 0;
-	if (num_N_R > 0) {
-		real_proj_site_t* sites_N_R = smooth_pw_values(num_N_R, N_R, labels_R, coords_R,
-			wf_R->lattice, wf_R->reclattice, wf_R->pps, wf_R->fftg);
-		for (int s = 0; s < num_N_R; s++) {
-			if (sites_N_R[s].num_indices > max_num_indices) {
-				max_num_indices = sites_N_R[s].num_indices;
+/*
+Returns 1 if the fractional coordinates coord1 and coord2 are
+the same position in the periodic structure.
+*/
+static int same_position(double* coord1, double* coord2) {
+	for (int i = 0; i < 3; i++) {
+		double d = coord1[i] - coord2[i];
+		if (fabs(d - round(d)) > WAVE_PROJ_COORD_TOL) {
+			return 0;
+		}
+	}
+	return 1;
+}
+
+/*
+Frees the entries of the wave projection cache of wf that are not used
+by any overlap context and cannot be reused, then the least recently used
+unused entries until the cache fits in the projector memory budget,
+if there is one.
+*/
+static void trim_wave_proj_cache(pswf_t* wf) {
+	long entry_size = (long) wf->nwk * wf->nspin * wf->nband * sizeof(double complex);
+	long total = 0;
+	wave_proj_cache_t** ptr = &wf->wp_cache;
+	while (*ptr != NULL) {
+		wave_proj_cache_t* entry = *ptr;
+		if (entry->refs == 0 && entry->elem < 0) {
+			*ptr = entry->next;
+			free(entry->overlaps);
+			free(entry);
+		} else {
+			total += entry_size * entry->total_projs;
+			ptr = &entry->next;
+		}
+	}
+	while (projector_memory_budget > 0 && total > projector_memory_budget) {
+		wave_proj_cache_t** oldest = NULL;
+		for (ptr = &wf->wp_cache; *ptr != NULL; ptr = &(*ptr)->next) {
+			if ((*ptr)->refs == 0 && (oldest == NULL || (*ptr)->last_use < (*oldest)->last_use)) {
+				oldest = ptr;
+			}
+		}
+		if (oldest == NULL) {
+			break;
+		}
+		wave_proj_cache_t* entry = *oldest;
+		*oldest = entry->next;
+		total -= entry_size * entry->total_projs;
+		free(entry->overlaps);
+		free(entry);
+	}
+}
+
+/*
+Returns the entries of the wave projection cache of wf for the smooth
+partial waves (from pps) of the num_N sites in Nlst. Every band of wf
+is projected onto the sites that are not in the cache yet, and the
+sites of elements that wf does not have are never reused.
+*/
+static wave_proj_cache_t** wave_projection_entries(pswf_t* wf, ppot_t* pps,
+	int num_N, int* Nlst, int* labels, double* coords) {
+
+	int NUM_KPTS = wf->nwk * wf->nspin;
+	int NUM_BANDS = wf->nband;
+	wave_proj_cache_t** entries = (wave_proj_cache_t**) malloc(
+		max(num_N, 1) * sizeof(wave_proj_cache_t*));
+	int* missing = (int*) malloc(max(num_N, 1) * sizeof(int));
+	int* missing_sites = (int*) malloc(max(num_N, 1) * sizeof(int));
+	CHECK_ALLOCATION(entries);
+	CHECK_ALLOCATION(missing);
+	CHECK_ALLOCATION(missing_sites);
+	int num_missing = 0;
+	wf->wp_clock++;
+	for (int s = 0; s < num_N; s++) {
+		ppot_t* pp = pps + labels[Nlst[s]];
+		double* coord = coords + 3 * Nlst[s];
+		int elem = -1;
+		for (int e = 0; e < wf->num_elems; e++) {
+			if (same_smooth_waves(pp, wf->pps + e)) {
+				elem = e;
+				break;
 			}
 		}
+		wave_proj_cache_t* entry = wf->wp_cache;
+		while (entry != NULL && (elem < 0 || entry->elem != elem
+			|| memcmp(entry->fftg, wf->fftg, 3 * sizeof(int)) != 0
+			|| !same_position(entry->coord, coord))) {
+			entry = entry->next;
+		}
+		if (entry == NULL) {
+			entry = (wave_proj_cache_t*) malloc(sizeof(wave_proj_cache_t));
+			CHECK_ALLOCATION(entry);
+			entry->elem = elem;
+			memcpy(entry->coord, coord, 3 * sizeof(double));
+			memcpy(entry->fftg, wf->fftg, 3 * sizeof(int));
+			entry->total_projs = pp->total_projs;
+			entry->refs = 0;
+			entry->cached = 1;
+			entry->overlaps = (double complex*) malloc(
+				max((long) NUM_KPTS * NUM_BANDS * pp->total_projs, 1) * sizeof(double complex));
+			CHECK_ALLOCATION(entry->overlaps);
+			entry->next = wf->wp_cache;
+			wf->wp_cache = entry;
+			missing[num_missing] = s;
+			missing_sites[num_missing] = Nlst[s];
+			num_missing++;
+		} else {
+			wf->wp_hits++;
+		}
+		entry->refs++;
+		entry->last_use = wf->wp_clock;
+		entries[s] = entry;
+	}
+
+	if (num_missing > 0) {
+		real_proj_site_t* sites = smooth_pw_values(num_missing, missing_sites, labels, coords,
+			wf->lattice, wf->reclattice, pps, wf->fftg);
+		int max_num_indices = 0;
+		for (int t = 0; t < num_missing; t++) {
+			max_num_indices = max(max_num_indices, sites[t].num_indices);
+		}
 #if defined(_OPENMP)
 		omp_set_num_threads(omp_get_max_threads());
 #endif
-		#pragma omp parallel for
-		for (int w = 0; w < NUM_BANDS * NUM_KPTS; w++) {
-			kpoint_t* kpt_R = wf_R->kpts[w%NUM_KPTS];
-	
-			get_aug_freqs(kpt_R, w/NUM_KPTS, sites_N_R, num_N_R,
-				wf_R->G_bounds, wf_R->lattice, wf_R->reclattice, max_num_indices, wf_R->fftg);
+		int block = band_block_size(NUM_BANDS, NUM_KPTS, wf->fftg);
+		int num_blocks = (NUM_BANDS + block - 1) / block;
+		#pragma omp parallel for schedule(dynamic)
+		for (int w = 0; w < num_blocks * NUM_KPTS; w++) {
+			int kpt_num = w % NUM_KPTS;
+			kpoint_t* kpt = wf->kpts[kpt_num];
+			int band_start = (w / NUM_KPTS) * block;
+			int num_bands = min(block, NUM_BANDS - band_start);
+			float complex** Cs = (float complex**) malloc(num_bands * sizeof(float complex*));
+			projection_t** projections = (projection_t**) malloc(num_bands * sizeof(projection_t*));
+			projection_t* projection_block = (projection_t*) malloc(
+				num_bands * num_missing * sizeof(projection_t));
+			CHECK_ALLOCATION(Cs);
+			CHECK_ALLOCATION(projections);
+			CHECK_ALLOCATION(projection_block);
+			for (int b = 0; b < num_bands; b++) {
+				Cs[b] = kpt->bands[band_start + b]->Cs;
+				projections[b] = projection_block + b * num_missing;
+				for (int t = 0; t < num_missing; t++) {
+					wave_proj_cache_t* entry = entries[missing[t]];
+					projections[b][t].overlaps = entry->overlaps
+						+ ((long) kpt_num * NUM_BANDS + band_start + b) * entry->total_projs;
+				}
+			}
+			onto_projector_bands(kpt, num_bands, Cs, kpt->num_waves, projections,
+				sites, num_missing, wf->lattice, wf->reclattice, max_num_indices, wf->fftg);
+			free(Cs);
+			free(projections);
+			free(projection_block);
+		}
+		free_real_proj_site_list(sites, num_missing);
+	}
+	free(missing);
+	free(missing_sites);
+	trim_wave_proj_cache(wf);
+	return entries;
+}
+
+/*
+Releases the num_entries entries of a wave projection cache in entries,
+freeing the ones whose wavefunction has been freed if they are unused.
+*/
+static void release_wave_proj_entries(wave_proj_cache_t** entries, int num_entries) {
+	if (entries == NULL) {
+		return;
+	}
+	for (int s = 0; s < num_entries; s++) {
+		entries[s]->refs--;
+		if (entries[s]->refs == 0 && !entries[s]->cached) {
+			free(entries[s]->overlaps);
+			free(entries[s]);
+		}
+	}
+	free(entries);
+}
+
+/*
+Adds the reciprocal space smooth partial waves of the num_add sites in
+sites_add to the CAs of a block of bands of kpt, and subtracts those
+of the num_remove sites in sites_remove (see get_aug_freqs_block).
+If accumulate is 0, the CAs are overwritten instead of added to.
+*/
+static void update_aug_freqs_block(kpoint_t* kpt, int band_start, int num_bands,
+	float complex** CAs, int accumulate,
+	real_proj_site_t* sites_add, int num_add, real_proj_site_t* sites_remove, int num_remove,
+	double* lattice, double* reclattice, int num_cart_gridpts, int* fftg) {
+
+	long gridsize = (long) fftg[0] * fftg[1] * fftg[2];
+	double complex* x = fft_workspace(0, fftg, num_bands);
+	double complex* y = fft_workspace(1, fftg, 1);
+	float complex** out = CAs;
+	if (accumulate) {
+		out = (float complex**) malloc(num_bands * sizeof(float complex*));
+		CHECK_ALLOCATION(out);
+	}
+	for (int b = 0; b < num_bands; b++) {
+		band_t* band = kpt->bands[band_start + b];
+		double complex* xb = x + b * gridsize;
+		get_aug_freqs_helper(band, xb, sites_add, num_add,
+			lattice, reclattice, kpt->k, num_cart_gridpts, fftg, band->projections);
+		if (num_remove > 0) {
+			get_aug_freqs_helper(band, y, sites_remove, num_remove,
+				lattice, reclattice, kpt->k, num_cart_gridpts, fftg, band->projections);
+			for (long i = 0; i < gridsize; i++) {
+				xb[i] -= y[i];
+			}
+		}
+		if (accumulate) {
+			out[b] = (float complex*) malloc(kpt->num_waves * sizeof(float complex));
+			CHECK_ALLOCATION(out[b]);
+		}
+	}
+	fwd_fft3d_batch(x, lattice, kpt->Gs, out, kpt->num_waves, num_bands, fftg);
+	if (accumulate) {
+		for (int b = 0; b < num_bands; b++) {
+			for (int w = 0; w < kpt->num_waves; w++) {
+				CAs[b][w] += out[b][w];
+			}
+			free(out[b]);
+		}
+		free(out);
+	}
+}
+
+/*
+Adds the reciprocal space smooth partial waves of the num_add sites in add
+to the CAs of entry, and subtracts those of the num_remove sites in remove.
+If accumulate is 0, the CAs are overwritten instead of added to.
+*/
+static void update_aug_freqs(pswf_t* wf, aug_freqs_cache_t* entry, int accumulate,
+	int num_add, int* add, int num_remove, int* remove, int* labels, double* coords) {
+
+	int NUM_KPTS = wf->nwk * wf->nspin;
+	int NUM_BANDS = wf->nband;
+	real_proj_site_t* sites_add = NULL;
+	real_proj_site_t* sites_remove = NULL;
+	int max_num_indices = 0;
+	if (num_add > 0) {
+		sites_add = smooth_pw_values(num_add, add, labels, coords,
+			wf->lattice, wf->reclattice, wf->pps, wf->fftg);
+		for (int s = 0; s < num_add; s++) {
+			max_num_indices = max(max_num_indices, sites_add[s].num_indices);
+		}
+	}
+	if (num_remove > 0) {
+		sites_remove = smooth_pw_values(num_remove, remove, labels, coords,
+			wf->lattice, wf->reclattice, wf->pps, wf->fftg);
+		for (int s = 0; s < num_remove; s++) {
+			max_num_indices = max(max_num_indices, sites_remove[s].num_indices);
 		}
-		free_real_proj_site_list(sites_N_R, num_N_R);
 	}
-	max_num_indices = 0;
-	printf("PART 1 DONE RECIP\n");
-	if (num_N_S > 0) {
-		real_proj_site_t* sites_N_S = smooth_pw_values(num_N_S, N_S, labels_S, coords_S,
-			wf_S->lattice, wf_S->reclattice, wf_S->pps, wf_S->fftg);
-		NUM_BANDS = wf_S->nband;
-		for (int s = 0; s < num_N_S; s++) {
-            if (sites_N_S[s].num_indices > max_num_indices) {
-                max_num_indices = sites_N_S[s].num_indices;
-            }
-        }
 #if defined(_OPENMP)
-		omp_set_num_threads(omp_get_max_threads());
+	omp_set_num_threads(omp_get_max_threads());
 #endif
-		#pragma omp parallel for
-		for (int w = 0; w < NUM_BANDS * NUM_KPTS; w++) {
-			kpoint_t* kpt_S = wf_S->kpts[w%NUM_KPTS];
+	int block = band_block_size(NUM_BANDS, NUM_KPTS, wf->fftg);
+	int num_blocks = (NUM_BANDS + block - 1) / block;
+	#pragma omp parallel for schedule(dynamic)
+	for (int w = 0; w < num_blocks * NUM_KPTS; w++) {
+		int kpt_num = w % NUM_KPTS;
+		int band_start = (w / NUM_KPTS) * block;
+		int num_bands = min(block, NUM_BANDS - band_start);
+		update_aug_freqs_block(wf->kpts[kpt_num], band_start, num_bands,
+			entry->CAs + kpt_num * NUM_BANDS + band_start, accumulate,
+			sites_add, num_add, sites_remove, num_remove,
+			wf->lattice, wf->reclattice, max_num_indices, wf->fftg);
+	}
+	if (sites_add != NULL) free_real_proj_site_list(sites_add, num_add);
+	if (sites_remove != NULL) free_real_proj_site_list(sites_remove, num_remove);
+}
 
-			get_aug_freqs(kpt_S, w/NUM_KPTS, sites_N_S, num_N_S,
-				wf_S->G_bounds, wf_S->lattice, wf_S->reclattice, max_num_indices, wf_S->fftg);
+/*
+Adds a new entry for the num_N sites in Nlst to the aug_freqs
+cache of wf. If copy is not NULL, its CAs are copied into the entry.
+*/
+static aug_freqs_cache_t* new_aug_freqs_entry(pswf_t* wf, int num_N, int* Nlst,
+	aug_freqs_cache_t* copy) {
+
+	int NUM_KPTS = wf->nwk * wf->nspin;
+	aug_freqs_cache_t* entry = (aug_freqs_cache_t*) malloc(sizeof(aug_freqs_cache_t));
+	CHECK_ALLOCATION(entry);
+	entry->num_sites = num_N;
+	entry->sites = (int*) malloc(num_N * sizeof(int));
+	CHECK_ALLOCATION(entry->sites);
+	memcpy(entry->sites, Nlst, num_N * sizeof(int));
+	entry->refs = 0;
+	entry->cached = 1;
+	entry->num_states = NUM_KPTS * wf->nband;
+	entry->size = 0;
+	entry->CAs = (float complex**) malloc(entry->num_states * sizeof(float complex*));
+	CHECK_ALLOCATION(entry->CAs);
+	for (int k = 0; k < NUM_KPTS; k++) {
+		int num_waves = wf->kpts[k]->num_waves;
+		for (int b = 0; b < wf->nband; b++) {
+			float complex* CAs = (float complex*) mkl_calloc(num_waves, sizeof(float complex), 64);
+			CHECK_ALLOCATION(CAs);
+			if (copy != NULL) {
+				memcpy(CAs, copy->CAs[k * wf->nband + b], num_waves * sizeof(float complex));
+			}
+			entry->CAs[k * wf->nband + b] = CAs;
+			entry->size += num_waves;
 		}
-		free_real_proj_site_list(sites_N_S, num_N_S);
 	}
-	printf("PART 2 DONE RECIP\n");
-	
+	entry->next = wf->aug_cache;
+	wf->aug_cache = entry;
+	return entry;
+}
+
+/*
+Frees the least recently used entries of the aug_freqs cache of wf that are
+not used by any overlap context until the cache fits in the projector
+memory budget, if there is one.
+*/
+static void trim_aug_freqs_cache(pswf_t* wf) {
+	long total = 0;
+	for (aug_freqs_cache_t* entry = wf->aug_cache; entry != NULL; entry = entry->next) {
+		total += entry->size * sizeof(float complex);
+	}
+	while (projector_memory_budget > 0 && total > projector_memory_budget) {
+		aug_freqs_cache_t** oldest = NULL;
+		for (aug_freqs_cache_t** ptr = &wf->aug_cache; *ptr != NULL; ptr = &(*ptr)->next) {
+			if ((*ptr)->refs == 0 && (oldest == NULL || (*ptr)->last_use < (*oldest)->last_use)) {
+				oldest = ptr;
+			}
+		}
+		if (oldest == NULL) {
+			break;
+		}
+		aug_freqs_cache_t* entry = *oldest;
+		*oldest = entry->next;
+		total -= entry->size * sizeof(float complex);
+		free_aug_freqs_entry(entry);
+	}
+}
+
+/*
+Returns an entry of the aug_freqs cache of wf with the reciprocal space
+smooth partial waves of the num_N sites in Nlst, or NULL if num_N is 0.
+If an entry for a similar list of sites is cached, only the terms of the
+sites that were added to or removed from its list are evaluated, in place
+if no overlap context uses it and in a copy otherwise.
+*/
+static aug_freqs_cache_t* aug_freqs_entry(pswf_t* wf, int num_N, int* Nlst,
+	int* labels, double* coords) {
+
+	if (num_N == 0) {
+		return NULL;
+	}
+	wf->wp_clock++;
+	int num_indices = 1;
+	for (int s = 0; s < num_N; s++) {
+		num_indices = max(num_indices, Nlst[s] + 1);
+	}
+	char* in_new = (char*) calloc(num_indices, sizeof(char));
+	CHECK_ALLOCATION(in_new);
+	for (int s = 0; s < num_N; s++) {
+		in_new[Nlst[s]] = 1;
+	}
+
+	// the cached entry that needs the fewest sites added or removed,
+	// preferring entries that can be updated in place
+	aug_freqs_cache_t* best = NULL;
+	int best_diff = num_N;
+	for (aug_freqs_cache_t* entry = wf->aug_cache; entry != NULL; entry = entry->next) {
+		int num_common = 0;
+		for (int s = 0; s < entry->num_sites; s++) {
+			if (entry->sites[s] < num_indices && in_new[entry->sites[s]]) num_common++;
+		}
+		int diff = num_N + entry->num_sites - 2 * num_common;
+		if (diff < best_diff || (diff == best_diff && best != NULL
+			&& best->refs > 0 && entry->refs == 0)) {
+			best = entry;
+			best_diff = diff;
+		}
+	}
+
+	aug_freqs_cache_t* entry = best;
+	if (best != NULL) {
+		wf->wp_hits++;
+	}
+	if (best == NULL) {
+		entry = new_aug_freqs_entry(wf, num_N, Nlst, NULL);
+		update_aug_freqs(wf, entry, 0, num_N, Nlst, 0, NULL, labels, coords);
+	} else if (best_diff > 0) {
+		int* add = (int*) malloc(num_N * sizeof(int));
+		int* remove = (int*) malloc(max(best->num_sites, 1) * sizeof(int));
+		char* in_old = (char*) calloc(num_indices, sizeof(char));
+		CHECK_ALLOCATION(add);
+		CHECK_ALLOCATION(remove);
+		CHECK_ALLOCATION(in_old);
+		int num_add = 0;
+		int num_remove = 0;
+		for (int s = 0; s < best->num_sites; s++) {
+			if (best->sites[s] < num_indices && in_new[best->sites[s]]) {
+				in_old[best->sites[s]] = 1;
+			} else {
+				remove[num_remove++] = best->sites[s];
+			}
+		}
+		for (int s = 0; s < num_N; s++) {
+			if (!in_old[Nlst[s]]) add[num_add++] = Nlst[s];
+		}
+		if (best->refs > 0) {
+			entry = new_aug_freqs_entry(wf, num_N, Nlst, best);
+		} else {
+			free(entry->sites);
+			entry->sites = (int*) malloc(num_N * sizeof(int));
+			CHECK_ALLOCATION(entry->sites);
+			memcpy(entry->sites, Nlst, num_N * sizeof(int));
+			entry->num_sites = num_N;
+		}
+		update_aug_freqs(wf, entry, 1, num_add, add, num_remove, remove, labels, coords);
+		free(add);
+		free(remove);
+		free(in_old);
+	}
+	entry->refs++;
+	entry->last_use = wf->wp_clock;
+	free(in_new);
+	trim_aug_freqs_cache(wf);
+	return entry;
+}
+
+/*
+Releases an entry of an aug_freqs cache, freeing it
+if it is unused and its wavefunction has been freed.
+*/
+static void release_aug_freqs_entry(aug_freqs_cache_t* entry) {
+	if (entry == NULL) {
+		return;
+	}
+	entry->refs--;
+	if (entry->refs == 0 && !entry->cached) {
+		free_aug_freqs_entry(entry);
+	}
+}
+
+/*
+Sets up the overlaps of the augmentation spheres of the N_RS site pairs
+(the conjugates of the values of reciprocal_offsite_overlap_matrix) and
+the paths between them, and stores them in ctx.
+*/
+static void setup_offsite_overlaps(overlap_context_t* ctx, pswf_t* wf_R, pswf_t* wf_S,
+	int* labels_R, int* labels_S, double* coords_R, double* coords_S,
+	int* N_RS_R, int* N_RS_S, int num_N_RS) {
+
+	double complex** overlaps = NULL;
 	double* dcoords =  NULL;
 	if (num_N_RS > 0) {
+		overlaps = (double complex**) malloc(num_N_RS * sizeof(double complex*));
 		dcoords = (double*) malloc(3 * num_N_RS * sizeof(double));
+		CHECK_ALLOCATION(overlaps);
 		CHECK_ALLOCATION(dcoords);
 	}
 #if defined(_OPENMP)
@@ -732,71 +1578,205 @@ void overlap_setup_recip(pswf_t* wf_R, pswf_t* wf_S,
 	#pragma omp parallel for
 	for (int i = 0; i < num_N_RS; i++) {
 		double R = 0;
-		int l1, l2;
 		int s1 = N_RS_R[i];
 		int s2 = N_RS_S[i];
 		ppot_t pp1 = wf_R->pps[labels_R[s1]];
 		ppot_t pp2 = wf_S->pps[labels_S[s2]];
-		// CALCULATE THE DIFF COORD HERE, PASS TO offsite_wave_overlap AND SAVE IT FOR USE IN compensation_terms
 		overlaps[i] = (double complex*) calloc(pp1.total_projs * pp2.total_projs, sizeof(double complex));
 		CHECK_ALLOCATION(overlaps[i]);
 		double* coord1 = coords_R + 3 * s1;
 		double* coord2 = coords_S + 3 * s2;
 		min_cart_path(coord2, coord1, wf_R->lattice, dcoords + 3*i, &R);
-		int tj = 0;
-		for (int j = 0; j < pp1.num_projs; j++) {
-			l1 = pp1.funcs[j].l;
-			for (int m1 = -l1; m1 <= l1; m1++) {
-				int tk = 0;
-				for (int k = 0; k < pp2.num_projs; k++) {
-					l2 = pp2.funcs[k].l;
-					for (int m2 = -l2; m2 <= l2; m2++) {
-						overlaps[i][tj*pp2.total_projs+tk] = conj(
-                            reciprocal_offsite_wave_overlap(dcoords + 3*i,
-                            pp1.kwave_grid, pp1.funcs[j].kwave,
-                            pp1.funcs[j].kwave_spline, pp1.wave_gridsize,
-                            pp2.kwave_grid, pp2.funcs[k].kwave,
-                            pp2.funcs[k].kwave_spline, pp2.wave_gridsize,
-                            wf_R->lattice, l1, m1, l2, m2)
-                            );
-						tk++;
-					}
-				}
-				tj++;
-			}
+		reciprocal_offsite_overlap_matrix(overlaps[i], dcoords + 3*i, &pp1, &pp2);
+		for (int j = 0; j < pp1.total_projs * pp2.total_projs; j++) {
+			overlaps[i][j] = conj(overlaps[i][j]);
 		}
 	}
-	wf_S->overlaps = overlaps;
-	wf_S->dcoords = dcoords;
-	wf_S->num_aug_overlap_sites = num_N_RS;
-	wf_R->num_aug_overlap_sites = num_N_RS;
+	ctx->overlaps = overlaps;
+	ctx->dcoords = dcoords;
+}
+
+static overlap_context_t* new_overlap_context(int num_N_R, int num_N_S, int num_N_RS) {
+	overlap_context_t* ctx = (overlap_context_t*) malloc(sizeof(overlap_context_t));
+	CHECK_ALLOCATION(ctx);
+	ctx->num_N_R = num_N_R;
+	ctx->num_N_S = num_N_S;
+	ctx->num_N_RS = num_N_RS;
+	ctx->wp_R = NULL;
+	ctx->wp_S = NULL;
+	ctx->CAs_R = NULL;
+	ctx->CAs_S = NULL;
+	ctx->dcoords = NULL;
+	ctx->overlaps = NULL;
+	return ctx;
+}
+
+void free_overlap_context(overlap_context_t* ctx) {
+	if (ctx == NULL) {
+		return;
+	}
+	release_wave_proj_entries(ctx->wp_R, ctx->num_N_S);
+	release_wave_proj_entries(ctx->wp_S, ctx->num_N_R);
+	release_aug_freqs_entry(ctx->CAs_R);
+	release_aug_freqs_entry(ctx->CAs_S);
+	if (ctx->overlaps != NULL) {
+		for (int i = 0; i < ctx->num_N_RS; i++) {
+			free(ctx->overlaps[i]);
+		}
+		free(ctx->overlaps);
+	}
+	free(ctx->dcoords);
+	free(ctx);
+}
+
+overlap_context_t* overlap_setup_real(pswf_t* wf_R, pswf_t* wf_S,
+	int* labels_R, int* labels_S, double* coords_R, double* coords_S,
+	int* N_R, int* N_S, int* N_RS_R, int* N_RS_S, int num_N_R, int num_N_S, int num_N_RS) {
+
+	overlap_context_t* ctx = new_overlap_context(num_N_R, num_N_S, num_N_RS);
+	printf("STARTING OVERLAP_SETUP\n");
+	ctx->wp_S = wave_projection_entries(wf_S, wf_R->pps,
+		num_N_R, N_R, labels_R, coords_R);
+	printf("PART 1 DONE\n");
+	ctx->wp_R = wave_projection_entries(wf_R, wf_S->pps,
+		num_N_S, N_S, labels_S, coords_S);
+	printf("PART 2 DONE\n");
+	setup_offsite_overlaps(ctx, wf_R, wf_S, labels_R, labels_S, coords_R, coords_S,
+		N_RS_R, N_RS_S, num_N_RS);
+	printf("PART 3 DONE\nFINISHED OVERLAP SETUP\n");
+	return ctx;
+}
+
+overlap_context_t* overlap_setup_recip(pswf_t* wf_R, pswf_t* wf_S,
+	int* labels_R, int* labels_S, double* coords_R, double* coords_S,
+	int* N_R, int* N_S, int* N_RS_R, int* N_RS_S, int num_N_R, int num_N_S, int num_N_RS) {
+
+	overlap_context_t* ctx = new_overlap_context(num_N_R, num_N_S, num_N_RS);
+	printf("STARTING OVERLAP_SETUP RECIP\n");
+	ctx->CAs_R = aug_freqs_entry(wf_R, num_N_R, N_R, labels_R, coords_R);
+	printf("PART 1 DONE RECIP\n");
+	ctx->CAs_S = aug_freqs_entry(wf_S, num_N_S, N_S, labels_S, coords_S);
+	printf("PART 2 DONE RECIP\n");
+	setup_offsite_overlaps(ctx, wf_R, wf_S, labels_R, labels_S, coords_R, coords_S,
+		N_RS_R, N_RS_S, num_N_RS);
 	printf("PART 3 DONE RECIP\nFINISHED OVERLAP SETUP\n");
+	return ctx;
 }
 
-void compensation_terms(double complex* overlap, int BAND_NUM, pswf_t* wf_S, pswf_t* wf_R,
-	int num_M, int num_N_R, int num_N_S, int num_N_RS,
+/*
+Stores in D the matrix <phi_i|phi_j> - <phit_i|phit_j> of pp in the
+basis of its total_projs projector functions, which is zero unless
+projectors i and j have the same l and m.
+*/
+static void onsite_overlap_block(ppot_t* pp, double complex* D) {
+	int tp = pp->total_projs;
+	int* ns = (int*) malloc(tp * sizeof(int));
+	int* ms = (int*) malloc(tp * sizeof(int));
+	CHECK_ALLOCATION(ns);
+	CHECK_ALLOCATION(ms);
+	int p = 0;
+	for (int n = 0; n < pp->num_projs; n++) {
+		for (int m = -pp->funcs[n].l; m <= pp->funcs[n].l; m++) {
+			ns[p] = n;
+			ms[p] = m;
+			p++;
+		}
+	}
+	for (int i = 0; i < tp; i++) {
+		for (int j = 0; j < tp; j++) {
+			int ni = ns[i], nj = ns[j];
+			if (pp->funcs[ni].l == pp->funcs[nj].l && ms[i] == ms[j]) {
+				D[i*tp+j] = pp->aepw_overlap_matrix[pp->num_projs*ni+nj]
+					- pp->pspw_overlap_matrix[pp->num_projs*ni+nj];
+			} else {
+				D[i*tp+j] = 0;
+			}
+		}
+	}
+	free(ns);
+	free(ms);
+}
+
+/*
+Adds the augmentation terms of the overlaps of the num_bands bands of wf_S
+listed in bands with all bands of wf_R to overlap (see compensation_terms_block).
+For each k-point, every term has the form <A_b|B_j>, where A_b contains the
+projections of band b of wf_R onto its sites in M_R, N_R and N_RS_R and
+its projections onto the partial waves at the sites in N_S, and B_j contains
+the matching projections of band j of wf_S, multiplied by the on-site or
+off-site partial wave overlaps. The terms for a block of bands of each
+wavefunction are then one matrix product. If recip is 1, the N_R and N_S
+terms are replaced by the overlaps of the plane wave coefficients with
+the reciprocal space partial waves (CAs) instead. The projections onto
+the partial waves and the off-site overlaps are taken from ctx.
+*/
+static void compensation_matrix(double complex* overlap, int num_bands, int* bands,
+	pswf_t* wf_S, pswf_t* wf_R, overlap_context_t* ctx, int num_M, int num_N_R, int num_N_S, int num_N_RS,
 	int* M_R, int* M_S, int* N_R, int* N_S, int* N_RS_R, int* N_RS_S,
-	int* proj_labels, double* proj_coords, int* ref_labels, double* ref_coords,
-	int* fft_grid, int flip_spin) {
+	int* proj_labels, int* ref_labels, int flip_spin, int recip) {
 
-	setbuf(stdout, NULL);
-	
 	int NUM_KPTS = wf_R->nwk * wf_R->nspin;
 	int NUM_BANDS = wf_R->nband;
+	long row_size = (long) NUM_BANDS * NUM_KPTS;
+	if (recip) {
+		num_N_R = 0;
+		num_N_S = 0;
+	}
 
-	//double* overlap = (double*) calloc(2 * NUM_KPTS * NUM_BANDS, sizeof(double));
-	CHECK_ALLOCATION(overlap);
+	// offsets of the segment of each term in A_b and B_j
+	int num_terms = num_M + num_N_R + num_N_S + num_N_RS;
+	int* offsets = (int*) malloc((num_terms + 1) * sizeof(int));
+	CHECK_ALLOCATION(offsets);
+	int n = 0;
+	offsets[0] = 0;
+	for (int s = 0; s < num_M; s++, n++) {
+		offsets[n+1] = offsets[n] + wf_R->pps[ref_labels[M_R[s]]].total_projs;
+	}
+	for (int s = 0; s < num_N_R; s++, n++) {
+		offsets[n+1] = offsets[n] + wf_R->pps[ref_labels[N_R[s]]].total_projs;
+	}
+	for (int s = 0; s < num_N_S; s++, n++) {
+		offsets[n+1] = offsets[n] + wf_S->pps[proj_labels[N_S[s]]].total_projs;
+	}
+	for (int s = 0; s < num_N_RS; s++, n++) {
+		offsets[n+1] = offsets[n] + wf_R->pps[ref_labels[N_RS_R[s]]].total_projs;
+	}
+	int L = offsets[num_terms];
+
+	double complex** D = (double complex**) malloc(wf_R->num_elems * sizeof(double complex*));
+	CHECK_ALLOCATION(D);
+	for (int e = 0; e < wf_R->num_elems; e++) {
+		int tp = wf_R->pps[e].total_projs;
+		D[e] = (double complex*) malloc(max(tp * tp, 1) * sizeof(double complex));
+		CHECK_ALLOCATION(D[e]);
+		onsite_overlap_block(wf_R->pps + e, D[e]);
+	}
 
-	double complex** N_RS_overlaps = wf_S->overlaps;
+	int max_waves = 1;
+	for (int k = 0; k < NUM_KPTS; k++) {
+		max_waves = max(max_waves, wf_R->kpts[k]->num_waves);
+	}
+	long row_bytes = L * sizeof(double complex);
+	if (recip) row_bytes += 2L * max_waves * sizeof(float complex);
+	int block = max(1, COMPENSATION_BLOCK_BYTES / max(row_bytes, 1));
+	int proj_block = min(block, num_bands);
+	int ref_block = min(block, NUM_BANDS);
+	ref_block = max(1, min(ref_block, (int) (row_size / omp_get_max_threads())));
+	int num_ref_blocks = (NUM_BANDS + ref_block - 1) / ref_block;
+	double complex one = 1;
+	double complex zero = 0;
+	float complex fone = 1;
+	float complex fzero = 0;
 
 #if defined(_OPENMP)
 	omp_set_num_threads(omp_get_max_threads());
 #endif
-	#pragma omp parallel for
-	for (int w = 0; w < NUM_BANDS * NUM_KPTS; w++) {
-		int ni = 0, nj = 0;
-
-		int kpt_ind_R = w%NUM_KPTS;
+	#pragma omp parallel for schedule(dynamic)
+	for (int w = 0; w < NUM_KPTS * num_ref_blocks; w++) {
+		int kpt_num = w % NUM_KPTS;
+		int rstart = (w / NUM_KPTS) * ref_block;
+		int nr = min(ref_block, NUM_BANDS - rstart);
+		int kpt_ind_R = kpt_num;
 		if (wf_R->nspin == 2 && flip_spin) {
 			if (kpt_ind_R < wf_R->nwk) {
 				kpt_ind_R += wf_R->nwk;
@@ -804,193 +1784,199 @@ void compensation_terms(double complex* overlap, int BAND_NUM, pswf_t* wf_S, psw
 				kpt_ind_R -= wf_R->nwk;
 			}
 		}
-
 		kpoint_t* kpt_R = wf_R->kpts[kpt_ind_R];
-		kpoint_t* kpt_S = wf_S->kpts[w%NUM_KPTS];
-		band_t* band_R = kpt_R->bands[w/NUM_KPTS];
-		band_t* band_S = kpt_S->bands[BAND_NUM];
-
-		double complex temp = 0 + 0 * I;
-		for (int s = 0; s < num_M; s++) {
-			ppot_t pp = wf_R->pps[ref_labels[M_R[s]]];
-			int s1 = M_R[s];
-			int s2 = M_S[s];
-			projection_t pron = band_R->projections[s1];
-			projection_t ppron = band_S->projections[s2];
-
-			for (int i = 0; i < pron.total_projs; i++) {
-				for (int j = 0; j < ppron.total_projs; j++) {
-					if (pron.ls[i] == ppron.ls[j]  && pron.ms[i] == ppron.ms[j]) {
-						nj = ppron.ns[j];
-						ni = pron.ns[i];
-						temp += conj(pron.overlaps[i])
-							* (pp.aepw_overlap_matrix[pp.num_projs*ni+nj]
-							- pp.pspw_overlap_matrix[pp.num_projs*ni+nj])
-							* ppron.overlaps[j];
-					}
-				}
-			}
+		kpoint_t* kpt_S = wf_S->kpts[kpt_num];
+		int num_waves = kpt_R->num_waves;
+
+		double complex* phases = (double complex*) malloc(max(num_N_RS, 1) * sizeof(double complex));
+		double complex* A = (double complex*) malloc(max((long) nr * L, 1) * sizeof(double complex));
+		double complex* B = (double complex*) malloc(max((long) proj_block * L, 1) * sizeof(double complex));
+		double complex* result = (double complex*) malloc(
+			(long) proj_block * nr * sizeof(double complex));
+		CHECK_ALLOCATION(phases);
+		CHECK_ALLOCATION(A);
+		CHECK_ALLOCATION(B);
+		CHECK_ALLOCATION(result);
+		for (int s = 0; s < num_N_RS; s++) {
+			phases[s] = cexp(2*I*PI * dot(kpt_R->k, ctx->dcoords + 3*s));
+		}
+		float complex* CA = NULL;
+		float complex* CB = NULL;
+		float complex* fresult = NULL;
+		if (recip) {
+			CA = (float complex*) calloc(2L * nr * num_waves, sizeof(float complex));
+			CB = (float complex*) calloc(2L * proj_block * num_waves, sizeof(float complex));
+			fresult = (float complex*) malloc((long) proj_block * nr * sizeof(float complex));
+			CHECK_ALLOCATION(CA);
+			CHECK_ALLOCATION(CB);
+			CHECK_ALLOCATION(fresult);
 		}
-		overlap[w] += temp;
-		//overlap[2*w] = creal(temp);
-		//overlap[2*w+1]= cimag(temp);
-		//printf("temp 1 %lf %lf\n", creal(temp), cimag(temp));
 
-		temp = 0 + 0 * I;
-		for (int s = 0; s < num_N_R; s++) {
-			int site_num = N_R[s];
-			projection_t pron = band_R->projections[site_num];
-			projection_t ppron = band_S->wave_projections[s];
-			for (int i = 0; i < pron.total_projs; i++) {
-				temp += ppron.overlaps[i] * conj(pron.overlaps[i]);
+		for (int b = 0; b < nr; b++) {
+			band_t* band_R = kpt_R->bands[rstart + b];
+			double complex* row = A + (long) b * L;
+			int t = 0;
+			for (int s = 0; s < num_M; s++, t++) {
+				memcpy(row + offsets[t], band_R->projections[M_R[s]].overlaps,
+					(offsets[t+1] - offsets[t]) * sizeof(double complex));
+			}
+			for (int s = 0; s < num_N_R; s++, t++) {
+				memcpy(row + offsets[t], band_R->projections[N_R[s]].overlaps,
+					(offsets[t+1] - offsets[t]) * sizeof(double complex));
+			}
+			for (int s = 0; s < num_N_S; s++, t++) {
+				int tp = offsets[t+1] - offsets[t];
+				memcpy(row + offsets[t], ctx->wp_R[s]->overlaps
+					+ ((long) kpt_ind_R * NUM_BANDS + rstart + b) * tp,
+					tp * sizeof(double complex));
+			}
+			for (int s = 0; s < num_N_RS; s++, t++) {
+				memcpy(row + offsets[t], band_R->projections[N_RS_R[s]].overlaps,
+					(offsets[t+1] - offsets[t]) * sizeof(double complex));
+			}
+			if (recip) {
+				// [CA_b, C_b] . [C_j, CA_j] = <CA_b|C_j> + <C_b|CA_j>
+				float complex* crow = CA + 2L * b * num_waves;
+				if (ctx->CAs_R != NULL) {
+					memcpy(crow, ctx->CAs_R->CAs[kpt_ind_R * NUM_BANDS + rstart + b],
+						num_waves * sizeof(float complex));
+				}
+				memcpy(crow + num_waves, band_R->Cs, num_waves * sizeof(float complex));
 			}
 		}
-		overlap[w] += temp;
-		//overlap[2*w] += creal(temp);
-		//overlap[2*w+1]+= cimag(temp);
-		//printf("temp 2 %lf %lf\n", creal(temp), cimag(temp));
 
-		temp = 0 + 0 * I;
-		for (int s = 0; s < num_N_S; s++) {
-			int site_num = N_S[s];
-			projection_t pron = band_R->wave_projections[s];
-			projection_t ppron = band_S->projections[site_num];
-			for (int i = 0; i < ppron.total_projs; i++) {
-				temp += conj(pron.overlaps[i]) * ppron.overlaps[i];
+		for (int pstart = 0; pstart < num_bands; pstart += proj_block) {
+			int np = min(proj_block, num_bands - pstart);
+			for (int j = 0; j < np; j++) {
+				band_t* band_S = kpt_S->bands[bands[pstart + j]];
+				double complex* row = B + (long) j * L;
+				int t = 0;
+				for (int s = 0; s < num_M; s++, t++) {
+					int tp = offsets[t+1] - offsets[t];
+					double complex* Ds = D[ref_labels[M_R[s]]];
+					double complex* ps = band_S->projections[M_S[s]].overlaps;
+					for (int i = 0; i < tp; i++) {
+						double complex temp = 0;
+						for (int k = 0; k < tp; k++) {
+							temp += Ds[i*tp+k] * ps[k];
+						}
+						row[offsets[t] + i] = temp;
+					}
+				}
+				for (int s = 0; s < num_N_R; s++, t++) {
+					int tp = offsets[t+1] - offsets[t];
+					memcpy(row + offsets[t], ctx->wp_S[s]->overlaps
+						+ ((long) kpt_num * wf_S->nband + bands[pstart + j]) * tp,
+						tp * sizeof(double complex));
+				}
+				for (int s = 0; s < num_N_S; s++, t++) {
+					memcpy(row + offsets[t], band_S->projections[N_S[s]].overlaps,
+						(offsets[t+1] - offsets[t]) * sizeof(double complex));
+				}
+				for (int s = 0; s < num_N_RS; s++, t++) {
+					int tp = offsets[t+1] - offsets[t];
+					projection_t ppron = band_S->projections[N_RS_S[s]];
+					double complex* Os = ctx->overlaps[s];
+					for (int i = 0; i < tp; i++) {
+						double complex temp = 0;
+						for (int k = 0; k < ppron.total_projs; k++) {
+							temp += Os[i*ppron.total_projs+k] * ppron.overlaps[k];
+						}
+						row[offsets[t] + i] = temp * phases[s];
+					}
+				}
+				if (recip) {
+					float complex* crow = CB + 2L * j * num_waves;
+					memcpy(crow, band_S->Cs, num_waves * sizeof(float complex));
+					if (ctx->CAs_S != NULL) {
+						memcpy(crow + num_waves, ctx->CAs_S->CAs[kpt_num * wf_S->nband + bands[pstart + j]],
+							num_waves * sizeof(float complex));
+					} else {
+						memset(crow + num_waves, 0, num_waves * sizeof(float complex));
+					}
+				}
 			}
-		}
-		overlap[w] += temp;
-		//overlap[2*w] += creal(temp);
-		//overlap[2*w+1]+= cimag(temp);
-		//printf("temp 3 %d %d %d %lf %lf\n", kpt_S->num_waves, kpt_R->num_waves, w%NUM_KPTS, creal(temp), cimag(temp));
 
-		temp = 0 + 0 * I;
-		for (int s = 0; s < num_N_RS; s++) {
-			int site_num1 = N_RS_R[s];
-			int site_num2 = N_RS_S[s];
-			projection_t pron = band_R->projections[site_num1];
-			projection_t ppron = band_S->projections[site_num2];
-			for (int i = 0; i < pron.total_projs; i++) {
-				for (int j = 0; j < ppron.total_projs; j++) {
-					temp += conj(pron.overlaps[i])
-						* (N_RS_overlaps[s][i*ppron.total_projs+j])
-						* ppron.overlaps[j] * cexp(2*I*PI *
-						dot(kpt_R->k, wf_S->dcoords + 3*s));
+			// result[j][b] = <A_b|B_j>
+			if (L > 0) {
+				cblas_zgemm(CblasRowMajor, CblasNoTrans, CblasConjTrans,
+					np, nr, L, &one, B, L, A, L, &zero, result, nr);
+			} else {
+				memset(result, 0, (long) np * nr * sizeof(double complex));
+			}
+			if (recip) {
+				cblas_cgemm(CblasRowMajor, CblasNoTrans, CblasConjTrans,
+					np, nr, 2 * num_waves, &fone, CB, 2 * num_waves,
+					CA, 2 * num_waves, &fzero, fresult, nr);
+			}
+			for (int j = 0; j < np; j++) {
+				double complex* orow = overlap + (pstart + j) * row_size;
+				for (int b = 0; b < nr; b++) {
+					double complex temp = result[j * nr + b];
+					if (recip) temp += (double complex) fresult[j * nr + b];
+					orow[(rstart + b) * NUM_KPTS + kpt_num] += temp;
 				}
 			}
 		}
-		overlap[w] += temp;
-		//overlap[2*w] += creal(temp);
-		//overlap[2*w+1]+= cimag(temp);
+
+		free(phases);
+		free(A);
+		free(B);
+		free(result);
+		free(CA);
+		free(CB);
+		free(fresult);
 	}
+
+	for (int e = 0; e < wf_R->num_elems; e++) {
+		free(D[e]);
+	}
+	free(D);
+	free(offsets);
 }
 
-void compensation_terms_recip(double complex* overlap, int BAND_NUM, pswf_t* wf_S, pswf_t* wf_R,
+void compensation_terms_block(double complex* overlap, int num_bands, int* bands,
+	pswf_t* wf_S, pswf_t* wf_R, overlap_context_t* ctx,
 	int num_M, int num_N_R, int num_N_S, int num_N_RS,
 	int* M_R, int* M_S, int* N_R, int* N_S, int* N_RS_R, int* N_RS_S,
 	int* proj_labels, double* proj_coords, int* ref_labels, double* ref_coords,
 	int* fft_grid, int flip_spin) {
 
-	setbuf(stdout, NULL);
-	
-	int NUM_KPTS = wf_R->nwk * wf_R->nspin;
-	int NUM_BANDS = wf_R->nband;
-
-	//double* overlap = (double*) calloc(2 * NUM_KPTS * NUM_BANDS, sizeof(double));
-	CHECK_ALLOCATION(overlap);
-
-	double complex** N_RS_overlaps = wf_S->overlaps;
+	compensation_matrix(overlap, num_bands, bands, wf_S, wf_R, ctx,
+		num_M, num_N_R, num_N_S, num_N_RS, M_R, M_S, N_R, N_S, N_RS_R, N_RS_S,
+		proj_labels, ref_labels, flip_spin, 0);
+}
 
-#if defined(_OPENMP)
-	omp_set_num_threads(omp_get_max_threads());
-#endif
-	#pragma omp parallel for
-	for (int w = 0; w < NUM_BANDS * NUM_KPTS; w++) {
+void compensation_terms(double complex* overlap, int BAND_NUM, pswf_t* wf_S, pswf_t* wf_R,
+	overlap_context_t* ctx, int num_M, int num_N_R, int num_N_S, int num_N_RS,
+	int* M_R, int* M_S, int* N_R, int* N_S, int* N_RS_R, int* N_RS_S,
+	int* proj_labels, double* proj_coords, int* ref_labels, double* ref_coords,
+	int* fft_grid, int flip_spin) {
 
-		int ni = 0, nj = 0;
+	compensation_terms_block(overlap, 1, &BAND_NUM, wf_S, wf_R, ctx,
+		num_M, num_N_R, num_N_S, num_N_RS, M_R, M_S, N_R, N_S, N_RS_R, N_RS_S,
+		proj_labels, proj_coords, ref_labels, ref_coords, fft_grid, flip_spin);
+}
 
-		int kpt_ind_R = w%NUM_KPTS;
-		if (wf_R->nspin == 2 && flip_spin) {
-			if (kpt_ind_R < wf_R->nwk) {
-				kpt_ind_R += wf_R->nwk;
-			} else {
-				kpt_ind_R -= wf_R->nwk;
-			}
-		}
+void compensation_terms_recip_block(double complex* overlap, int num_bands, int* bands,
+	pswf_t* wf_S, pswf_t* wf_R, overlap_context_t* ctx,
+	int num_M, int num_N_R, int num_N_S, int num_N_RS,
+	int* M_R, int* M_S, int* N_R, int* N_S, int* N_RS_R, int* N_RS_S,
+	int* proj_labels, double* proj_coords, int* ref_labels, double* ref_coords,
+	int* fft_grid, int flip_spin) {
 
-		kpoint_t* kpt_R = wf_R->kpts[kpt_ind_R];
-		kpoint_t* kpt_S = wf_S->kpts[w%NUM_KPTS];
-		band_t* band_R = kpt_R->bands[w/NUM_KPTS];
-		band_t* band_S = kpt_S->bands[BAND_NUM];
-		float complex* C1s = NULL;
-		float complex* C2s = NULL;
-		float complex curr_overlap;
-		int num_waves;
-		
-		if (band_R->CAs != NULL) {
-			curr_overlap = 0;
-			C1s = band_S->Cs;
-			C2s = band_R->CAs;
-			num_waves = kpt_R->num_waves;
-			cblas_cdotc_sub(num_waves, C2s, 1, C1s, 1, &curr_overlap);
-			overlap[w] += (double complex) curr_overlap;
-		}
-
-		if (band_S->CAs != NULL) {
-			curr_overlap = 0;
-			C1s = band_S->CAs;
-			C2s = band_R->Cs;
-			num_waves = kpt_R->num_waves;
-			cblas_cdotc_sub(num_waves, C2s, 1, C1s, 1, &curr_overlap);
-			overlap[w] += (double complex) curr_overlap;
-		}
-		//printf("part 1 %d %d %d %lf %lf %f %f\n", BAND_NUM, w/NUM_KPTS, w%NUM_KPTS,
-		//	creal(overlap[w]), cimag(overlap[w]),
-		//	creal(curr_overlap), cimag(curr_overlap));
-
-		double complex temp = 0 + 0 * I;
-		for (int s = 0; s < num_M; s++) {
-			ppot_t pp = wf_R->pps[ref_labels[M_R[s]]];
-			int s1 = M_R[s];
-			int s2 = M_S[s];
-			projection_t pron = band_R->projections[s1];
-			projection_t ppron = band_S->projections[s2];
-
-			for (int i = 0; i < pron.total_projs; i++) {
-				for (int j = 0; j < ppron.total_projs; j++) {
-					if (pron.ls[i] == ppron.ls[j]  && pron.ms[i] == ppron.ms[j]) {
-						nj = ppron.ns[j];
-						ni = pron.ns[i];
-						temp += conj(pron.overlaps[i])
-							* (pp.aepw_overlap_matrix[pp.num_projs*ni+nj]
-							- pp.pspw_overlap_matrix[pp.num_projs*ni+nj])
-							* ppron.overlaps[j];
-					}
-				}
-			}
-		}
-		overlap[w] += temp;
-		//printf("part 2 %lf %lf\n", creal(overlap[w]), cimag(overlap[w]));
+	compensation_matrix(overlap, num_bands, bands, wf_S, wf_R, ctx,
+		num_M, num_N_R, num_N_S, num_N_RS, M_R, M_S, N_R, N_S, N_RS_R, N_RS_S,
+		proj_labels, ref_labels, flip_spin, 1);
+}
 
-		temp = 0 + 0 * I;
-		for (int s = 0; s < num_N_RS; s++) {
-			int site_num1 = N_RS_R[s];
-			int site_num2 = N_RS_S[s];
-			projection_t pron = band_R->projections[site_num1];
-			projection_t ppron = band_S->projections[site_num2];
-			for (int i = 0; i < pron.total_projs; i++) {
-				for (int j = 0; j < ppron.total_projs; j++) {
-					temp += conj(pron.overlaps[i])
-						* (N_RS_overlaps[s][i*ppron.total_projs+j])
-						* ppron.overlaps[j] * cexp(2*I*PI *
-						dot(kpt_R->k, wf_S->dcoords + 3*s));
-				}
-			}
-		}
-		overlap[w] += temp;
-		//printf("part 3 %lf %lf\n", creal(overlap[w]), cimag(overlap[w]));
-		//overlap[2*w] += creal(temp);
-		//overlap[2*w+1]+= cimag(temp);
-	}
+void compensation_terms_recip(double complex* overlap, int BAND_NUM, pswf_t* wf_S, pswf_t* wf_R,
+	overlap_context_t* ctx, int num_M, int num_N_R, int num_N_S, int num_N_RS,
+	int* M_R, int* M_S, int* N_R, int* N_S, int* N_RS_R, int* N_RS_S,
+	int* proj_labels, double* proj_coords, int* ref_labels, double* ref_coords,
+	int* fft_grid, int flip_spin) {
 
+	compensation_terms_recip_block(overlap, 1, &BAND_NUM, wf_S, wf_R, ctx,
+		num_M, num_N_R, num_N_S, num_N_RS, M_R, M_S, N_R, N_S, N_RS_R, N_RS_S,
+		proj_labels, proj_coords, ref_labels, ref_coords, fft_grid, flip_spin);
 }
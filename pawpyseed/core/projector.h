@@ -8,6 +8,24 @@ VASP for the onto_projector and projector_values evaluation.
 #define PROJECTOR_H
 #include "linalg.h"
 
+/**
+Data for projecting the bands of a wavefunction wf_S onto the bands of a
+basis wf_R, made by overlap_setup_real or overlap_setup_recip and used by
+compensation_terms. It is kept apart from both wavefunctions, so that one
+basis can be used by many Projectors at the same time.
+*/
+typedef struct overlap_context {
+	int num_N_R; ///< number of sites in N_R
+	int num_N_S; ///< number of sites in N_S
+	int num_N_RS; ///< number of site pairs in N_RS
+	wave_proj_cache_t** wp_R; ///< projections of wf_R onto the smooth partial waves of the N_S sites, or NULL
+	wave_proj_cache_t** wp_S; ///< projections of wf_S onto the smooth partial waves of the N_R sites, or NULL
+	aug_freqs_cache_t* CAs_R; ///< smooth partial waves of the N_R sites for the bands of wf_R, or NULL
+	aug_freqs_cache_t* CAs_S; ///< smooth partial waves of the N_S sites for the bands of wf_S, or NULL
+	double* dcoords; ///< path between the sites of each N_RS pair
+	double complex** overlaps; ///< overlaps of the partial waves of the sites of each N_RS pair
+} overlap_context_t;
+
 /**
 Returns a point to a list of ppot_t objects, one for each element in a POTCAR
 file. Called as a helper function by Wavefunction.make_c_projectors
@@ -15,6 +33,16 @@ file. Called as a helper function by Wavefunction.make_c_projectors
 ppot_t* get_projector_list(int num_els, int* labels, int* ls, double* wave_grids,
 	double* projectors, double* aewaves, double* pswaves, double* rmaxs, double grid_encut);
 
+/**
+Returns a list of num_els ppot_t objects, where element i is a copy of
+*pp_ptrs[i] that shares its radial data instead of recomputing it, so
+that several wavefunctions can use the same projector functions.
+free_ppot_list only frees the returned list, not the shared data,
+which must be freed with the list it was made in after every list
+sharing it has been freed.
+*/
+ppot_t* share_projector_list(ppot_t** pp_ptrs, int num_els);
+
 /**
 Finds the coordinates on the FFT grid that fall within each projection sphere
 and stores the values of the projectors at that those points, as well
@@ -33,15 +61,39 @@ objects, one for each site in the structure.
 real_proj_site_t* smooth_pw_values(int num_N, int* Nlst, int* labels, double* coords,
 	double* lattice, double* reclattice, ppot_t* pps, int* fftg);
 
+/**
+Allocates a projection_t list with one entry for each site in sites,
+with the n, l and m values of each projector filled in.
+*/
+projection_t* new_projection_list(real_proj_site_t* sites, int num_sites);
+
+/**
+Calls alloc_projection_block for wf with the projectors of pps at each
+site, where labels[s] is the element of site s, so that the projections
+of all bands are stored contiguously.
+*/
+void alloc_site_projection_block(pswf_t* wf, ppot_t* pps, int num_sites, int* labels);
+
 /**
 Helper function for onto_projector, which performs the FFT of the wavefunction
 into real space and calculates from <p_i|psit_nk> from the grid points found
-in projector_values.
+in projector_values. The entries of projections must already be allocated
+(see new_projection_list).
 */
 void onto_projector_helper(band_t* band, double complex* x, real_proj_site_t* sites,
     int num_sites, double* lattice, double* reclattice, double* kpt, int num_cart_gridpts,
     int* fftg, projection_t* projections);
 
+/**
+Same as onto_projector_helper, but for num_bands real space grids stored
+one after the other in x (see fft3d_batch). The phase factors at each
+grid point are shared by all of the grids. The projections of grid b
+are stored in projections[b].
+*/
+void onto_projector_helper_block(double complex* x, int num_bands,
+	projection_t** projections, real_proj_site_t* sites, int num_sites,
+	double* lattice, double* reclattice, double* kpt, int num_cart_gridpts, int* fftg);
+
 void get_aug_freqs_helper(band_t* band, double complex* x, real_proj_site_t* sites,
 	int num_sites, double* lattice, double* reclattice, double* kpt, int num_cart_gridpts,
 	int* fftg, projection_t* projections);
@@ -64,6 +116,47 @@ void onto_smoothpw(kpoint_t* kpt, int band_num, real_proj_site_t* sites, int num
 void get_aug_freqs(kpoint_t* kpt, int band_num, real_proj_site_t* sites, int num_sites,
 	int* G_bounds, double* lattice, double* reclattice, int num_cart_gridpts, int* fftg);
 
+/**
+Returns the number of bands at each k-point to process together with
+the *_block functions below, given the total number of bands and
+k-points (with spin) and the FFT grid. Blocks are small enough to
+keep the FFT buffer of each thread small (see fft_batch_size) and to
+leave several blocks for each thread.
+*/
+int band_block_size(int num_bands, int num_kpts, int* fftg);
+
+/**
+Same as onto_projector, but for bands band_start to
+band_start+num_bands-1 of kpt, which are transformed to real
+space with a single batched FFT.
+*/
+void onto_projector_block(kpoint_t* kpt, int band_start, int num_bands,
+	real_proj_site_t* sites, int num_sites, int* G_bounds, double* lattice,
+	double* reclattice, int num_cart_gridpts, int* fftg);
+
+/**
+Same as onto_projector_ncl, for a block of bands (see onto_projector_block).
+*/
+void onto_projector_ncl_block(kpoint_t* kpt, int band_start, int num_bands,
+	real_proj_site_t* sites, int num_sites, int* G_bounds, double* lattice,
+	double* reclattice, int num_cart_gridpts, int* fftg);
+
+/**
+Same as onto_smoothpw, for a block of bands (see onto_projector_block).
+*/
+void onto_smoothpw_block(kpoint_t* kpt, int band_start, int num_bands,
+	real_proj_site_t* sites, int num_sites, int* G_bounds, double* lattice,
+	double* reclattice, int num_cart_gridpts, int* fftg);
+
+/**
+Same as get_aug_freqs, for a block of bands (see onto_projector_block).
+The augmentation grids of the bands without CAs are transformed to
+reciprocal space with a single batched FFT.
+*/
+void get_aug_freqs_block(kpoint_t* kpt, int band_start, int num_bands,
+	real_proj_site_t* sites, int num_sites, int* G_bounds, double* lattice,
+	double* reclattice, int num_cart_gridpts, int* fftg);
+
 /**
 Calculates the maximum number of grid points that can be contained within the projector
 sphere of pp_ptr given the lattice and fftg (FFT grid dimensions, 3D vector of int),
@@ -77,12 +170,76 @@ for all onsite i and j for the element represented by pp_ptr.
 */
 void make_pwave_overlap_matrices(ppot_t* pp_ptr);
 
+/**
+Attaches the projector list pps to wf without evaluating any projections,
+e.g. for a wavefunction whose projections were read from a snapshot.
+Sets wf->pps, wf->num_elems, wf->num_sites and wf->fftg,
+and the real-space grid sizes of each element.
+Returns the largest num_cart_gridpts of the elements.
+*/
+int set_projector_list(pswf_t* wf, ppot_t* pps, int num_elems,
+	int num_sites, int* fftg);
+
+/**
+Sets up wf to evaluate <p_i|psit_nk> on demand with evaluate_projections,
+without evaluating any projections yet. The projector list pps is attached
+to wf (see set_projector_list), and the projections of all bands are
+allocated. If recip is 1, projections are evaluated in reciprocal space
+(see setup_projections_recip), otherwise in real space. The real space
+projector values at each site are set up when they are first needed
+and kept in wf until it is freed, unless they do not fit in the
+memory budget (see set_projector_memory_budget). Projections that are
+already stored in wf (e.g. read from a snapshot) are marked as evaluated.
+*/
+void init_projections(pswf_t* wf, ppot_t* pps, int num_elems,
+	int num_sites, int* fftg, int* labels, double* coords, int recip);
+
+/**
+Evaluates <p_i|psit_nk> for bands band_start to band_start+num_bands-1
+of wf->kpts[kpt_num], skipping bands that have already been evaluated.
+init_projections must be called first.
+*/
+void evaluate_projections(pswf_t* wf, int kpt_num, int band_start, int num_bands);
+
+/**
+Sets the maximum number of bytes used for the real space projector values
+of the sites of a wavefunction when evaluating its projections. If the values
+at every site do not fit, they are set up for one block of sites at a time,
+and each band is transformed to real space once for each block. A budget
+of zero or less means no limit. The default is 2 GB.
+*/
+void set_projector_memory_budget(long num_bytes);
+
+/**
+Returns the memory budget set by set_projector_memory_budget.
+*/
+long get_projector_memory_budget(void);
+
+/**
+Evaluates <p_i|psit_nk> for all bands and kpoints of wf that have not been
+evaluated yet. init_projections must be called first.
+*/
+void evaluate_all_projections(pswf_t* wf);
+
 /**
 Evaluates <p_i|psit_nk> for all bands and kpoints of wf.
+Same as init_projections followed by evaluate_all_projections.
 */
 void setup_projections(pswf_t* wf, ppot_t* pps, int num_elems,
 	int num_sites, int* fftg, int* labels, double* coords);
 
+/**
+Same as setup_projections, but evaluates <p_i|psit_nk> in reciprocal
+space, like VASP with LREAL=.FALSE. For each k-point, the reciprocal
+space projectors p_i(k+G) of every site are tabulated from the
+kproj functions of pps, and the projections of all bands are
+calculated as a matrix product with the plane wave coefficients.
+No FFTs or real space projector values are needed.
+Same as init_projections with recip=1 followed by evaluate_all_projections.
+*/
+void setup_projections_recip(pswf_t* wf, ppot_t* pps, int num_elems,
+	int num_sites, int* fftg, int* labels, double* coords);
+
 /**
 Much more efficient version of overlap_setup.
 Calculates three overlap terms for when bands have different
@@ -90,21 +247,35 @@ structures:
 <(phi1_i-phit1_i)|psit2_n2k>
 <(phi2_i-phit2_i)|psit1_n1k>
 <(phi1_i-phit1_i)|(phi2_i-phit2_i)>
+and returns them in a new overlap_context_t, which must be freed with
+free_overlap_context. The projections onto the partial waves of each site
+are cached on wf_R and wf_S, so setups that share sites reuse them.
 */
-void overlap_setup_real(pswf_t* wf_R, pswf_t* wf_S,
+overlap_context_t* overlap_setup_real(pswf_t* wf_R, pswf_t* wf_S,
 	int* labels_R, int* labels_S, double* coords_R, double* coords_S,
 	int* N_R, int* N_S, int* N_RS_R, int* N_RS_S, int num_N_R, int num_N_S, int num_N_RS);
 
-void overlap_setup_recip(pswf_t* wf_R, pswf_t* wf_S,
+/**
+Same as overlap_setup_real, but for the 'aug_recip' method, in which the
+partial waves of the N_R and N_S sites are Fourier transformed.
+*/
+overlap_context_t* overlap_setup_recip(pswf_t* wf_R, pswf_t* wf_S,
 	int* labels_R, int* labels_S, double* coords_R, double* coords_S,
 	int* N_R, int* N_S, int* N_RS_R, int* N_RS_S, int num_N_R, int num_N_S, int num_N_RS);
 
+/**
+Frees an overlap_context_t and releases its entries of the
+caches of the wavefunctions it was set up for.
+*/
+void free_overlap_context(overlap_context_t* ctx);
+
 /**
 Calculates the components of the overlap operator in the augmentation
 regions of each ion in the lattice, using the 'aug_real' method.
+ctx must have been made by overlap_setup_real for wf_R and wf_S.
 */
 void compensation_terms(double complex* overlap, int BAND_NUM, pswf_t* wf_S, pswf_t* wf_R,
-	int num_M, int num_N_R, int num_N_S, int num_N_RS,
+	overlap_context_t* ctx, int num_M, int num_N_R, int num_N_S, int num_N_RS,
 	int* M_R, int* M_S, int* N_R, int* N_S, int* N_RS_R, int* N_RS_S,
 	int* proj_labels, double* proj_coords, int* ref_labels, double* ref_coords,
 	int* fft_grid, int spin_flip);
@@ -112,13 +283,37 @@ void compensation_terms(double complex* overlap, int BAND_NUM, pswf_t* wf_S, psw
 /**
 Calculates the components of the overlap operator in the augmentation
 regions of each ion in the lattice, using the 'aug_recip' method.
+ctx must have been made by overlap_setup_recip for wf_R and wf_S.
 */
 void compensation_terms_recip(double complex* overlap, int BAND_NUM, pswf_t* wf_S, pswf_t* wf_R,
-	int num_M, int num_N_R, int num_N_S, int num_N_RS,
+	overlap_context_t* ctx, int num_M, int num_N_R, int num_N_S, int num_N_RS,
 	int* M_R, int* M_S, int* N_R, int* N_S, int* N_RS_R, int* N_RS_S,
 	int* proj_labels, double* proj_coords, int* ref_labels, double* ref_coords,
 	int* fft_grid, int spin_flip);
 
+/**
+Same as compensation_terms, but for the num_bands bands of wf_S listed in bands.
+The terms for bands[i] are added to overlap[i*nband*nwk*nspin], in the same
+format as pseudoprojection_matrix.
+*/
+void compensation_terms_block(double complex* overlap, int num_bands, int* bands,
+	pswf_t* wf_S, pswf_t* wf_R, overlap_context_t* ctx,
+	int num_M, int num_N_R, int num_N_S, int num_N_RS,
+	int* M_R, int* M_S, int* N_R, int* N_S, int* N_RS_R, int* N_RS_S,
+	int* proj_labels, double* proj_coords, int* ref_labels, double* ref_coords,
+	int* fft_grid, int flip_spin);
+
+/**
+Same as compensation_terms_recip, for the bands of wf_S listed in bands
+(see compensation_terms_block).
+*/
+void compensation_terms_recip_block(double complex* overlap, int num_bands, int* bands,
+	pswf_t* wf_S, pswf_t* wf_R, overlap_context_t* ctx,
+	int num_M, int num_N_R, int num_N_S, int num_N_RS,
+	int* M_R, int* M_S, int* N_R, int* N_S, int* N_RS_R, int* N_RS_S,
+	int* proj_labels, double* proj_coords, int* ref_labels, double* ref_coords,
+	int* fft_grid, int flip_spin);
+
 /**
 ###DEPRECATED###
 O(N^2) spherical Bessel transform
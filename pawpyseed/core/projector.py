@@ -7,6 +7,7 @@
 from pawpyseed.core.wavefunction import *
 from pawpyseed.core import pawpyc
 from pawpyseed.core.pawpyc import Timer
+from scipy.spatial import cKDTree
 import warnings
 
 class Projector(pawpyc.CProjector):
@@ -116,6 +117,9 @@ class Projector(pawpyc.CProjector):
 		site indices, and N_RS contains pairs of indices in R and S with overlapping augmentation
 		spheres in the PAW formalism. R si for self.basis, S is for self.wf
 
+		The site pairs are found with a KD-tree over the periodic images
+		of the sites of S, so this scales as O(N log N) with the number of sites.
+
 		Returns:
 			M_R (numpy array): Indices of sites in basis which have an identical site in
 				S (self) (same element and position to within tolerance of 0.02 Angstroms).
@@ -124,34 +128,55 @@ class Projector(pawpyc.CProjector):
 			N_R (numpy array): Indices of sites in basis but not in M_R
 			N_S (numpy array): Indices of sites in self but not in M_S
 			N_RS (numpy array): Pairs of indices (one in basis and one in self) which
-				are not identical but have overlapping augmentation regions
+				are not identical but have overlapping augmentation regions,
+				with shape (number of pairs, 2)
 		"""
 
-		ref_sites = self.basis.structure.sites
-		sites = self.wf.structure.sites
-		M_R = []
-		M_S = []
-		for i in range(len(ref_sites)):
-			for j in range(len(sites)):
-				if ref_sites[i].distance(sites[j]) <= 0.02 and el(ref_sites[i]) == el(sites[j]):
-					M_R.append(i)
-					M_S.append(j)
-		N_R = []
-		N_S = []
-		for i in range(len(ref_sites)):
-			if not i in M_R:
-				N_R.append(i)
-		for j in range(len(sites)):
-			if (not j in N_S) and (not j in M_S):
-				N_S.append(j)
-		
-		N_RS = []
-		for i in N_R:
-			for j in N_S:
-				rmax1 = self.basis.cr.pps[el(ref_sites[i])].rmax
-				rmax2 = self.wf.cr.pps[el(sites[i])].rmax
-				if ref_sites[i].distance(sites[j]) < rmax1 + rmax2:
-					N_RS.append((i,j))
+		ref_structure = self.basis.structure
+		structure = self.wf.structure
+		lattice = ref_structure.lattice
+		ref_els = [el(site) for site in ref_structure]
+		els = [el(site) for site in structure]
+		ref_rmax = np.array([self.basis.cr.pps[e].rmax for e in ref_els])
+		rmax = np.array([self.wf.cr.pps[e].rmax for e in els])
+		ref_els = np.array(ref_els)
+		els = np.array(els)
+		num_R, num_S = len(ref_els), len(els)
+		cutoff = max(ref_rmax.max() + rmax.max(), 0.02)
+
+		# periodic images of the sites of S that can be within cutoff
+		# of a site of R, given that all fractional coordinates are in [0,1)
+		widths = 1 / np.linalg.norm(lattice.inv_matrix, axis=0)
+		nimg = np.ceil(cutoff / widths).astype(int)
+		images = np.array(np.meshgrid(*[np.arange(-n, n+1) for n in nimg],
+			indexing='ij')).reshape(3, -1).T
+		ref_frac = ref_structure.frac_coords % 1.0
+		frac = structure.frac_coords % 1.0
+		image_frac = (frac[np.newaxis,:,:] + images[:,np.newaxis,:]).reshape(-1, 3)
+		ref_tree = cKDTree(lattice.get_cartesian_coords(ref_frac))
+		tree = cKDTree(lattice.get_cartesian_coords(image_frac))
+		pairs = ref_tree.sparse_distance_matrix(tree, cutoff, output_type='ndarray')
+		R_inds = pairs['i'].astype(np.int32)
+		S_inds = (pairs['j'] % num_S).astype(np.int32)
+		dists = pairs['v']
+
+		# keep the shortest distance between each pair of sites,
+		# ordered by the index in R and then by the index in S
+		order = np.lexsort((dists, S_inds, R_inds))
+		R_inds, S_inds, dists = R_inds[order], S_inds[order], dists[order]
+		first = np.ones(len(order), dtype=bool)
+		first[1:] = (R_inds[1:] != R_inds[:-1]) | (S_inds[1:] != S_inds[:-1])
+		R_inds, S_inds, dists = R_inds[first], S_inds[first], dists[first]
+
+		same = (dists <= 0.02) & (ref_els[R_inds] == els[S_inds])
+		M_R = R_inds[same]
+		M_S = S_inds[same]
+		N_R = np.setdiff1d(np.arange(num_R, dtype=np.int32), M_R)
+		N_S = np.setdiff1d(np.arange(num_S, dtype=np.int32), M_S)
+
+		overlapping = np.isin(R_inds, N_R) & np.isin(S_inds, N_S)\
+			& (dists < ref_rmax[R_inds] + rmax[S_inds])
+		N_RS = np.stack((R_inds[overlapping], S_inds[overlapping]), axis=-1)
 		return M_R, M_S, N_R, N_S, N_RS
 
 	def setup_overlap(self):
@@ -161,11 +186,8 @@ class Projector(pawpyc.CProjector):
 		when needed
 		"""
 		M_R, M_S, N_R, N_S, N_RS = self.make_site_lists()
-		num_N_RS = len(N_RS)
-		if num_N_RS > 0:
-			N_RS_R, N_RS_S = zip(*N_RS)
-		else:
-			N_RS_R, N_RS_S = [], []
+		N_RS = np.array(N_RS, dtype=np.int32).reshape(-1, 2)
+		N_RS_R, N_RS_S = N_RS[:,0], N_RS[:,1]
 		self.site_cat = [M_R, M_S, N_R, N_S, N_RS_R, N_RS_S]
 		start = time.monotonic()
 		if self.method == "aug_recip":
@@ -263,6 +285,55 @@ class Projector(pawpyc.CProjector):
 			raise ValueError("Band index out of range (0-indexed)")
 		return self._single_band_projection(band_num, **kwargs)
 
+	def overlap_matrix(self, bands = None, flip_spin = False):
+		"""
+		Projection of several bands of self onto all the bands of basis.
+		For each k-point and spin, the pseudo wavefunction overlaps of
+		all the bands are calculated as one matrix product of the
+		plane wave coefficients, and the augmentation terms of all the
+		bands are added together, which is much faster than calling
+		single_band_projection for each band.
+
+		Arguments:
+			bands (list of int, None): bands of self to project onto basis.
+				If None, all bands of self are projected.
+			flip_spin (bool, False): For method=='aug_*', swap the spins
+				of basis for the projection (see single_band_projection)
+
+		Returns:
+			(np.array): array of shape (len(bands), basis.nband * nwk * nspin),
+				where row i is single_band_projection(bands[i])
+
+		Example:
+			# Get overlap of band bands[i], k-point k, spin s (0 or 1 index)
+			# of wf with band b, k-point k, spin s of basis
+			>>> pr = Projector(wf, basis)
+			>>> res = pr.overlap_matrix(bands)
+			>>> print(res[i, b*pr.nwk*pr.nspin + s*pr.nwk + k])
+		"""
+		if bands is None:
+			bands = range(self.wf.nband)
+		bands = np.array(bands, dtype=np.int32).reshape(-1)
+		if np.any(bands >= self.wf.nband) or np.any(bands < 0):
+			raise ValueError("Band index out of range (0-indexed)")
+		if self.method == "realspace" or len(bands) == 0:
+			res = np.zeros((len(bands), self.basis.nband * self.basis.nwk * self.basis.nspin),
+				dtype=np.complex128)
+			for i, b in enumerate(bands):
+				res[i] = self._single_band_projection(b)
+			return res
+		if self.method == "pseudo":
+			return self.wf.pseudoprojection_matrix(bands, self.basis)
+		res = self.wf.pseudoprojection_matrix(bands, self.basis, flip_spin)
+		start = time.monotonic()
+		if self.method == "aug_real":
+			self._add_augmentation_terms_block(res, bands, flip_spin)
+		else:
+			self._projection_recip_block(res, bands, flip_spin)
+		end = time.monotonic()
+		Timer.augmentation_time(end-start)
+		return res
+
 	@staticmethod
 	def setup_bases(basis_dirs, desymmetrize = True,
 		atomate_compatible = True):
@@ -443,6 +514,10 @@ class Projector(pawpyc.CProjector):
 			analyze_all (bool, False): If True, overrides num_below_ef,
 				num_above_ef, vbmband, and band_list. Whether to perform
 				analysis on all bands in wf
+
+		If only a range of bands of wf was read (see Wavefunction.from_files),
+		vbmband, band_list and the band labels of the results are WAVECAR
+		band indices, i.e. they are offset by wf.band_start.
 		"""
 		if num_below_ef < 0 or num_above_ef < 0:
 			raise ValueError("num_above_ef and num_below_ef must both be nonnegative.")
@@ -452,26 +527,28 @@ class Projector(pawpyc.CProjector):
 		nwk = basis.nwk
 		nspin = basis.nspin
 		occs = self.wf._get_occs()
+		start = self.wf.band_start
 		
 		if analyze_all:
 			totest = [i for i in range(nband)]
 		elif band_list:
-			totest = band_list[:]
+			totest = [b - start for b in band_list]
 		else:
 			vbm = 0
 			for i in range(self.wf.nband):
 				if occs[i*self.wf.nwk*self.wf.nspin] > 0.5:
 					vbm = i
 			if vbmband != None:
-				vbm = vbmband
+				vbm = vbmband - start
 			min_band, max_band = max(vbm - num_below_ef, 0), min(vbm + num_above_ef, self.wf.nband - 1)
 			totest = [i for i in range(min_band,max_band+1)]
 
 		results = {}
 		for b in totest:
-			results[b] = self.proportion_conduction(b, spinpol = spinpol)
+			results[b + start] = self.proportion_conduction(b, spinpol = spinpol)
 
 		if return_energies:
-			return results, self.wf._get_energy_list(totest)
+			energies = self.wf._get_energy_list(totest)
+			return results, {b + start : energies[b] for b in totest}
 		else:
 			return results
@@ -1,11 +1,15 @@
 #include <stdio.h>
 #include <stdlib.h>
+#include <string.h>
 #include <complex.h>
 #include <math.h>
 #include <omp.h>
 #include <time.h>
 #include "pseudoprojector.h"
 #include "utils.h"
+#include <mkl.h>
+
+#define PSEUDO_BLOCK_BYTES (16L << 20)
 
 void vc_pseudoprojection(pswf_t* wf_ref, pswf_t* wf_proj, int BAND_NUM, double* results) {
 
@@ -92,3 +96,79 @@ void pseudoprojection(double complex* projections, pswf_t* wf_ref, pswf_t* wf_pr
 		}
 	}
 }
+
+void pseudoprojection_matrix(double complex* projections, pswf_t* wf_ref, pswf_t* wf_proj,
+	int num_bands, int* bands, int flip_spin) {
+
+	int NUM_KPTS = wf_ref->nwk * wf_ref->nspin;
+	int NUM_BANDS = wf_ref->nband;
+	long row_size = (long) NUM_BANDS * NUM_KPTS;
+
+	int max_waves = 1;
+	for (int kpt_num = 0; kpt_num < NUM_KPTS; kpt_num++) {
+		max_waves = max(max_waves, wf_proj->kpts[kpt_num]->num_waves);
+	}
+	// blocks of bands of wf_ref and wf_proj are copied to contiguous
+	// coefficient matrices, so that the overlaps of each pair of blocks
+	// are one matrix product. wf_ref is split into enough blocks to
+	// give each thread at least one (k-point, block) pair.
+	int block = max(1, PSEUDO_BLOCK_BYTES / ((long) max_waves * sizeof(float complex)));
+	int proj_block = min(block, num_bands);
+	int ref_block = min(block, NUM_BANDS);
+	ref_block = max(1, min(ref_block, (int) (row_size / omp_get_max_threads())));
+	int num_ref_blocks = (NUM_BANDS + ref_block - 1) / ref_block;
+	float complex one = 1;
+	float complex zero = 0;
+
+	#pragma omp parallel for schedule(dynamic)
+	for (int w = 0; w < NUM_KPTS * num_ref_blocks; w++) {
+		int kpt_num = w % NUM_KPTS;
+		int rstart = (w / NUM_KPTS) * ref_block;
+		int nr = min(ref_block, NUM_BANDS - rstart);
+		int kpt_ind_p = kpt_num;
+		if (wf_ref->nspin == 2 && flip_spin) {
+			if (kpt_ind_p < wf_ref->nwk) {
+				kpt_ind_p += wf_ref->nwk;
+			} else {
+				kpt_ind_p -= wf_ref->nwk;
+			}
+		}
+		kpoint_t* kpt_ref = wf_ref->kpts[kpt_ind_p];
+		kpoint_t* kpt_proj = wf_proj->kpts[kpt_num];
+		int num_waves = kpt_proj->num_waves;
+
+		float complex* C_ref = (float complex*) mkl_malloc(
+			(long) nr * num_waves * sizeof(float complex), 64);
+		float complex* C_proj = (float complex*) mkl_malloc(
+			(long) proj_block * num_waves * sizeof(float complex), 64);
+		float complex* result = (float complex*) mkl_malloc(
+			(long) proj_block * nr * sizeof(float complex), 64);
+		CHECK_ALLOCATION(C_ref);
+		CHECK_ALLOCATION(C_proj);
+		CHECK_ALLOCATION(result);
+		for (int b = 0; b < nr; b++) {
+			memcpy(C_ref + (long) b * num_waves, kpt_ref->bands[rstart + b]->Cs,
+				num_waves * sizeof(float complex));
+		}
+		for (int pstart = 0; pstart < num_bands; pstart += proj_block) {
+			int np = min(proj_block, num_bands - pstart);
+			for (int j = 0; j < np; j++) {
+				memcpy(C_proj + (long) j * num_waves, kpt_proj->bands[bands[pstart + j]]->Cs,
+					num_waves * sizeof(float complex));
+			}
+			// result[j][b] = <ref_b|proj_j>
+			cblas_cgemm(CblasRowMajor, CblasNoTrans, CblasConjTrans,
+				np, nr, num_waves, &one, C_proj, num_waves,
+				C_ref, num_waves, &zero, result, nr);
+			for (int j = 0; j < np; j++) {
+				double complex* row = projections + (pstart + j) * row_size;
+				for (int b = 0; b < nr; b++) {
+					row[(rstart + b) * NUM_KPTS + kpt_num] = result[j * nr + b];
+				}
+			}
+		}
+		mkl_free(C_ref);
+		mkl_free(C_proj);
+		mkl_free(result);
+	}
+}
@@ -25,4 +25,14 @@ loop over bands
 void pseudoprojection(double complex* projections, pswf_t* wf_ref, pswf_t* wf_proj, int BAND_NUM,
 						int flip_spin);
 
+/**
+Same as pseudoprojection, but for the num_bands bands of wf_proj listed in bands.
+For each kpoint and spin, the overlaps of all of these bands with all bands
+of wf_ref are calculated with a single matrix product of the plane wave
+coefficients. The result for bands[i] is stored in
+projections[i*nband*nwk*nspin], in the same format as pseudoprojection.
+*/
+void pseudoprojection_matrix(double complex* projections, pswf_t* wf_ref, pswf_t* wf_proj,
+	int num_bands, int* bands, int flip_spin);
+
 #endif
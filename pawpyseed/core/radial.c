@@ -1,5 +1,6 @@
 #include <stdio.h>
 #include <stdlib.h>
+#include <string.h>
 #include <complex.h>
 #include <math.h>
 #include <omp.h>
@@ -10,6 +11,7 @@
 
 #define PI 3.14159265358979323846
 #define KGRID_SIZE 500
+#define OFFSITE_TABLE_SPACING 0.01
 
 double complex offsite_wave_overlap(double* dcoord,
 	double* r1, double* f1, double** spline1, int size1,
@@ -178,6 +180,287 @@ double complex reciprocal_offsite_wave_overlap(double* dcoord,
 	return total;
 }
 
+/*
+Radial integrals
+integral[f1_j(k) f2_k(k) k^2 j_L(kR) dk]
+of each pair of partial wave functions (kwave) j of one element and k of
+another, for each L with |l1-l2| <= L <= l1+l2 and L+l1+l2 even, which
+are all that reciprocal_offsite_wave_overlap needs apart from angular factors.
+They are tabulated against R = |dcoord| up to the sum of the radii of the
+elements and interpolated with cubic splines. Tables are cached for each
+pair of elements until free_offsite_tables is called for one of them.
+*/
+typedef struct offsite_table {
+	funcset_t* funcs1; ///< radial data of the first element
+	funcset_t* funcs2; ///< radial data of the second element
+	int num_projs1; ///< number of radial functions of the first element
+	int num_projs2; ///< number of radial functions of the second element
+	int num_lterms; ///< maximum number of L values of a pair of functions
+	double* weights; ///< [num_projs1*num_projs2][KGRID_SIZE] quadrature weights times f1*f2*k^2
+	double* kgrid; ///< logarithmic k grid of the integrals
+	int size; ///< number of R grid points
+	double* values; ///< [num_projs1*num_projs2*num_lterms][size] radial integrals
+	double* splines; ///< [num_projs1*num_projs2*num_lterms][3][size] spline coefficients
+	struct offsite_table* next; ///< next table in the cache
+} offsite_table_t;
+
+static offsite_table_t* offsite_tables = NULL;
+
+/*
+Stores in integrals[(j*num_projs2+k)*num_lterms+(L-|l1-l2|)/2]
+the radial integrals of table at R.
+*/
+static void offsite_radial_integrals(offsite_table_t* table, double R, double* integrals) {
+	double* sbfs = (double*) malloc(KGRID_SIZE * sizeof(double));
+	CHECK_ALLOCATION(sbfs);
+	int lmax = 0;
+	for (int j = 0; j < table->num_projs1; j++) {
+		for (int k = 0; k < table->num_projs2; k++) {
+			lmax = max(lmax, table->funcs1[j].l + table->funcs2[k].l);
+		}
+	}
+	for (int L = 0; L <= lmax; L++) {
+		for (int n = 0; n < KGRID_SIZE; n++) {
+			sbfs[n] = sbf(table->kgrid[n] * R, L);
+		}
+		for (int j = 0; j < table->num_projs1; j++) {
+			int l1 = table->funcs1[j].l;
+			for (int k = 0; k < table->num_projs2; k++) {
+				int l2 = table->funcs2[k].l;
+				if (L < abs(l1-l2) || L > l1+l2 || (L+l1+l2) % 2) continue;
+				int p = j * table->num_projs2 + k;
+				double* w = table->weights + (long) p * KGRID_SIZE;
+				double integral = 0;
+				for (int n = 0; n < KGRID_SIZE; n++) {
+					integral += w[n] * sbfs[n];
+				}
+				integrals[p * table->num_lterms + (L-abs(l1-l2))/2] = integral;
+			}
+		}
+	}
+	free(sbfs);
+}
+
+static offsite_table_t* make_offsite_table(ppot_t* pp1, ppot_t* pp2) {
+	offsite_table_t* table = (offsite_table_t*) malloc(sizeof(offsite_table_t));
+	CHECK_ALLOCATION(table);
+	table->funcs1 = pp1->funcs;
+	table->funcs2 = pp2->funcs;
+	table->num_projs1 = pp1->num_projs;
+	table->num_projs2 = pp2->num_projs;
+	table->num_lterms = 1;
+	for (int j = 0; j < pp1->num_projs; j++) {
+		for (int k = 0; k < pp2->num_projs; k++) {
+			table->num_lterms = max(table->num_lterms,
+				min(pp1->funcs[j].l, pp2->funcs[k].l) + 1);
+		}
+	}
+	int num_pairs = pp1->num_projs * pp2->num_projs;
+	int num_integrals = num_pairs * table->num_lterms;
+
+	// same logarithmic grid as reciprocal_offsite_wave_overlap
+	double* k1 = pp1->kwave_grid;
+	double* k2 = pp2->kwave_grid;
+	double kmax = fmin(k1[pp1->wave_gridsize-1], k2[pp2->wave_gridsize-1]);
+	double kmin = fmax(k1[0], k2[0]);
+	table->kgrid = (double*) malloc(KGRID_SIZE * sizeof(double));
+	CHECK_ALLOCATION(table->kgrid);
+	for (int n = 0; n < KGRID_SIZE; n++) {
+		table->kgrid[n] = kmin * pow(kmax/kmin, (double) n / KGRID_SIZE);
+	}
+
+	// spline_integral is linear in the function values, so it is
+	// the same as a weighted sum of them
+	double* quad = (double*) malloc(KGRID_SIZE * sizeof(double));
+	double* unit = (double*) calloc(KGRID_SIZE, sizeof(double));
+	CHECK_ALLOCATION(quad);
+	CHECK_ALLOCATION(unit);
+	for (int n = 0; n < KGRID_SIZE; n++) {
+		unit[n] = 1;
+		double** spline = spline_coeff(table->kgrid, unit, KGRID_SIZE);
+		quad[n] = spline_integral(table->kgrid, unit, spline, KGRID_SIZE);
+		free(spline[0]);
+		free(spline[1]);
+		free(spline[2]);
+		free(spline);
+		unit[n] = 0;
+	}
+	table->weights = (double*) malloc((long) num_pairs * KGRID_SIZE * sizeof(double));
+	CHECK_ALLOCATION(table->weights);
+	for (int j = 0; j < pp1->num_projs; j++) {
+		for (int k = 0; k < pp2->num_projs; k++) {
+			double* w = table->weights + (long) (j * pp2->num_projs + k) * KGRID_SIZE;
+			for (int n = 0; n < KGRID_SIZE; n++) {
+				double kk = table->kgrid[n];
+				w[n] = quad[n] * kk * kk
+					* wave_interpolate(kk, pp1->wave_gridsize, k1,
+						pp1->funcs[j].kwave, pp1->funcs[j].kwave_spline)
+					* wave_interpolate(kk, pp2->wave_gridsize, k2,
+						pp2->funcs[k].kwave, pp2->funcs[k].kwave_spline);
+			}
+		}
+	}
+	free(quad);
+	free(unit);
+
+	double rmax = fmax(pp1->rmax, pp1->wave_rmax) + fmax(pp2->rmax, pp2->wave_rmax);
+	table->size = (int) (rmax / OFFSITE_TABLE_SPACING) + 2;
+	int size = table->size;
+	double* rgrid = (double*) malloc(size * sizeof(double));
+	double* columns = (double*) malloc((long) size * num_integrals * sizeof(double));
+	table->values = (double*) calloc((long) num_integrals * size, sizeof(double));
+	table->splines = (double*) malloc(3L * num_integrals * size * sizeof(double));
+	CHECK_ALLOCATION(rgrid);
+	CHECK_ALLOCATION(columns);
+	CHECK_ALLOCATION(table->values);
+	CHECK_ALLOCATION(table->splines);
+	for (int i = 0; i < size; i++) {
+		rgrid[i] = i * OFFSITE_TABLE_SPACING;
+	}
+	#pragma omp parallel for
+	for (int i = 0; i < size; i++) {
+		double* col = columns + (long) i * num_integrals;
+		for (int p = 0; p < num_integrals; p++) {
+			col[p] = 0;
+		}
+		offsite_radial_integrals(table, rgrid[i], col);
+	}
+	for (int p = 0; p < num_integrals; p++) {
+		double* vals = table->values + (long) p * size;
+		for (int i = 0; i < size; i++) {
+			vals[i] = columns[(long) i * num_integrals + p];
+		}
+		double** spline = spline_coeff(rgrid, vals, size);
+		for (int d = 0; d < 3; d++) {
+			memcpy(table->splines + (3L * p + d) * size, spline[d], size * sizeof(double));
+			free(spline[d]);
+		}
+		free(spline);
+	}
+	free(rgrid);
+	free(columns);
+	table->next = NULL;
+	return table;
+}
+
+/*
+Returns the cached table of radial integrals of pp1 and pp2,
+making it first if there is none.
+*/
+static offsite_table_t* get_offsite_table(ppot_t* pp1, ppot_t* pp2) {
+	offsite_table_t* table = NULL;
+	#pragma omp critical(offsite_tables)
+	{
+		table = offsite_tables;
+		while (table != NULL && (table->funcs1 != pp1->funcs || table->funcs2 != pp2->funcs)) {
+			table = table->next;
+		}
+		if (table == NULL) {
+			table = make_offsite_table(pp1, pp2);
+			table->next = offsite_tables;
+			offsite_tables = table;
+		}
+	}
+	return table;
+}
+
+void free_offsite_tables(funcset_t* funcs) {
+	#pragma omp critical(offsite_tables)
+	{
+		offsite_table_t** table_ptr = &offsite_tables;
+		while (*table_ptr != NULL) {
+			offsite_table_t* table = *table_ptr;
+			if (funcs == NULL || table->funcs1 == funcs || table->funcs2 == funcs) {
+				*table_ptr = table->next;
+				free(table->weights);
+				free(table->kgrid);
+				free(table->values);
+				free(table->splines);
+				free(table);
+			} else {
+				table_ptr = &(table->next);
+			}
+		}
+	}
+}
+
+void reciprocal_offsite_overlap_matrix(double complex* overlaps, double* dcoord,
+	ppot_t* pp1, ppot_t* pp2) {
+
+	offsite_table_t* table = get_offsite_table(pp1, pp2);
+	int num_lterms = table->num_lterms;
+	int num_integrals = pp1->num_projs * pp2->num_projs * num_lterms;
+
+	double theta = 0, phi = 0;
+	double R = mag(dcoord);
+	if (R < 10e-12) {
+		theta = 0;
+		phi = 0;
+		R = 0;
+	} else {
+		theta = acos(dcoord[2]/R);
+		if (R - fabs(dcoord[2]) < 10e-12) phi = 0;
+		else phi = acos(dcoord[0] / pow(dcoord[0]*dcoord[0] + dcoord[1]*dcoord[1], 0.5));
+		if (dcoord[1] < 0) phi = 2*PI - phi;
+	}
+
+	double* integrals = (double*) calloc(num_integrals, sizeof(double));
+	CHECK_ALLOCATION(integrals);
+	int size = table->size;
+	if (R > (size - 1) * OFFSITE_TABLE_SPACING) {
+		offsite_radial_integrals(table, R, integrals);
+	} else {
+		int ind = min((int) (R / OFFSITE_TABLE_SPACING), size - 2);
+		double rem = R - ind * OFFSITE_TABLE_SPACING;
+		for (int p = 0; p < num_integrals; p++) {
+			double* s = table->splines + 3L * p * size;
+			integrals[p] = table->values[(long) p * size + ind] + rem * (s[ind]
+				+ rem * (s[size + ind] + rem * s[2 * size + ind]));
+		}
+	}
+
+	// the angular factors are the same as in reciprocal_offsite_wave_overlap
+	int tj = 0;
+	for (int j = 0; j < pp1->num_projs; j++) {
+		int l1 = pp1->funcs[j].l;
+		for (int m1 = -l1; m1 <= l1; m1++) {
+			int tk = 0;
+			for (int k = 0; k < pp2->num_projs; k++) {
+				int l2 = pp2->funcs[k].l;
+				double* radial = integrals + (j * pp2->num_projs + k) * num_lterms;
+				for (int m2 = -l2; m2 <= l2; m2++) {
+					int lx = l1, ly = l2, mx = m1, my = m2;
+					if (l1 < l2) {
+						lx = l2;
+						ly = l1;
+						mx = m2;
+						my = m1;
+					}
+					if (my < 0) {
+						mx = -mx;
+						my = -my;
+					}
+					double complex total = 0;
+					for (int L = abs(l1-l2); L <= l1+l2; L+=2) {
+						int Lind = (L-abs(l1-l2))/2;
+						if (R > 10e-10) {
+							total += radial[Lind] * SBTFACS[lx][ly][Lind][lx+mx][my]
+								* Ylm(L, m1-m2, theta, phi) * cpow(I, l2+L-l1)
+								* pow(-1, m1) * 8;
+						} else if (L == 0 && l1 == l2 && m1 == m2) {
+							total += radial[Lind] * 2 / PI;
+						}
+					}
+					overlaps[tj*pp2->total_projs+tk] = total;
+					tk++;
+				}
+			}
+			tj++;
+		}
+	}
+	free(integrals);
+}
+
 /*double complex charge_in_sphere(double* dcoord,
 	double* k, double* psf1, double* aef1, int l1, int m1,
 	double* psf2, double* aef2, int l2, int m2,
@@ -7,6 +7,7 @@ of two overlapping spheres
 #define RADIAL_H
 
 #include <complex.h>
+#include "utils.h"
 
 /**
 Given dcoord: difference between site locations (R2-R1); r1, the radial grid, size size1, of
@@ -31,4 +32,24 @@ double complex reciprocal_offsite_wave_overlap(double* dcoord,
 	double* k2, double* f2, double** s2, int size2,
 	double* lattice, int l1, int m1, int l2, int m2);
 
+/**
+Calculates reciprocal_offsite_wave_overlap for every pair of partial wave
+functions of pp1 and pp2, with the first function (index tj, in the order
+of the projectors of pp1) at the origin and the second (index tk) at dcoord.
+The result for the pair is stored in overlaps[tj*pp2->total_projs+tk].
+The radial integrals only depend on the radial functions, L and |dcoord|,
+so they are tabulated against |dcoord| once for each pair of elements,
+cached, and interpolated, and only the angular factors are calculated
+for each call.
+*/
+void reciprocal_offsite_overlap_matrix(double complex* overlaps, double* dcoord,
+	ppot_t* pp1, ppot_t* pp2);
+
+/**
+Frees the cached radial integral tables (see reciprocal_offsite_overlap_matrix)
+involving the element with radial data funcs, or every cached table if
+funcs is NULL. Called by free_ppot.
+*/
+void free_offsite_tables(funcset_t* funcs);
+
 #endif
@@ -1,10 +1,19 @@
+#define _XOPEN_SOURCE 700
 #include <stdio.h>
 #include <stdlib.h>
 #include <complex.h>
 #include <math.h>
 #include <omp.h>
 #include <time.h>
+#include <string.h>
+#include <fcntl.h>
+#include <unistd.h>
+#include <sys/mman.h>
+#include <sys/stat.h>
+#include <zlib.h>
+#include <bzlib.h>
 #include "utils.h"
+#include "gsphere.h"
 #include "reader.h"
 
 #define PI 3.14159265358979323846
@@ -12,23 +21,129 @@
 
 WAVECAR* wcopen(char* f, int type) {
 	WAVECAR* wc = (WAVECAR*) malloc(sizeof(WAVECAR));
+	wc->zfp = NULL;
+	wc->pos = 0;
+	wc->error = 0;
 	if (type == 0) {
 		wc->type = 0;
 		wc->fp = fopen(f, "rb");
 		wc->start = NULL;
 		wc->curr = NULL;
-	} else {
+		wc->size = 0;
+	} else if (type == 1) {
 		wc->type = 1;
 		wc->fp = NULL;
 		wc->start = f;
 		wc->curr = f;
+		wc->size = 0;
+	} else if (type == 2) {
+		wc->type = 2;
+		wc->fp = NULL;
+		int fd = open(f, O_RDONLY);
+		struct stat st;
+		if (fd < 0 || fstat(fd, &st) != 0) {
+			printf("ERROR: could not open %s for mapping\n", f);
+			if (fd >= 0) close(fd);
+			free(wc);
+			return NULL;
+		}
+		wc->size = (long) st.st_size;
+		void* map = mmap(NULL, wc->size, PROT_READ | PROT_WRITE, MAP_PRIVATE, fd, 0);
+		close(fd);
+		if (map == MAP_FAILED) {
+			printf("ERROR: could not map %s\n", f);
+			free(wc);
+			return NULL;
+		}
+		wc->start = (char*) map;
+		wc->curr = wc->start;
+	} else {
+		wc->type = type;
+		wc->fp = NULL;
+		wc->start = NULL;
+		wc->curr = NULL;
+		wc->size = 0;
+		if (type == 3) {
+			gzFile gz = gzopen(f, "rb");
+			if (gz != NULL) {
+				gzbuffer(gz, 1 << 18);
+			}
+			wc->zfp = (void*) gz;
+		} else {
+			int bzerror;
+			wc->fp = fopen(f, "rb");
+			if (wc->fp != NULL) {
+				wc->zfp = (void*) BZ2_bzReadOpen(&bzerror, wc->fp, 0, 0, NULL, 0);
+			}
+		}
+		if (wc->zfp == NULL) {
+			printf("ERROR: could not open compressed file %s\n", f);
+			if (wc->fp != NULL) fclose(wc->fp);
+			free(wc);
+			return NULL;
+		}
 	}
 	return wc;
 }
 
+long wcdecompress(void* ptr0, long nbytes, WAVECAR* wc) {
+	char* ptr = (char*) ptr0;
+	long total = 0;
+	if (wc->type == 3) {
+		while (total < nbytes) {
+			unsigned int chunk = (unsigned int) fmin(nbytes - total, 1 << 30);
+			int nread = gzread((gzFile) wc->zfp, ptr + total, chunk);
+			if (nread <= 0) break;
+			total += nread;
+		}
+	} else {
+		int bzerror = BZ_OK;
+		while (total < nbytes) {
+			int chunk = (int) fmin(nbytes - total, 1 << 30);
+			int nread = BZ2_bzRead(&bzerror, (BZFILE*) wc->zfp, ptr + total, chunk);
+			if (nread > 0) total += nread;
+			if (bzerror == BZ_STREAM_END) {
+				// files written by parallel bzip2 tools contain
+				// several concatenated streams
+				void* unused;
+				int nunused;
+				char buf[BZ_MAX_UNUSED];
+				BZ2_bzReadGetUnused(&bzerror, (BZFILE*) wc->zfp, &unused, &nunused);
+				memcpy(buf, unused, nunused);
+				BZ2_bzReadClose(&bzerror, (BZFILE*) wc->zfp);
+				if (nunused == 0 && feof(wc->fp)) {
+					wc->zfp = NULL;
+					break;
+				}
+				wc->zfp = (void*) BZ2_bzReadOpen(&bzerror, wc->fp, 0, 0, buf, nunused);
+			} else if (bzerror != BZ_OK) {
+				break;
+			}
+		}
+	}
+	wc->pos += total;
+	return total;
+}
+
 void wcseek(WAVECAR* wc, long loc) {
 	if (wc->type == 0) {
 		fseek(wc->fp, loc, SEEK_SET);
+	} else if (wc->type == 3) {
+		gzseek((gzFile) wc->zfp, loc, SEEK_SET);
+		wc->pos = loc;
+	} else if (wc->type == 4) {
+		int bzerror;
+		if (loc < wc->pos || wc->zfp == NULL) {
+			// bzip2 streams can only be read forward, so start over
+			if (wc->zfp != NULL) BZ2_bzReadClose(&bzerror, (BZFILE*) wc->zfp);
+			rewind(wc->fp);
+			wc->zfp = (void*) BZ2_bzReadOpen(&bzerror, wc->fp, 0, 0, NULL, 0);
+			wc->pos = 0;
+		}
+		char buf[1 << 16];
+		while (wc->pos < loc && wc->zfp != NULL) {
+			if (wcdecompress(buf, (long) fmin(loc - wc->pos, 1 << 16), wc) == 0) break;
+		}
 	} else {
 		wc->curr = wc->start + loc;
 	}
@@ -37,17 +152,47 @@ void wcseek(WAVECAR* wc, long loc) {
 void wcread(void* ptr0, long size, long nmemb, WAVECAR* wc) {
 	if (wc->type == 0) {
 		fread(ptr0, size, nmemb, wc->fp);
+	} else if (wc->type == 3 || wc->type == 4) {
+		if (wc->error) {
+			return;
+		}
+		if (wc->zfp == NULL || wcdecompress(ptr0, size * nmemb, wc) < size * nmemb) {
+			// checked by the readers once the records have been read
+			printf("ERROR: unexpected end of compressed WAVECAR\n");
+			wc->error = 1;
+		}
 	} else {
+		memcpy(ptr0, wc->curr, size * nmemb);
+	}
+}
+
+void wcpread(void* ptr0, long size, long nmemb, long loc, WAVECAR* wc) {
+	if (wc->type == 0) {
 		char* ptr = (char*) ptr0;
-		for (int i = 0; i < size * nmemb; i++) {
-			ptr[i] = wc->curr[i];
+		long total = 0;
+		int fd = fileno(wc->fp);
+		while (total < size * nmemb) {
+			ssize_t nread = pread(fd, ptr + total, size * nmemb - total, loc + total);
+			if (nread <= 0) {
+				printf("ERROR: unexpected end of WAVECAR\n");
+				break;
+			}
+			total += nread;
 		}
+	} else {
+		memcpy(ptr0, wc->start + loc, size * nmemb);
 	}
 }
 
 void wcclose(WAVECAR* wc) {
 	if (wc->type == 0) {
 		fclose(wc->fp);
+	} else if (wc->type == 3) {
+		gzclose((gzFile) wc->zfp);
+	} else if (wc->type == 4) {
+		int bzerror;
+		if (wc->zfp != NULL) BZ2_bzReadClose(&bzerror, (BZFILE*) wc->zfp);
+		fclose(wc->fp);
 	}
 	free(wc);
 }
@@ -124,7 +269,40 @@ void setup(int nspin, int nwk, int nband,
 	*nb3 = nb3max;
 }
 
+int wavecar_band_range(WAVECAR* wc, long nrecl, int nkpts, int nband,
+	double emin, double emax, int* band_min, int* band_max) {
+
+	int lo = *band_max + 1, hi = *band_min - 1;
+	double* kptr = (double*) malloc(nrecl);
+	CHECK_ALLOCATION(kptr);
+	for (int iwk = 0; iwk < nkpts; iwk++) {
+		long loc = iwk * (long)(1 + nband) * nrecl + 2 * nrecl;
+		if (wc->type < 3) {
+			wcpread(kptr, 8, nrecl/8, loc, wc);
+		} else {
+			wcseek(wc, loc);
+			wcread(kptr, 8, nrecl/8, wc);
+		}
+		for (int b = *band_min; b <= *band_max; b++) {
+			double energy = kptr[4+b*3];
+			if (energy >= emin && energy <= emax) {
+				lo = min(lo, b);
+				hi = max(hi, b);
+			}
+		}
+	}
+	free(kptr);
+	*band_min = lo;
+	*band_max = hi;
+	return hi - lo + 1;
+}
+
 pswf_t* read_wavecar(WAVECAR* wc, double* kpt_weights) {
+	return read_wavecar_bands(wc, kpt_weights, 0, -1, 1, 0);
+}
+
+pswf_t* read_wavecar_bands(WAVECAR* wc, double* kpt_weights,
+	int band_min, int band_max, double emin, double emax) {
 
 	int nrecli, nspin, nwk, nband, nprec;
 	double nb1max, nb2max, nb3max, encut;
@@ -136,6 +314,11 @@ pswf_t* read_wavecar(WAVECAR* wc, double* kpt_weights) {
 	double* ptr = readin;
 	wcread(ptr,24,1,wc);
 	//fread(ptr,24,1,wc->fp);
+	if (wc->error) {
+		free(lattice);
+		free(reclattice);
+		return NULL;
+	}
 	nrecli = (int) round(readin[0]);
 	nspin = (int) round(readin[1]);
 	nprec = (int) round(readin[2]);
@@ -152,24 +335,74 @@ pswf_t* read_wavecar(WAVECAR* wc, double* kpt_weights) {
 	for (int i = 0; i < 9; i++) {
 		lattice[i] = readarr[i+3];
 	}
+	if (wc->error) {
+		free(lattice);
+		free(reclattice);
+		return NULL;
+	}
+	if (wc->type == 2 && (2 + nwk * nspin * (long)(1 + nband)) * nrecl > wc->size) {
+		printf("ERROR: WAVECAR is truncated\n");
+		free(lattice);
+		free(reclattice);
+		munmap(wc->start, wc->size);
+		return NULL;
+	}
+
+
+	band_min = max(band_min, 0);
+	if (band_max < 0 || band_max >= nband) {
+		band_max = nband - 1;
+	}
+	if (emin <= emax) {
+		wavecar_band_range(wc, nrecl, nwk * nspin, nband,
+			emin, emax, &band_min, &band_max);
+	}
+	if (wc->error) {
+		free(lattice);
+		free(reclattice);
+		return NULL;
+	}
+	if (band_min > band_max) {
+		printf("ERROR: no bands selected from WAVECAR\n");
+		free(lattice);
+		free(reclattice);
+		if (wc->type == 2) munmap(wc->start, wc->size);
+		return NULL;
+	}
+	int nsel = band_max - band_min + 1;
 
 	setup(nspin, nwk, nband, &nb1max, &nb2max, &nb3max,
 		&npmax, encut, lattice, reclattice);
-	double* b1 = reclattice;
-	double* b2 = reclattice+3;
-	double* b3 = reclattice+6;
-
 	pswf_t* wf = (pswf_t*) malloc(sizeof(pswf_t));
 
 	wf->num_sites = 0;
 	wf->nspin = nspin;
 	wf->nwk = nwk;
-	wf->nband = nband;
+	wf->nband = nsel;
+	wf->band_start = band_min;
 	wf->is_ncl = 0;
-	wf->dcoords = NULL;
 	wf->fftg = NULL;
-	wf->overlaps = NULL;
 	wf->num_projs = NULL;
+	wf->proj_block = NULL;
+	wf->overlap_block = NULL;
+	wf->nlm_block = NULL;
+	wf->proj_done = NULL;
+	wf->proj_method = 0;
+	wf->proj_labels = NULL;
+	wf->proj_coords = NULL;
+	wf->proj_sites = NULL;
+	wf->wp_num = 0;
+	wf->wp_cache = NULL;
+	wf->aug_cache = NULL;
+	wf->wp_clock = 0;
+	wf->wp_hits = 0;
+	if (wc->type == 2) {
+		wf->wc_map = wc->start;
+		wf->wc_map_size = wc->size;
+	} else {
+		wf->wc_map = NULL;
+		wf->wc_map_size = 0;
+	}
 
 	kpoint_t** kpts = (kpoint_t**) malloc(nwk*nspin*sizeof(kpoint_t*));
 	if (kpts == NULL) {
@@ -181,124 +414,116 @@ pswf_t* read_wavecar(WAVECAR* wc, double* kpt_weights) {
 	wf->reclattice = reclattice;
 	wf->G_bounds = (int*) calloc(6, sizeof(int));
 
-	double* kptr = (double*) malloc(nrecl);
-	float complex* cptr = (float complex*) malloc(nrecl);
-	//#pragma omp parallel for
+	// compressed WAVECARs can only be read sequentially,
+	// all other sources are read with positioned reads
+	int parallel_read = (wc->type < 3);
+	#pragma omp parallel for schedule(dynamic) if(parallel_read)
 	for (int iwk = 0; iwk < nwk * nspin; iwk++) {
 		long irec = iwk * (long)(1 + nband);
+		double* kptr = (double*) malloc(nrecl);
+		int gbounds[6] = {0, 0, 0, 0, 0, 0};
 
 		kpoint_t* kpt = (kpoint_t*) malloc(sizeof(kpoint_t));
-		kpt->expansion = NULL;
-		kpt->num_bands = nband;
-		band_t** bands = (band_t**) malloc(nband*sizeof(band_t*));
-		kpt->bands = bands;
-		if (kpt == NULL || bands == NULL) {
+		if (kpt == NULL) {
 		    ALLOCATION_FAILED();
 		}
-		wcseek(wc, irec*nrecl+2*nrecl);
-		wcread(kptr, 8, nrecl/8, wc);
-		//fseek(wc->fp, irec*nrecl+2*nrecl, SEEK_SET);
-		//fread(kptr, 8, nrecl/8, wc->fp);
+		kpt->expansion = NULL;
+		if (parallel_read) {
+			wcpread(kptr, 8, nrecl/8, irec*nrecl+2*nrecl, wc);
+		} else {
+			wcseek(wc, irec*nrecl+2*nrecl);
+			wcread(kptr, 8, nrecl/8, wc);
+		}
+		if (wc->error) {
+			// the compressed WAVECAR ended early, cleaned up below
+			kpts[iwk] = NULL;
+			free(kpt);
+			free(kptr);
+			continue;
+		}
 		
 		int nplane = (int) round(kptr[0]);
 		kpt->num_waves = nplane;
-		int* igall = malloc(3*nplane*sizeof(int));
-		if (igall == NULL) {
-		    ALLOCATION_FAILED();
-		}
 		kpt->k = (double*) malloc(3*sizeof(double));
 		kpt->k[0] = kptr[1];
 		kpt->k[1] = kptr[2];
 		kpt->k[2] = kptr[3];
 		double kx = kpt->k[0], ky = kpt->k[1], kz = kpt->k[2];
-		for (int i = 0; i < nband; i++) {
-			band_t* band = (band_t*) malloc(sizeof(band_t));
-			band->num_waves = nplane;
-			band->energy = kptr[4+i*3];
-			band->occ = kptr[6+i*3];
-			band->projections = NULL;
-			band->up_projections = NULL;
-			band->down_projections = NULL;
-			band->wave_projections = NULL;
-			band->CRs = NULL;
-			band->CAs = NULL;
-			kpt->bands[i] = band;
+		// mapped coefficients stay in the map, the rest are
+		// read into one [nsel][nplane] block per k-point
+		alloc_kpoint_bands(kpt, nsel, wc->type != 2);
+		for (int i = 0; i < nsel; i++) {
+			band_t* band = kpt->bands[i];
+			band->n = band_min + i;
+			band->energy = kptr[4+band->n*3];
+			band->occ = kptr[6+band->n*3];
 		}
 
-		int ncnt = -1;
-		for (int ig3 = 0; ig3 <= 2 * nb3max; ig3++) {
-			int ig3p = ig3;
-			if (ig3 > nb3max) ig3p = ig3 - 2 * nb3max - 1;
-			for (int ig2 = 0; ig2 <= 2 * nb2max; ig2++) {
-				int ig2p = ig2;
-				if (ig2 > nb2max) ig2p = ig2 - 2 * nb2max - 1;
-				for (int ig1 = 0; ig1 <= 2 * nb1max; ig1++) {
-					int ig1p = ig1;
-					if (ig1 > nb1max) ig1p = ig1 - 2 * nb1max - 1;
-					double sumkg[3];
-					for (int j = 0; j < 3; j++) {
-						sumkg[j] = (kx+ig1p) * b1[j]
-									+ (ky+ig2p) * b2[j]
-									+ (kz+ig3p) * b3[j];
-					}
-					double gtot = mag(sumkg);
-					double etot = pow(gtot,2.0) / c;
-					//printf("%lf %lf\n", etot, gtot);
-					if (etot <= encut) {
-						ncnt++;
-						igall[ncnt*3+0] = ig1p;
-						igall[ncnt*3+1] = ig2p;
-						igall[ncnt*3+2] = ig3p;
-						if (ig1p < wf->G_bounds[0]) wf->G_bounds[0] = ig1p;
-						else if (ig1p > wf->G_bounds[1]) wf->G_bounds[1] = ig1p;
-						if (ig2p < wf->G_bounds[2]) wf->G_bounds[2] = ig2p;
-						else if (ig2p > wf->G_bounds[3]) wf->G_bounds[3] = ig2p;
-						if (ig3p < wf->G_bounds[4]) wf->G_bounds[4] = ig3p;
-						else if (ig3p > wf->G_bounds[5]) wf->G_bounds[5] = ig3p;
-					}
-				}
+		int ncnt = 0;
+		int* igall = get_gsphere(reclattice, encut, kpt->k, 1, &ncnt, gbounds);
+
+		#pragma omp critical
+		{
+			for (int i = 0; i < 6; i += 2) {
+				wf->G_bounds[i] = min(wf->G_bounds[i], gbounds[i]);
+				wf->G_bounds[i+1] = max(wf->G_bounds[i+1], gbounds[i+1]);
 			}
 		}
-		ncnt++;
 
 		if (ncnt * 2 == nplane) {
 			//printf("This is an NCL wavefunction!\n");
+			#pragma omp atomic write
 			wf->is_ncl = 1;
-			for (int iplane = 0; iplane < nplane/2; iplane++) {
-				igall[3*(nplane/2+iplane)+0] = igall[3*iplane+0];
-				igall[3*(nplane/2+iplane)+1] = igall[3*iplane+1];
-				igall[3*(nplane/2+iplane)+2] = igall[3*iplane+2];
-			}
+			release_gsphere(igall);
+			igall = get_gsphere(reclattice, encut, kpt->k, 2, &ncnt, gbounds);
 		} else if (ncnt != nplane) {
 			printf("ERROR %d %d %lf %lf %lf %lf\n", ncnt, nplane, kx,ky,kz, c);
 		}
 		//if (ncnt > npmax) printf("BIG ERROR");
 		//printf("%d %d\n", ncnt, npmax);
 
-		for (int iband = 0; iband < nband; iband++) {
+		// skip the records of the bands before band_min
+		irec += band_min;
+		for (int iband = 0; iband < nsel; iband++) {
 			irec++;
-			wcseek(wc, (long)irec*nrecl+2*(long)nrecl);
-			wcread(cptr, 8, nrecl/8, wc);
-			//fseek(wc->fp, (long)irec*nrecl+2*(long)nrecl, SEEK_SET);
-			//fread(cptr, 8, nrecl/8, wc->fp);
-			float complex* coeff = malloc(nplane*sizeof(float complex));
-			for (int iplane = 0; iplane < nplane; iplane++) {
-				coeff[iplane] = cptr[iplane];
+			if (wc->type == 2) {
+				// the record is paged in the first time Cs is accessed
+				kpt->bands[iband]->Cs = (float complex*) (wc->start
+					+ (long)irec*nrecl + 2*(long)nrecl);
+				continue;
+			}
+			float complex* coeff = kpt->bands[iband]->Cs;
+			if (parallel_read) {
+				wcpread(coeff, sizeof(float complex), nplane,
+					(long)irec*nrecl+2*(long)nrecl, wc);
+			} else {
+				wcseek(wc, (long)irec*nrecl+2*(long)nrecl);
+				wcread(coeff, sizeof(float complex), nplane, wc);
 			}
-			kpt->bands[iband]->Cs = coeff;
 		}
 		
 		//printf("iwk %d\n", iwk);
 		kpt->weight = kpt_weights[iwk%nwk];
 		kpt->Gs = igall;
 		kpts[iwk] = kpt;
+		free(kptr);
 	}
 
-	free(kptr);
-	free(cptr);
+	if (wc->error) {
+		for (int iwk = 0; iwk < nwk * nspin; iwk++) {
+			if (kpts[iwk] != NULL) {
+				free_kpoint(kpts[iwk], 0, 0, 0, NULL);
+			}
+		}
+		free(kpts);
+		free(wf->G_bounds);
+		free(lattice);
+		free(reclattice);
+		free(wf);
+		return NULL;
+	}
 
 	wf->pps = NULL;
-	wf->overlaps = NULL;
 	wf->encut = encut;
 
 	return wf;
@@ -312,107 +537,159 @@ pswf_t* read_wavefunctions(char* filename, double* kpt_weights) {
 	return wf;
 }
 
-pswf_t* read_wavefunctions_from_str(char* start, double* kpt_weights) {
-	WAVECAR* f = wcopen(start, 1);
+pswf_t* read_wavefunctions_mmap(char* filename, double* kpt_weights) {
+	setbuf(stdout,NULL);
+	WAVECAR* f = wcopen(filename, 2);
+	if (f == NULL) {
+		return NULL;
+	}
 	pswf_t* wf = read_wavecar(f, kpt_weights);
 	wcclose(f);
 	return wf;
 }
 
-/*
-kpoint_t** read_one_band(int* G_bounds, double* kpt_weights, int* ns, int* nk, int* nb, int BAND_NUM, char* filename) {
-	clock_t start = clock();
+int wavecar_file_type(char* filename, int lazy) {
+	unsigned char magic[3] = {0, 0, 0};
+	FILE* fp = fopen(filename, "rb");
+	if (fp == NULL) {
+		return -1;
+	}
+	fread(magic, 1, 3, fp);
+	fclose(fp);
+	if (magic[0] == 'B' && magic[1] == 'Z' && magic[2] == 'h') {
+		return 4;
+	} else if (magic[0] == 0x1f && magic[1] == 0x8b) {
+		return 3;
+	}
+	return lazy ? 2 : 0;
+}
 
-	int nrecli=0, nspin=0, nwk=0, nband=0;
-	double nb1max=0, nb2max=0, nb3max=0, encut=0;
-	double lattice[9] = {0};
-	double reclattice[9] = {0};
-	setup(filename, &nrecli, &nspin, &nwk, &nband, &nb1max, &nb2max, &nb3max,
-		&encut, lattice, reclattice);
-	double* b1 = reclattice;
-	double* b2 = reclattice+3;
-	double* b3 = reclattice+6;
+pswf_t* read_wavefunctions_compressed(char* filename, double* kpt_weights) {
+	setbuf(stdout,NULL);
+	int type = wavecar_file_type(filename, 0);
+	if (type < 0) {
+		return NULL;
+	}
+	// zlib also reads uncompressed files transparently
+	WAVECAR* f = wcopen(filename, type == 4 ? 4 : 3);
+	if (f == NULL) {
+		return NULL;
+	}
+	pswf_t* wf = read_wavecar(f, kpt_weights);
+	wcclose(f);
+	return wf;
+}
 
-	long nrecl = (long) nrecli;
+pswf_t* read_wavefunctions_bands(char* filename, double* kpt_weights, int lazy,
+	int band_min, int band_max, double emin, double emax) {
+
+	setbuf(stdout,NULL);
+	int type = wavecar_file_type(filename, lazy);
+	if (type < 0) {
+		return NULL;
+	}
+	WAVECAR* f = wcopen(filename, type);
+	if (f == NULL) {
+		return NULL;
+	}
+	pswf_t* wf = read_wavecar_bands(f, kpt_weights, band_min, band_max, emin, emax);
+	wcclose(f);
+	return wf;
+}
+
+wavecar_header_t* read_wavecar_header(char* filename) {
+	int type = wavecar_file_type(filename, 0);
+	if (type < 0) {
+		return NULL;
+	}
+	WAVECAR* wc = wcopen(filename, type);
+	if (wc == NULL) {
+		return NULL;
+	}
+
+	double readin[3] = {0, 0, 0};
+	wcread(readin, 24, 1, wc);
+	long nrecl = (long) round(readin[0]);
+	if (wc->error) {
+		wcclose(wc);
+		return NULL;
+	}
+	if (nrecl < 96) {
+		printf("ERROR: %s is not a valid WAVECAR\n", filename);
+		wcclose(wc);
+		return NULL;
+	}
+	wavecar_header_t* header = (wavecar_header_t*) malloc(sizeof(wavecar_header_t));
+	CHECK_ALLOCATION(header);
+	header->nrecl = (int) nrecl;
+	header->nspin = (int) round(readin[1]);
+	header->nprec = (int) round(readin[2]);
 
 	double* kptr = (double*) malloc(nrecl);
-	float complex* cptr = (float complex*) malloc(nrecl);
+	CHECK_ALLOCATION(kptr);
+	wcseek(wc, nrecl);
+	wcread(kptr, 8, nrecl/8, wc);
+	if (wc->error) {
+		free(header);
+		free(kptr);
+		wcclose(wc);
+		return NULL;
+	}
+	int nwk = (int) round(kptr[0]);
+	int nband = (int) round(kptr[1]);
+	int nspin = header->nspin;
+	header->nwk = nwk;
+	header->nband = nband;
+	header->encut = kptr[2];
+	for (int i = 0; i < 9; i++) {
+		header->lattice[i] = kptr[i+3];
+	}
 
-	kpoint_t** kpts = (kpoint_t**) malloc(nwk*nspin*sizeof(kpoint_t*));
+	header->kpts = (double*) malloc(3 * nwk * sizeof(double));
+	header->num_waves = (int*) malloc(nwk * sizeof(int));
+	header->energies = (double*) malloc(nspin * nwk * nband * sizeof(double));
+	header->occs = (double*) malloc(nspin * nwk * nband * sizeof(double));
+	CHECK_ALLOCATION(header->kpts);
+	CHECK_ALLOCATION(header->num_waves);
+	CHECK_ALLOCATION(header->energies);
+	CHECK_ALLOCATION(header->occs);
 
-	//#pragma omp parallel for
 	for (int iwk = 0; iwk < nwk * nspin; iwk++) {
-		int irec = iwk * (1 + nband);
-		FILE* pfp = fopen(filename, "rb");
-		kpoint_t* kpt = (kpoint_t*) malloc(sizeof(kpoint_t));
-		kpt->num_bands = 1;
-		band_t** bands = (band_t**) malloc(sizeof(band_t*));
-		kpt->bands = bands;
-		//void* karr = malloc(nrecl);
-		fseek(pfp, (long)irec*nrecl+(long)2*nrecl, SEEK_SET);
-		//printf("reading dat %d\n", fread(kptr, 8, nrecl/8, pfp));
-		fread(kptr, 8, nrecl/8, pfp);
-
-		int nplane = (int) round(kptr[0]);
-		int* igall = malloc(3*nplane*sizeof(int));
-		double kx = kptr[1];
-		double ky = kptr[2];
-		double kz = kptr[3];
-
-		band_t* band = (band_t*) malloc(sizeof(band_t));
-		band->num_waves = nplane;
-		band->energy = kptr[4+BAND_NUM*3];
-		band->occ = kptr[6+BAND_NUM*3];
-		kpt->bands[0] = band;
-
-		int ncnt = -1;
-		for (int ig3 = 0; ig3 <= 2 * nb3max; ig3++) {
-			int ig3p = ig3;
-			if (ig3 > nb3max) ig3p = ig3 - 2 * nb3max - 1;
-			for (int ig2 = 0; ig2 <= 2 * nb2max; ig2++) {
-				int ig2p = ig2;
-				if (ig2 > nb2max) ig2p = ig2 - 2 * nb2max - 1;
-				for (int ig1 = 0; ig1 <= 2 * nb1max; ig1++) {
-					int ig1p = ig1;
-					if (ig1 > nb1max) ig1p = ig1 - 2 * nb1max - 1;
-					double sumkg[3];
-					for (int j = 0; j < 3; j++) {
-						sumkg[j] = (kx+ig1p) * b1[j]
-									+ (ky+ig2p) * b2[j]
-									+ (kz+ig3p) * b3[j];
-					}
-					double gtot = mag(sumkg);
-					double etot = pow(gtot,2.0) / c;
-					//printf("%lf %lf\n", etot, gtot);
-					if (etot <= encut) {
-						ncnt++;
-						igall[ncnt*3+0] = ig1p;
-						igall[ncnt*3+1] = ig2p;
-						igall[ncnt*3+2] = ig3p;
-					}
-				}
+		wcseek(wc, (iwk * (long)(1 + nband) + 2) * nrecl);
+		wcread(kptr, 8, nrecl/8, wc);
+		if (iwk < nwk) {
+			header->num_waves[iwk] = (int) round(kptr[0]);
+			for (int i = 0; i < 3; i++) {
+				header->kpts[3*iwk+i] = kptr[1+i];
 			}
 		}
-		if (ncnt != nplane - 1) printf("ERROR %d %d", ncnt, nplane);
-
-		int iband = BAND_NUM;
-		irec += 1 + BAND_NUM;
-		fseek(pfp,(long) irec*nrecl+2*(long)nrecl, SEEK_SET);
-		fread(cptr, 8, nrecl/8, pfp);
-		float complex* coeff = malloc(nplane*sizeof(float complex));
-		for (int iplane = 0; iplane < nplane; iplane++) {
-			coeff[iplane] = cptr[iplane];
+		for (int b = 0; b < nband; b++) {
+			header->energies[iwk*nband+b] = kptr[4+b*3];
+			header->occs[iwk*nband+b] = kptr[6+b*3];
 		}
-		kpt->bands[0]->Cs = coeff;
-		kpt->weight = kpt_weights[iwk%nwk];
-		kpt->Gs = igall;
-		kpts[iwk] = kpt;
 	}
-	clock_t end = clock();
+
 	free(kptr);
-	free(cptr);
-	printf("%lf seconds to read defect\n", (double)(end-start) / CLOCKS_PER_SEC);
+	if (wc->error) {
+		free_wavecar_header(header);
+		wcclose(wc);
+		return NULL;
+	}
+	wcclose(wc);
+	return header;
+}
 
-	return kpts;
+void free_wavecar_header(wavecar_header_t* header) {
+	free(header->kpts);
+	free(header->num_waves);
+	free(header->energies);
+	free(header->occs);
+	free(header);
+}
+
+pswf_t* read_wavefunctions_from_str(char* start, double* kpt_weights) {
+	WAVECAR* f = wcopen(start, 1);
+	pswf_t* wf = read_wavecar(f, kpt_weights);
+	wcclose(f);
+	return wf;
 }
-*/
@@ -15,14 +15,59 @@ typedef struct WAVECAR_FILE {
 	FILE* fp;
 	char* start;
 	char* curr;
+	long size;
+	void* zfp;
+	long pos;
+	int error;
 } WAVECAR;
 
+/**
+Metadata of a WAVECAR, read from its header records only.
+The per-band arrays are ordered as [spin][kpoint][band].
+*/
+typedef struct wavecar_header {
+	int nrecl; ///< record length in bytes
+	int nspin; ///< number of spins
+	int nprec; ///< precision tag of the coefficients
+	int nwk; ///< number of kpoints
+	int nband; ///< number of bands
+	double encut; ///< plane-wave cutoff (eV)
+	double lattice[9]; ///< lattice (Angstroms, each row is a lattice vector)
+	double* kpts; ///< fractional kpoints (nwk x 3)
+	int* num_waves; ///< number of plane-wave coefficients at each kpoint (nwk)
+	double* energies; ///< band energies (eV)
+	double* occs; ///< band occupations
+} wavecar_header_t;
+
+/**
+Opens a WAVECAR for reading. If type is 0, f is a file path which is
+read with stdio. If type is 1, f is a pointer to the WAVECAR contents.
+If type is 2, f is a file path which is memory mapped (copy-on-write);
+in this case the map is not released by wcclose, since read_wavecar
+hands it to the pswf_t it returns. If type is 3 or 4, f is the path
+to a gzip or bzip2 compressed file, which is decompressed as it is read.
+Returns NULL if the file could not be opened or mapped.
+*/
 WAVECAR* wcopen(char* f, int type);
 
+/**
+Decompresses the next nbytes bytes of a gzip or bzip2 WAVECAR
+into ptr0 and returns the number of bytes read.
+*/
+long wcdecompress(void* ptr0, long nbytes, WAVECAR* wc);
+
 void wcseek(WAVECAR* wc, long loc);
 
 void wcread(void* ptr0, long size, long nmemb, WAVECAR* wc);
 
+/**
+Reads nmemb items of the given size at byte offset loc of the WAVECAR.
+Unlike wcseek/wcread, this does not move a shared file position, so it
+can be called from several threads at once. Not supported for compressed
+WAVECARs (types 3 and 4).
+*/
+void wcpread(void* ptr0, long size, long nmemb, long loc, WAVECAR* wc);
+
 void wcclose(WAVECAR* wc);
 
 /**
@@ -32,12 +77,34 @@ void setup(int nspin, int nwk, int nband,
 	double* nb1, double* nb2, double* nb3, int* np, double ecut,
 	double* lattice, double* reclattice);
 
+/**
+Narrows the band range [band_min, band_max] to the smallest range containing
+every band whose energy lies in [emin, emax] at any k-point (and spin),
+using only the k-point header records of the WAVECAR. Stores the
+new range to band_min and band_max and returns the number of bands in it,
+which is zero or negative if no band falls in the window.
+*/
+int wavecar_band_range(WAVECAR* wc, long nrecl, int nkpts, int nband,
+	double emin, double emax, int* band_min, int* band_max);
+
 /**
 Handles reading WAVECAR objects, called by read_wavefunctions
-and read_wavefunctions_from_str
+and read_wavefunctions_from_str. Reads all the bands.
 */
 pswf_t* read_wavecar(WAVECAR* wc, double* kpt_weights);
 
+/**
+Same as read_wavecar, but only reads bands band_min to band_max (inclusive,
+0-indexed; a negative band_max means the last band). If emin <= emax,
+the range is further narrowed with wavecar_band_range to the bands
+in the energy window [emin, emax] (in eV). The records of the other bands
+are skipped. Band b of the returned pswf_t is band b + band_start
+of the WAVECAR, and the n field of each band_t holds its WAVECAR index.
+Returns NULL if no bands are selected.
+*/
+pswf_t* read_wavecar_bands(WAVECAR* wc, double* kpt_weights,
+	int band_min, int band_max, double emin, double emax);
+
 /**
 Given char* filename pointing to a WAVECAR file (VASP output),
 constructs a pswf_t* containing the plane-wave coefficients
@@ -46,15 +113,55 @@ and energies for each band at each kpoint for each spin.
 pswf_t* read_wavefunctions(char* filename, double* kpt_weights);
 
 /**
-Read wavefunctions from a string. This is useful if the binary
-WAVECAR object is opened from a .gz or .bz2 format by monty
+Same as read_wavefunctions, except the WAVECAR is memory mapped and
+the plane-wave coefficients of each band point into the map instead of
+being copied. The coefficients are therefore only paged in from disk
+when a routine first accesses them. The map is released by free_pswf.
+Returns NULL if the file cannot be mapped or is truncated.
 */
-pswf_t* read_wavefunctions_from_str(char* start, double* kpt_weights);
+pswf_t* read_wavefunctions_mmap(char* filename, double* kpt_weights);
+
+/**
+Same as read_wavefunctions, but for a gzip or bzip2 compressed WAVECAR
+(the format is detected from the file contents). The file is decompressed
+record by record directly into the coefficient arrays, so the decompressed
+WAVECAR is never held in memory as a whole. Returns NULL if the file
+cannot be opened.
+*/
+pswf_t* read_wavefunctions_compressed(char* filename, double* kpt_weights);
+
+/**
+Returns the type argument of wcopen to use for filename: 4 for bzip2 and
+3 for gzip compressed files (detected from the file contents), otherwise
+2 if lazy is nonzero and 0 if it is not. Returns -1 if the file
+cannot be opened.
+*/
+int wavecar_file_type(char* filename, int lazy);
+
+/**
+Reads bands band_min to band_max and/or the bands in the energy window
+[emin, emax] of a WAVECAR, as described for read_wavecar_bands.
+Compressed files are detected automatically, and if lazy is nonzero,
+uncompressed files are memory mapped as in read_wavefunctions_mmap.
+Returns NULL if the file cannot be read or no bands are selected.
+*/
+pswf_t* read_wavefunctions_bands(char* filename, double* kpt_weights, int lazy,
+	int band_min, int band_max, double emin, double emax);
 
 /**
-DEPRECATED, DO NOT USE: function to read a single band from a WAVECAR
+Reads the header records of the WAVECAR filename (plain, gzip or bzip2)
+without reading any plane-wave coefficients. Returns NULL if the file
+cannot be read. Free the result with free_wavecar_header.
 */
-kpoint_t** read_one_band(int* G_bounds, double* kpt_weights, int* ns, int* nk, int* nb, int BAND_NUM, char* filename);
+wavecar_header_t* read_wavecar_header(char* filename);
+
+void free_wavecar_header(wavecar_header_t* header);
+
+/**
+Read wavefunctions from a string. This is useful if the binary
+WAVECAR object is opened from a .gz or .bz2 format by monty
+*/
+pswf_t* read_wavefunctions_from_str(char* start, double* kpt_weights);
 
 #endif
 
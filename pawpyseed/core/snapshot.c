@@ -0,0 +1,346 @@
+#define _XOPEN_SOURCE 700
+#include <stdio.h>
+#include <stdlib.h>
+#include <string.h>
+#include <complex.h>
+#include <fcntl.h>
+#include <unistd.h>
+#include <sys/mman.h>
+#include <sys/stat.h>
+#include "utils.h"
+#include "snapshot.h"
+
+#define SNAPSHOT_ALIGN 64
+
+long snapshot_write(void* ptr, long size, FILE* fp, long pos) {
+	if (size > 0 && fwrite(ptr, 1, size, fp) != (size_t) size) {
+		return -1;
+	}
+	return pos + size;
+}
+
+long snapshot_pad(FILE* fp, long pos) {
+	char zeros[SNAPSHOT_ALIGN] = {0};
+	if (pos < 0) {
+		return pos;
+	}
+	long npad = (SNAPSHOT_ALIGN - pos % SNAPSHOT_ALIGN) % SNAPSHOT_ALIGN;
+	return snapshot_write(zeros, npad, fp, pos);
+}
+
+long snapshot_align(long pos) {
+	return (pos + SNAPSHOT_ALIGN - 1) / SNAPSHOT_ALIGN * SNAPSHOT_ALIGN;
+}
+
+int snapshot_has_projections(pswf_t* wf) {
+	if (wf->num_sites <= 0) {
+		return 0;
+	}
+	for (int k = 0; k < wf->nwk * wf->nspin; k++) {
+		for (int b = 0; b < wf->nband; b++) {
+			band_t* band = wf->kpts[k]->bands[b];
+			if (band->projections == NULL) {
+				return 0;
+			}
+			if (wf->is_ncl && (band->up_projections == NULL
+				|| band->down_projections == NULL)) {
+				return 0;
+			}
+			if (wf->proj_done != NULL && !wf->proj_done[(long) k * wf->nband + b]) {
+				return 0;
+			}
+		}
+	}
+	return 1;
+}
+
+long write_projection_lists(pswf_t* wf, int list_num, FILE* fp, long pos) {
+	for (int k = 0; k < wf->nwk * wf->nspin; k++) {
+		for (int b = 0; b < wf->nband; b++) {
+			band_t* band = wf->kpts[k]->bands[b];
+			projection_t* projs = band->projections;
+			if (list_num == 1) projs = band->up_projections;
+			else if (list_num == 2) projs = band->down_projections;
+			for (int s = 0; s < wf->num_sites && pos >= 0; s++) {
+				pos = snapshot_write(projs[s].overlaps,
+					projs[s].total_projs * sizeof(double complex), fp, pos);
+			}
+		}
+	}
+	return pos;
+}
+
+long write_pswf_snapshot(pswf_t* wf, char* filename, long offset) {
+	FILE* fp = fopen(filename, "r+b");
+	if (fp == NULL || offset % SNAPSHOT_ALIGN != 0) {
+		if (fp != NULL) fclose(fp);
+		return -1;
+	}
+	fseek(fp, offset, SEEK_SET);
+
+	int NUM_KPTS = wf->nwk * wf->nspin;
+	int has_projections = snapshot_has_projections(wf);
+	snapshot_header_t header;
+	memset(&header, 0, sizeof(snapshot_header_t));
+	header.nspin = wf->nspin;
+	header.nwk = wf->nwk;
+	header.nband = wf->nband;
+	header.band_start = wf->band_start;
+	header.is_ncl = wf->is_ncl;
+	header.num_sites = has_projections ? wf->num_sites : 0;
+	header.has_projections = has_projections;
+	header.encut = wf->encut;
+	for (int i = 0; i < 9; i++) {
+		header.lattice[i] = wf->lattice[i];
+		header.reclattice[i] = wf->reclattice[i];
+	}
+	for (int i = 0; i < 6; i++) {
+		header.G_bounds[i] = wf->G_bounds[i];
+	}
+
+	// positions are relative to offset, which is aligned
+	long pos = snapshot_write(&header, sizeof(snapshot_header_t), fp, 0);
+	pos = snapshot_pad(fp, pos);
+	for (int k = 0; k < NUM_KPTS && pos >= 0; k++) {
+		pos = snapshot_write(wf->kpts[k]->k, 3 * sizeof(double), fp, pos);
+	}
+	for (int k = 0; k < NUM_KPTS && pos >= 0; k++) {
+		pos = snapshot_write(&(wf->kpts[k]->weight), sizeof(double), fp, pos);
+	}
+	for (int k = 0; k < NUM_KPTS && pos >= 0; k++) {
+		long num_waves = wf->kpts[k]->num_waves;
+		pos = snapshot_write(&num_waves, sizeof(long), fp, pos);
+	}
+	pos = snapshot_pad(fp, pos);
+	for (int k = 0; k < NUM_KPTS && pos >= 0; k++) {
+		for (int b = 0; b < wf->nband && pos >= 0; b++) {
+			pos = snapshot_write(&(wf->kpts[k]->bands[b]->energy), sizeof(double), fp, pos);
+		}
+	}
+	for (int k = 0; k < NUM_KPTS && pos >= 0; k++) {
+		for (int b = 0; b < wf->nband && pos >= 0; b++) {
+			pos = snapshot_write(&(wf->kpts[k]->bands[b]->occ), sizeof(double), fp, pos);
+		}
+	}
+	pos = snapshot_pad(fp, pos);
+	for (int k = 0; k < NUM_KPTS && pos >= 0; k++) {
+		pos = snapshot_write(wf->kpts[k]->Gs,
+			3 * wf->kpts[k]->num_waves * sizeof(int), fp, pos);
+	}
+	pos = snapshot_pad(fp, pos);
+	for (int k = 0; k < NUM_KPTS && pos >= 0; k++) {
+		for (int b = 0; b < wf->nband && pos >= 0; b++) {
+			pos = snapshot_write(wf->kpts[k]->bands[b]->Cs,
+				wf->kpts[k]->num_waves * sizeof(float complex), fp, pos);
+		}
+	}
+	pos = snapshot_pad(fp, pos);
+
+	if (has_projections) {
+		projection_t* projs = wf->kpts[0]->bands[0]->projections;
+		for (int s = 0; s < wf->num_sites && pos >= 0; s++) {
+			long nums[2] = {projs[s].num_projs, projs[s].total_projs};
+			pos = snapshot_write(nums, 2 * sizeof(long), fp, pos);
+		}
+		for (int s = 0; s < wf->num_sites && pos >= 0; s++) {
+			int size = projs[s].total_projs * sizeof(int);
+			pos = snapshot_write(projs[s].ns, size, fp, pos);
+			pos = snapshot_write(projs[s].ls, size, fp, pos);
+			pos = snapshot_write(projs[s].ms, size, fp, pos);
+		}
+		pos = snapshot_pad(fp, pos);
+		for (int list_num = 0; list_num < (wf->is_ncl ? 3 : 1); list_num++) {
+			pos = write_projection_lists(wf, list_num, fp, pos);
+		}
+	}
+
+	if (fclose(fp) != 0 || pos < 0) {
+		return -1;
+	}
+	return offset + pos;
+}
+
+pswf_t* read_pswf_snapshot(char* filename, long offset) {
+	setbuf(stdout, NULL);
+	int fd = open(filename, O_RDONLY);
+	struct stat st;
+	if (fd < 0 || fstat(fd, &st) != 0) {
+		printf("ERROR: could not open %s\n", filename);
+		if (fd >= 0) close(fd);
+		return NULL;
+	}
+	long size = (long) st.st_size;
+	if (offset < 0 || offset % SNAPSHOT_ALIGN != 0
+		|| size < offset + (long) sizeof(snapshot_header_t)) {
+		printf("ERROR: %s is not a valid snapshot\n", filename);
+		close(fd);
+		return NULL;
+	}
+	void* map = mmap(NULL, size, PROT_READ | PROT_WRITE, MAP_PRIVATE, fd, 0);
+	close(fd);
+	if (map == MAP_FAILED) {
+		printf("ERROR: could not map %s\n", filename);
+		return NULL;
+	}
+	char* start = (char*) map + offset;
+	snapshot_header_t* header = (snapshot_header_t*) start;
+	int nwk = (int) header->nwk;
+	int nspin = (int) header->nspin;
+	int nband = (int) header->nband;
+	int num_sites = (int) header->num_sites;
+	int NUM_KPTS = nwk * nspin;
+
+	// find the section positions and check that the file is complete
+	char* kptr = start + snapshot_align(sizeof(snapshot_header_t));
+	double* ks = (double*) kptr;
+	double* weights = ks + 3 * NUM_KPTS;
+	long* num_waves = (long*) (weights + NUM_KPTS);
+	long total_waves = 0;
+	long end = snapshot_align(kptr - start + NUM_KPTS * (4 * sizeof(double) + sizeof(long)));
+	if (nwk <= 0 || nspin <= 0 || nband <= 0 || offset + end > size) {
+		printf("ERROR: %s is not a valid snapshot\n", filename);
+		munmap(map, size);
+		return NULL;
+	}
+	for (int k = 0; k < NUM_KPTS; k++) {
+		total_waves += num_waves[k];
+	}
+	double* energies = (double*) (start + end);
+	double* occs = energies + NUM_KPTS * nband;
+	end = snapshot_align(end + 2 * NUM_KPTS * nband * sizeof(double));
+	int* Gs = (int*) (start + end);
+	end = snapshot_align(end + 3 * total_waves * sizeof(int));
+	char* Cs = start + end;
+	end = snapshot_align(end + total_waves * nband * sizeof(float complex));
+	long* site_info = (long*) (start + end);
+	if (header->has_projections) {
+		end += num_sites * 2 * sizeof(long);
+		if (offset + end > size) {
+			printf("ERROR: %s is truncated\n", filename);
+			munmap(map, size);
+			return NULL;
+		}
+		long total_projs = 0;
+		for (int s = 0; s < num_sites; s++) {
+			total_projs += site_info[2*s+1];
+		}
+		end = snapshot_align(end + 3 * total_projs * sizeof(int));
+		end += (header->is_ncl ? 3 : 1) * NUM_KPTS * nband * total_projs
+			* sizeof(double complex);
+	}
+	if (offset + end > size) {
+		printf("ERROR: %s is truncated\n", filename);
+		munmap(map, size);
+		return NULL;
+	}
+
+	pswf_t* wf = (pswf_t*) malloc(sizeof(pswf_t));
+	CHECK_ALLOCATION(wf);
+	wf->encut = header->encut;
+	wf->num_elems = 0;
+	wf->num_projs = NULL;
+	wf->num_sites = num_sites;
+	wf->pps = NULL;
+	wf->nspin = nspin;
+	wf->nwk = nwk;
+	wf->nband = nband;
+	wf->band_start = (int) header->band_start;
+	wf->is_ncl = (int) header->is_ncl;
+	wf->fftg = NULL;
+	wf->wp_num = 0;
+	wf->proj_block = NULL;
+	wf->overlap_block = NULL;
+	wf->nlm_block = NULL;
+	wf->proj_done = NULL;
+	wf->proj_method = 0;
+	wf->proj_labels = NULL;
+	wf->proj_coords = NULL;
+	wf->proj_sites = NULL;
+	wf->wp_cache = NULL;
+	wf->aug_cache = NULL;
+	wf->wp_clock = 0;
+	wf->wp_hits = 0;
+	wf->wc_map = (char*) map;
+	wf->wc_map_size = size;
+	wf->lattice = (double*) malloc(9 * sizeof(double));
+	wf->reclattice = (double*) malloc(9 * sizeof(double));
+	wf->G_bounds = (int*) malloc(6 * sizeof(int));
+	wf->kpts = (kpoint_t**) malloc(NUM_KPTS * sizeof(kpoint_t*));
+	CHECK_ALLOCATION(wf->lattice);
+	CHECK_ALLOCATION(wf->reclattice);
+	CHECK_ALLOCATION(wf->G_bounds);
+	CHECK_ALLOCATION(wf->kpts);
+	for (int i = 0; i < 9; i++) {
+		wf->lattice[i] = header->lattice[i];
+		wf->reclattice[i] = header->reclattice[i];
+	}
+	for (int i = 0; i < 6; i++) {
+		wf->G_bounds[i] = (int) header->G_bounds[i];
+	}
+
+	for (int k = 0; k < NUM_KPTS; k++) {
+		kpoint_t* kpt = (kpoint_t*) malloc(sizeof(kpoint_t));
+		CHECK_ALLOCATION(kpt);
+		kpt->up = k / nwk;
+		kpt->num_waves = (int) num_waves[k];
+		kpt->weight = weights[k];
+		kpt->expansion = NULL;
+		kpt->k = (double*) malloc(3 * sizeof(double));
+		kpt->Gs = (int*) malloc(3 * num_waves[k] * sizeof(int));
+		CHECK_ALLOCATION(kpt->k);
+		CHECK_ALLOCATION(kpt->Gs);
+		memcpy(kpt->k, ks + 3 * k, 3 * sizeof(double));
+		memcpy(kpt->Gs, Gs, 3 * num_waves[k] * sizeof(int));
+		Gs += 3 * num_waves[k];
+		alloc_kpoint_bands(kpt, nband, 0);
+		// the [nband][num_waves] block of coefficients is paged
+		// in from the snapshot the first time it is used
+		kpt->coeffs = (float complex*) Cs;
+		for (int b = 0; b < nband; b++) {
+			band_t* band = kpt->bands[b];
+			band->n = wf->band_start + b;
+			band->energy = energies[k * nband + b];
+			band->occ = occs[k * nband + b];
+			band->Cs = kpt->coeffs + b * num_waves[k];
+		}
+		Cs += nband * num_waves[k] * sizeof(float complex);
+		wf->kpts[k] = kpt;
+	}
+
+	if (header->has_projections) {
+		int* num_projs = (int*) malloc(num_sites * sizeof(int));
+		int* total_projs = (int*) malloc(num_sites * sizeof(int));
+		CHECK_ALLOCATION(num_projs);
+		CHECK_ALLOCATION(total_projs);
+		int nlm_size = 0;
+		for (int s = 0; s < num_sites; s++) {
+			num_projs[s] = (int) site_info[2*s];
+			total_projs[s] = (int) site_info[2*s+1];
+			nlm_size += total_projs[s];
+		}
+		int* nlms = (int*) malloc(3 * nlm_size * sizeof(int));
+		CHECK_ALLOCATION(nlms);
+		int* nlm = (int*) (site_info + 2 * num_sites);
+		int offset = 0;
+		for (int s = 0; s < num_sites; s++) {
+			for (int i = 0; i < 3; i++) {
+				memcpy(nlms + i * nlm_size + offset, nlm + i * total_projs[s],
+					total_projs[s] * sizeof(int));
+			}
+			nlm += 3 * total_projs[s];
+			offset += total_projs[s];
+		}
+		char* projptr = (char*) site_info + snapshot_align(
+			(char*) nlm - (char*) site_info);
+		alloc_projection_block(wf, num_projs, total_projs,
+			nlms, nlms + nlm_size, nlms + 2 * nlm_size);
+		// the overlaps are stored in the same order as overlap_block
+		memcpy(wf->overlap_block, projptr, (wf->is_ncl ? 3 : 1) * (long) NUM_KPTS
+			* nband * nlm_size * sizeof(double complex));
+		free(num_projs);
+		free(total_projs);
+		free(nlms);
+	}
+
+	return wf;
+}
@@ -0,0 +1,59 @@
+/** \file
+Binary snapshots of pswf_t objects, used by Wavefunction.save and
+Wavefunction.load. A snapshot contains the plane-wave coefficients,
+plane-wave indices, k-points, energies and occupations of a pswf_t,
+along with the projections <p_i|psit_nk> if they have been computed, so
+that a wavefunction can be restored without reading the WAVECAR
+or recomputing the projections.
+
+The snapshot is written starting at a byte offset in the file (the
+Python side stores its own metadata before it), and contains, in order:
+a snapshot_header_t; the k-points, k-point weights and number of plane
+waves at each k-point; the band energies and occupations; the plane-wave
+indices of each k-point; the coefficients of each band at each k-point;
+and, if has_projections is nonzero, the number of projectors and
+the n, l and m values of each projector at each site followed by the
+projections of each band at each k-point (for noncollinear wavefunctions,
+the spin up and spin down projections follow). Each of these sections
+starts at a multiple of 64 bytes from the offset.
+*/
+
+#ifndef SNAPSHOT_H
+#define SNAPSHOT_H
+#include "utils.h"
+
+typedef struct snapshot_header {
+	long nspin; ///< number of spins
+	long nwk; ///< number of kpoints
+	long nband; ///< number of bands
+	long band_start; ///< WAVECAR index of band 0
+	long is_ncl; ///< 1 if noncollinear, 0 otherwise
+	long num_sites; ///< number of sites in the projections, 0 if none
+	long has_projections; ///< 1 if the projections are stored
+	double encut; ///< plane-wave cutoff
+	double lattice[9]; ///< lattice
+	double reclattice[9]; ///< reciprocal lattice (with 2pi factor)
+	long G_bounds[6]; ///< G_bounds of the pswf_t
+} snapshot_header_t;
+
+/**
+Writes a snapshot of wf to filename, starting at byte offset, which
+must be a multiple of 64. The file must already exist and is not
+truncated. The projections are stored if they have been computed for
+every band. Returns the size of the file after writing, or -1 if
+the file cannot be written.
+*/
+long write_pswf_snapshot(pswf_t* wf, char* filename, long offset);
+
+/**
+Reads a snapshot written by write_pswf_snapshot. The file is memory
+mapped, and the coefficient block of each k-point (kpt->coeffs) points
+into the map, so it is only paged in from disk when it is used; the map
+is released by free_pswf. Projections, if stored, are copied into
+wf->proj_block (see alloc_projection_block) and wf->num_sites is set,
+but wf->pps is left NULL (see set_projector_list). Returns NULL if the file cannot be read
+or is not a valid snapshot.
+*/
+pswf_t* read_pswf_snapshot(char* filename, long offset);
+
+#endif
@@ -1,7 +1,7 @@
 # coding: utf-8
 
 import unittest
-import os, subprocess, sys
+import os, subprocess, sys, gc
 import time
 import scipy
 
@@ -31,12 +31,14 @@ MODULE_DIR = os.path.dirname(os.path.abspath(__file__))
 
 from pymatgen.io.vasp.inputs import Poscar, Potcar
 from pymatgen.io.vasp.outputs import Vasprun, Chgcar
+from pymatgen.electronic_structure.core import Spin
 from pymatgen.core.structure import Structure
 
 from pawpyseed.core.utils import *
 from pawpyseed.core.wavefunction import *
 from pawpyseed.core.projector import Projector
 from pawpyseed.core.noncollinear import NCLWavefunction
+from pawpyseed.core.vasprun import read_vasprun, clear_vasprun_cache
 
 class DummyProjector(Projector):
 
@@ -520,6 +522,305 @@ class TestPy:
 		res = pr.defect_band_analysis(4, 10, False)
 		assert len(res.keys()) == 15
 
+	def test_lazy(self):
+		print("TEST LAZY")
+		sys.stdout.flush()
+		wf = Wavefunction.from_directory('.')
+		lwf = Wavefunction.from_directory('.', lazy=True)
+		assert_equal(lwf.nband, wf.nband)
+		assert_equal(lwf._get_occs(), wf._get_occs())
+		for b in range(wf.nband):
+			assert_almost_equal(lwf.pseudoprojection(b, wf),
+				wf.pseudoprojection(b, wf))
+		state1 = wf.get_state_realspace(10, 1, 0)
+		state2 = lwf.get_state_realspace(10, 1, 0)
+		assert_almost_equal(np.linalg.norm(state1-state2), 0)
+
+	def test_band_range(self):
+		print("TEST BAND RANGE")
+		sys.stdout.flush()
+		wf = Wavefunction.from_directory('.')
+		nk = wf.nwk * wf.nspin
+		for fname, lazy in [('WAVECAR', False), ('WAVECAR', True), ('WAVECAR2.gz', False)]:
+			bwf = Wavefunction.from_files('CONTCAR', fname, 'POTCAR',
+				'vasprun.xml', lazy=lazy, bands=(5, 12))
+			assert_equal(bwf.band_start, 5)
+			assert_equal(bwf.nband, 8)
+			assert_equal(bwf._get_occs(), wf._get_occs()[5*nk:13*nk])
+			for b in range(bwf.nband):
+				assert_almost_equal(bwf.pseudoprojection(b, wf),
+					wf.pseudoprojection(b + 5, wf))
+		energies = wf._get_energy_list(range(wf.nband))
+		emin = min(e for e, occ in energies[6])
+		emax = max(e for e, occ in energies[8])
+		ewf = Wavefunction.from_directory('.', energy_window=(emin, emax))
+		assert ewf.band_start <= 6
+		assert ewf.band_start + ewf.nband - 1 >= 8
+		for b in range(ewf.nband):
+			assert_equal(ewf._get_energy_list([b])[b],
+				energies[b + ewf.band_start])
+		with assert_raises(ValueError):
+			Wavefunction.from_directory('.', bands=(3, 2))
+		with assert_raises(IOError):
+			Wavefunction.from_directory('.', energy_window=(1e5, 1e6))
+
+	def test_wavecar_header(self):
+		print("TEST WAVECAR HEADER")
+		sys.stdout.flush()
+		wf = Wavefunction.from_directory('.')
+		for fname in ['WAVECAR', 'WAVECAR2.gz']:
+			header = WavecarHeader(fname)
+			assert_equal(header.nband, wf.nband)
+			assert_equal(header.nwk, wf.nwk)
+			assert_equal(header.nspin, wf.nspin)
+			assert_almost_equal(header.encut, wf.encut)
+			assert_almost_equal(header.kpts, wf.kpts)
+			assert_almost_equal(header.lattice, wf.structure.lattice.matrix)
+			assert_equal(header.occupations.transpose(2,0,1).flatten(),
+				wf._get_occs())
+			energies = wf._get_energy_list(range(wf.nband))
+			for b in range(wf.nband):
+				assert_equal(header.energies[:,:,b].flatten(),
+					[e for e, occ in energies[b]])
+			bands = header.bands_in_window(-1, 1)
+			ewf = Wavefunction.from_directory('.', energy_window=(-1, 1))
+			assert_equal(bands, (ewf.band_start, ewf.band_start + ewf.nband - 1))
+		with assert_raises(FileNotFoundError):
+			WavecarHeader('NOTAWAVECAR')
+
+	def test_vasprun(self):
+		print("TEST VASPRUN")
+		sys.stdout.flush()
+		clear_vasprun_cache()
+		for fname in ['vasprun.xml', 'noncollinear/vasprun.xml']:
+			vr = Vasprun(fname)
+			vrd = read_vasprun(fname)
+			assert read_vasprun(fname) is vrd
+			for key in ['NGX', 'NGY', 'NGZ', 'SYMPREC', 'ISPIN']:
+				assert_equal(vrd.parameters[key], vr.parameters[key])
+			assert_almost_equal(vrd.actual_kpoints, vr.actual_kpoints)
+			assert_almost_equal(vrd.actual_kpoints_weights, vr.actual_kpoints_weights)
+			assert_equal(vrd.eigenvalue_band_properties, vr.eigenvalue_band_properties)
+			assert_equal(vrd.is_spin, vr.is_spin)
+			for spin in vr.eigenvalues:
+				assert_almost_equal(vrd.eigenvalues[spin], vr.eigenvalues[spin])
+			assert_almost_equal(vrd.tdos.efermi, vr.tdos.efermi)
+			assert_almost_equal(vrd.tdos.energies, vr.tdos.energies)
+			for spin in vr.tdos.densities:
+				assert_almost_equal(vrd.tdos.densities[spin], vr.tdos.densities[spin])
+		assert read_vasprun('.') is read_vasprun('vasprun.xml')
+
+	def test_save_load(self):
+		print("TEST SAVE LOAD")
+		sys.stdout.flush()
+		wf = Wavefunction.from_directory('.')
+		basis = Wavefunction.from_directory('.')
+		wf.save('wf_noproj.pwf')
+		wf.check_c_projectors()
+		wf.save('wf.pwf')
+		res = Projector(wf, basis).single_band_projection(6)
+		for fname, projector_owner in [('wf_noproj.pwf', 0), ('wf.pwf', 1)]:
+			lwf = Wavefunction.load(fname)
+			assert_equal(lwf.projector_owner, projector_owner)
+			assert_equal(lwf.nband, wf.nband)
+			assert_almost_equal(lwf.kpts, wf.kpts)
+			assert_almost_equal(lwf.kws, wf.kws)
+			assert_almost_equal(lwf.band_props, wf.band_props)
+			assert_equal(lwf.dim, wf.dim)
+			assert lwf.structure == wf.structure
+			assert_equal(lwf._get_occs(), wf._get_occs())
+			for b in range(wf.nband):
+				assert_almost_equal(lwf.pseudoprojection(b, wf),
+					wf.pseudoprojection(b, wf))
+			assert_almost_equal(Projector(lwf, basis).single_band_projection(6), res)
+		# save a loaded wavefunction over the file it is mapped from
+		lwf = Wavefunction.load('wf.pwf')
+		lwf.save('wf.pwf')
+		rwf = Wavefunction.load('wf.pwf')
+		assert_equal(rwf.projector_owner, 1)
+		for b in range(wf.nband):
+			assert_almost_equal(rwf.pseudoprojection(b, wf),
+				wf.pseudoprojection(b, wf))
+		assert_almost_equal(Projector(rwf, basis).single_band_projection(6), res)
+		# the projector method is kept, so lazily evaluated bands
+		# use the same method as the saved ones
+		wf = Wavefunction.from_directory('.')
+		wf.set_projector_method('recip')
+		wf.check_c_projectors()
+		wf.save('wf_recip.pwf')
+		lwf = Wavefunction.load('wf_recip.pwf')
+		assert_equal(lwf.projector_method, 'recip')
+		assert_equal(lwf.projector_owner, 1)
+		assert_equal(Wavefunction.load('wf.pwf').projector_method, 'real')
+		nwf = NCLWavefunction.from_directory('noncollinear', True)
+		nwf.save('ncl.pwf')
+		lwf = Wavefunction.load('ncl.pwf')
+		assert isinstance(lwf, NCLWavefunction)
+		for b in range(nwf.nband):
+			assert_almost_equal(lwf.pseudoprojection(b, nwf),
+				nwf.pseudoprojection(b, nwf))
+		with assert_raises(PAWpyError):
+			Wavefunction.load('CONTCAR')
+		for fname in ['wf_noproj.pwf', 'wf.pwf', 'wf_recip.pwf', 'ncl.pwf']:
+			os.remove(fname)
+
+	def test_pseudopotential_cache(self):
+		print("TEST PSEUDOPOTENTIAL CACHE")
+		sys.stdout.flush()
+		data = Potcar.from_file('POTCAR')[0].data[:-15]
+		clear_pseudopotential_cache()
+		set_pseudopotential_cache_dir('ppcache')
+		pp = load_pseudopotential(data)
+		assert load_pseudopotential(data) is pp
+		assert os.path.isfile(os.path.join('ppcache', pp.hash + '.pp1.npz'))
+		clear_pseudopotential_cache()
+		cpp = load_pseudopotential(data)
+		assert cpp is not pp
+		assert_equal(cpp.ls, pp.ls)
+		assert_almost_equal(cpp.rmax, pp.rmax)
+		assert_almost_equal(cpp.grid, pp.grid)
+		for name in ['pswaves', 'aewaves', 'realprojs', 'recipprojs']:
+			for arr1, arr2 in zip(getattr(cpp, name), getattr(pp, name)):
+				assert_almost_equal(arr1, arr2)
+		set_pseudopotential_cache_dir(None)
+		clear_pseudopotential_cache()
+		os.remove(os.path.join('ppcache', pp.hash + '.pp1.npz'))
+		os.rmdir('ppcache')
+
+	def test_shared_projector_list(self):
+		print("TEST SHARED PROJECTOR LIST")
+		sys.stdout.flush()
+		wf = Wavefunction.from_directory('.')
+		basis = Wavefunction.from_directory('.')
+		wf.check_c_projectors()
+		num_cached = len(pawpyc._PPOT_CACHE)
+		basis.check_c_projectors()
+		assert_equal(len(pawpyc._PPOT_CACHE), num_cached)
+		pp = list(wf.cr.pps.values())[0]
+		ppot = pawpyc.get_ppot_pointer(pp, 400.0)
+		assert pawpyc.get_ppot_pointer(pp, 400.0) is ppot
+		assert pawpyc.get_ppot_pointer(pp, 500.0) is not ppot
+
+	def test_fft_workspaces(self):
+		print("TEST FFT WORKSPACES")
+		sys.stdout.flush()
+		wf = Wavefunction.from_directory('.')
+		state1 = wf.get_state_realspace(0, 0, 0)
+		pawpyc.free_fft_workspaces()
+		state2 = wf.get_state_realspace(0, 0, 0)
+		state3 = wf.get_state_realspace(0, 0, 0)
+		assert_equal(state1, state2)
+		assert_equal(state2, state3)
+
+	def test_recip_projections(self):
+		print("TEST RECIP PROJECTIONS")
+		sys.stdout.flush()
+		wf = Wavefunction.from_directory('.')
+		rwf = Wavefunction.from_directory('.')
+		with assert_raises(ValueError):
+			rwf.set_projector_method('fft')
+		rwf.set_projector_method('recip')
+		assert_equal(rwf.desymmetrized_copy().projector_method, 'recip')
+		for s in range(wf.nspin):
+			for k in range(wf.nwk):
+				assert_almost_equal(rwf.projections(k, s), wf.projections(k, s), decimal=3)
+		with assert_raises(PAWpyError):
+			rwf.set_projector_method('real')
+
+	def test_lazy_projections(self):
+		print("TEST LAZY PROJECTIONS")
+		sys.stdout.flush()
+		wf = Wavefunction.from_directory('.')
+		wf.check_c_projectors()
+		lwf = Wavefunction.from_directory('.')
+		assert_equal(lwf.get_state_realspace(1, 0, 0), wf.get_state_realspace(1, 0, 0))
+		assert lwf.projector_owner
+		projs = lwf._get_projections(0, 0)
+		assert_equal(projs[1], wf.projections(0, 0)[1])
+		assert_equal(projs[0], 0)
+		assert_equal(lwf.projections(0, 0), wf.projections(0, 0))
+		lwf.check_c_projectors()
+		for s in range(wf.nspin):
+			for k in range(wf.nwk):
+				assert_equal(lwf.projections(k, s), wf.projections(k, s))
+
+	def test_projector_memory_budget(self):
+		print("TEST PROJECTOR MEMORY BUDGET")
+		sys.stdout.flush()
+		wf = Wavefunction.from_directory('.')
+		wf.check_c_projectors()
+		budget = pawpyc.get_projector_memory_budget()
+		pawpyc.set_projector_memory_budget(1)
+		try:
+			swf = Wavefunction.from_directory('.')
+			swf.check_c_projectors()
+		finally:
+			pawpyc.set_projector_memory_budget(budget)
+		for s in range(wf.nspin):
+			for k in range(wf.nwk):
+				assert_equal(swf.projections(k, s), wf.projections(k, s))
+
+	def test_accessors(self):
+		print("TEST ACCESSORS")
+		sys.stdout.flush()
+		wf = Wavefunction.from_directory('.')
+		lwf = Wavefunction.from_directory('.', lazy=True)
+		vr = Vasprun('vasprun.xml')
+		nk = wf.nwk * wf.nspin
+		for s, spin in enumerate([Spin.up, Spin.down]):
+			assert_almost_equal(wf.eigenvalues[s], vr.eigenvalues[spin][:,:,0], decimal=3)
+			assert_almost_equal(wf.occupations[s], vr.eigenvalues[spin][:,:,1], decimal=3)
+		assert_equal(wf.occupations.transpose(2,0,1).flatten(), wf._get_occs())
+		assert not wf.eigenvalues.flags.writeable
+		for b in range(0, wf.nband, 5):
+			overlaps = wf.pseudoprojection(b, wf).reshape(wf.nband, nk)
+			for s in range(wf.nspin):
+				for k in range(wf.nwk):
+					coeffs = wf.coefficients(k, s)
+					assert_equal(coeffs.shape[0], wf.nband)
+					assert not coeffs.flags.writeable
+					assert_equal(lwf.coefficients(k, s), coeffs)
+					assert_almost_equal(coeffs.conj().dot(coeffs[b]),
+						overlaps[:,k+s*wf.nwk], decimal=5)
+		with assert_raises(ValueError):
+			wf.coefficients(wf.nwk, 0)
+		wf.check_c_projectors()
+		indices = wf.projection_indices()
+		for s in range(wf.nspin):
+			for k in range(wf.nwk):
+				projs = wf.projections(k, s)
+				assert_equal(projs.shape, (wf.nband, len(indices)))
+		assert_equal(np.unique(indices[:,0]), np.arange(len(wf.structure)))
+
+	def test_compressed(self):
+		print("TEST COMPRESSED")
+		sys.stdout.flush()
+		import bz2
+		try:
+			with open('WAVECAR', 'rb') as f, bz2.open('WAVECAR.bz2', 'wb') as fbz:
+				fbz.write(f.read())
+			wf = Wavefunction.from_files('CONTCAR', 'WAVECAR',
+				'POTCAR', 'vasprun.xml')
+			for fname in ['WAVECAR2.gz', 'WAVECAR.bz2']:
+				cwf = Wavefunction.from_files('CONTCAR', fname,
+					'POTCAR', 'vasprun.xml')
+				assert_equal(cwf._get_occs(), wf._get_occs())
+				for b in range(wf.nband):
+					assert_almost_equal(cwf.pseudoprojection(b, wf),
+						wf.pseudoprojection(b, wf))
+			# a compressed WAVECAR that ends early is an error
+			with open('WAVECAR2.gz', 'rb') as f:
+				data = f.read()
+			with open('WAVECAR_cut.gz', 'wb') as f:
+				f.write(data[:len(data)//2])
+			with assert_raises(IOError):
+				Wavefunction.from_files('CONTCAR', 'WAVECAR_cut.gz',
+					'POTCAR', 'vasprun.xml')
+		finally:
+			for fname in ['WAVECAR.bz2', 'WAVECAR_cut.gz']:
+				if os.path.exists(fname):
+					os.remove(fname)
+
 	def test_projector(self):
 		print("TEST PROJ")
 		sys.stdout.flush()
@@ -589,6 +890,102 @@ class TestPy:
 		for wf_dir, wf in generator:
 			wf.defect_band_analysis(4, 10, spinpol=True)
 
+	def test_overlap_matrix(self):
+		print("TEST OVERLAP MATRIX")
+		sys.stdout.flush()
+		wf1 = Wavefunction.from_directory('.', False)
+		basis = Wavefunction.from_directory('.', False)
+		for method in ['pseudo', 'aug_real', 'aug_recip']:
+			pr = Projector(wf1, basis, method = method)
+			res = pr.overlap_matrix()
+			assert_equal(res.shape, (wf1.nband, basis.nband * basis.nwk * basis.nspin))
+			for b in range(wf1.nband):
+				assert_almost_equal(res[b], pr.single_band_projection(b), decimal=5)
+			res = pr.overlap_matrix([3, 1])
+			assert_almost_equal(res[0], pr.single_band_projection(3), decimal=5)
+			assert_almost_equal(res[1], pr.single_band_projection(1), decimal=5)
+		with assert_raises(ValueError):
+			pr.overlap_matrix([wf1.nband])
+
+	def test_site_lists(self):
+		print("TEST SITE LISTS")
+		sys.stdout.flush()
+		wf1 = Wavefunction.from_directory('.', False)
+		basis = Wavefunction.from_directory('.', False)
+		pr = Projector(wf1, basis)
+		M_R, M_S, N_R, N_S, N_RS = pr.make_site_lists()
+		assert_equal(M_R, np.arange(len(basis.structure)))
+		assert_equal(M_S, np.arange(len(wf1.structure)))
+		assert_equal(len(N_R), 0)
+		assert_equal(len(N_S), 0)
+		assert_equal(N_RS.shape, (0, 2))
+		structure = wf1.structure.copy()
+		structure.translate_sites([0], [0.01, 0.02, -0.03])
+		structure.translate_sites([1], [0.05, 0, 0])
+		wf1.structure = structure
+		M_R, M_S, N_R, N_S, N_RS = pr.make_site_lists()
+		N_RS_ref = []
+		for i in N_R:
+			for j in N_S:
+				rmax1 = basis.cr.pps[el(basis.structure[i])].rmax
+				rmax2 = wf1.cr.pps[el(structure[j])].rmax
+				if basis.structure[i].distance(structure[j]) < rmax1 + rmax2:
+					N_RS_ref.append((i,j))
+		assert_equal(M_R, M_S)
+		assert 0 not in M_R and 1 not in M_R
+		assert_equal(np.sort(np.concatenate((M_R, N_R))), np.arange(len(structure)))
+		assert_equal(N_RS, np.array(N_RS_ref).reshape(-1, 2))
+
+	def test_overlap_setup_reuse(self):
+		print("TEST OVERLAP SETUP REUSE")
+		sys.stdout.flush()
+		budget = pawpyc.get_projector_memory_budget()
+		try:
+			# a budget of 0 means that the caches are not limited
+			for limit in [0, budget]:
+				pawpyc.set_projector_memory_budget(limit)
+				basis = Wavefunction.from_directory('.', False)
+				wf = Wavefunction.from_directory('.', False)
+				for method in ['aug_real', 'aug_recip']:
+					ref = Projector(wf, basis, method = method).overlap_matrix()
+					fresh = Wavefunction.from_directory('.', False)
+					dummy_ref = DummyProjector(wf, fresh, method = method).overlap_matrix()
+					assert_almost_equal(DummyProjector(wf, basis, method = method).overlap_matrix(),
+						dummy_ref, decimal=6)
+					# setups that do not use the cached sites keep them,
+					# also once no projector refers to them anymore
+					gc.collect()
+					assert_almost_equal(Projector(wf, basis, method = method).overlap_matrix(),
+						ref, decimal=6)
+					gc.collect()
+					num_wp, num_aug, hits = basis._overlap_cache_info()
+					assert num_wp > 0
+					# the basis-side terms of the earlier setups are reused
+					assert_almost_equal(DummyProjector(wf, basis, method = method).overlap_matrix(),
+						dummy_ref, decimal=6)
+					assert basis._overlap_cache_info()[2] > hits
+		finally:
+			pawpyc.set_projector_memory_budget(budget)
+
+	def test_concurrent_projectors(self):
+		print("TEST CONCURRENT PROJECTORS")
+		sys.stdout.flush()
+		basis = Wavefunction.from_directory('.', False)
+		wf = Wavefunction.from_directory('.', False)
+		for method in ['aug_real', 'aug_recip']:
+			pr = Projector(wf, basis, method = method)
+			ref = pr.overlap_matrix()
+			# setting up other projectors onto the same basis must not
+			# change the overlaps of one that is still in use
+			other = DummyProjector(wf, basis, method = method)
+			other_ref = other.overlap_matrix()
+			selfpr = Projector(basis, basis, method = method)
+			selfpr.overlap_matrix()
+			assert_almost_equal(pr.overlap_matrix(), ref, decimal=10)
+			assert_almost_equal(other.overlap_matrix(), other_ref, decimal=10)
+			del other, selfpr
+			assert_almost_equal(pr.overlap_matrix(), ref, decimal=10)
+
 	def test_offsite(self):
 		Projector = DummyProjector
 		print("TEST OFFSITE")
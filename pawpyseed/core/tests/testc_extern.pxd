@@ -27,6 +27,8 @@ cdef extern from "utils.h":
         double** smooth_diffwave_spline
         double* dense_kwave
         double** dense_kwave_spline
+        double* kproj
+        double** kproj_spline
     ctypedef struct  ppot_t:
         int num_projs
         int total_projs
@@ -45,6 +47,10 @@ cdef extern from "utils.h":
         double* proj_grid
         double* smooth_grid
         double* dense_kgrid
+        int kproj_gridsize
+        double kproj_max
+        double* kproj_grid
+        int shared_data
     ctypedef struct  projection_t:
         int num_projs
         int total_projs
@@ -76,26 +82,9 @@ cdef extern from "utils.h":
         double weight
         int num_bands
         band_t** bands
+        band_t* band_block
+        float complex* coeffs
         rayleigh_set_t** expansion
-    ctypedef struct  pswf_t:
-        double encut
-        int num_elems
-        int* num_projs
-        int num_sites
-        ppot_t* pps
-        int* G_bounds
-        kpoint_t** kpts
-        int nspin
-        int nband
-        int nwk
-        double* lattice
-        double* reclattice
-        int* fftg
-        int is_ncl
-        int wp_num
-        int num_aug_overlap_sites
-        double* dcoords
-        double complex** overlaps
     ctypedef struct  projgrid_t:
         double complex* values
     ctypedef struct  real_proj_t:
@@ -115,6 +104,57 @@ cdef extern from "utils.h":
         int* indices
         double* paths
         real_proj_t* projs
+    ctypedef struct  wave_proj_cache_t:
+        int elem
+        double coord[3]
+        int fftg[3]
+        int total_projs
+        int refs
+        int cached
+        long last_use
+        double complex* overlaps
+        wave_proj_cache_t* next
+    ctypedef struct  aug_freqs_cache_t:
+        int num_sites
+        int* sites
+        int refs
+        int cached
+        long last_use
+        int num_states
+        long size
+        float complex** CAs
+        aug_freqs_cache_t* next
+    ctypedef struct  pswf_t:
+        double encut
+        int num_elems
+        int* num_projs
+        int num_sites
+        ppot_t* pps
+        int* G_bounds
+        kpoint_t** kpts
+        int nspin
+        int nband
+        int band_start
+        int nwk
+        double* lattice
+        double* reclattice
+        int* fftg
+        int is_ncl
+        char* wc_map
+        long wc_map_size
+        projection_t* proj_block
+        double complex* overlap_block
+        int* nlm_block
+        char* proj_done
+        int proj_method
+        int* proj_labels
+        double* proj_coords
+        real_proj_site_t* proj_sites
+        int wp_num
+        wave_proj_cache_t* wp_cache
+        aug_freqs_cache_t* aug_cache
+        long wp_clock
+        long wp_hits
     cdef void affine_transform(double* out, double* op, double* inv)
     cdef void rotation_transform(double* out, double* op, double* inv)
     cdef int min(int a, int b)
@@ -131,7 +171,12 @@ cdef extern from "utils.h":
     cdef double complex trilinear_interpolate(double complex* c, double* frac, int* fftg)
     cdef void free_projection_list(projection_t* projlist, int num)
     cdef void clean_wave_projections(pswf_t* wf)
+    cdef void free_aug_freqs_entry(aug_freqs_cache_t* entry)
+    cdef void free_overlap_caches(pswf_t* wf)
     cdef void free_kpoint(kpoint_t* kpt, int num_elems, int num_sites, int wp_num, int* num_projs)
+    cdef void alloc_kpoint_bands(kpoint_t* kpt, int num_bands, int alloc_coeffs)
+    cdef void alloc_projection_block(pswf_t* wf, int* num_projs, int* total_projs,
+        int* ns, int* ls, int* ms)
     cdef void free_ppot(ppot_t* pp)
     cdef void free_real_proj(real_proj_t* proj)
     cdef void free_real_proj_site(real_proj_site_t* site)
@@ -141,6 +186,7 @@ cdef extern from "utils.h":
     cdef void free_ppot_list(ppot_t* pps, int length)
     cdef double* get_occs(pswf_t* wf)
     cdef int get_nband(pswf_t* wf)
+    cdef int get_band_start(pswf_t* wf)
     cdef int get_nwk(pswf_t* wf)
     cdef int get_nspin(pswf_t* wf)
     cdef int is_ncl(pswf_t* wf)
@@ -170,9 +216,11 @@ cdef extern from "utils.h":
         int l, int m, double* pos)
     cdef void setup_site(real_proj_site_t* sites, ppot_t* pps, int num_sites, int* site_nums,
         int* labels, double* coords, double* lattice, int* fftg, int pr0_pw1)
+    cdef void free_site_templates(funcset_t* funcs)
     cdef double** spline_coeff(double* x, double* y, int N)
     cdef double spline_integral(double* x, double* a, double** s, int size)
     cdef void frac_from_index(int index, double* coord, int* fftg)
+    cdef void direction(double* cart, double* dir)
     cdef double sph_bessel(double k, double r, int l)
     cdef double sbf(double x, int l)
     cdef pswf_t* expand_symm_wf(pswf_t* rwf, int num_kpts, int* maps,
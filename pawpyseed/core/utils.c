@@ -5,13 +5,18 @@
 #include <math.h>
 #include <omp.h>
 #include <time.h>
+#include <sys/mman.h>
 #include <mkl.h>
 #include <mkl_types.h>
 #include "utils.h"
+#include "gsphere.h"
+#include "radial.h"
 
 #define PI 3.14159265358979323846
 #define CCONST 0.262465831
 #define OPSIZE 9
+#define SITE_TEMPLATE_TOL 1e-8
+#define MAX_SITE_TEMPLATE_BYTES (256l << 20)
 
 void affine_transform(double* out, double* op, double* inv) {
 	//0 1 2 3
@@ -191,10 +196,41 @@ void clean_wave_projections(pswf_t* wf) {
 
 }
 
+void free_aug_freqs_entry(aug_freqs_cache_t* entry) {
+	for (int i = 0; i < entry->num_states; i++) {
+		mkl_free(entry->CAs[i]);
+	}
+	free(entry->CAs);
+	free(entry->sites);
+	free(entry);
+}
+
+void free_overlap_caches(pswf_t* wf) {
+	while (wf->wp_cache != NULL) {
+		wave_proj_cache_t* entry = wf->wp_cache;
+		wf->wp_cache = entry->next;
+		entry->cached = 0;
+		if (entry->refs == 0) {
+			free(entry->overlaps);
+			free(entry);
+		}
+	}
+	while (wf->aug_cache != NULL) {
+		aug_freqs_cache_t* entry = wf->aug_cache;
+		wf->aug_cache = entry->next;
+		entry->cached = 0;
+		if (entry->refs == 0) {
+			free_aug_freqs_entry(entry);
+		}
+	}
+}
+
 void free_kpoint(kpoint_t* kpt, int num_elems, int num_sites, int wp_num, int* num_projs) {
 	for (int b = 0; b < kpt->num_bands; b++) {
 		band_t* curr_band = kpt->bands[b];
-		free(curr_band->Cs);
+		if (kpt->coeffs == NULL) {
+			free(curr_band->Cs);
+		}
 		if (curr_band->projections != NULL) {
 			free_projection_list(curr_band->projections, num_sites);
 		}
@@ -213,20 +249,100 @@ void free_kpoint(kpoint_t* kpt, int num_elems, int num_sites, int wp_num, int* n
 		if (curr_band->CAs != NULL) {
 			mkl_free(curr_band->CAs);
 		}
-		free(curr_band);
+		if (kpt->band_block == NULL) {
+			free(curr_band);
+		}
 	}
 	if (kpt->expansion != NULL) {
 		for (int i = 0; i < num_elems; i++)
 			free_rayleigh_set_list(kpt->expansion[i], num_projs[i]);
 		free(kpt->expansion);
 	}
-	free(kpt->Gs);
+	release_gsphere(kpt->Gs);
+	free(kpt->coeffs);
+	free(kpt->band_block);
 	free(kpt->bands);
 	free(kpt->k);
 	free(kpt);
 }
 
+void alloc_kpoint_bands(kpoint_t* kpt, int num_bands, int alloc_coeffs) {
+	kpt->num_bands = num_bands;
+	kpt->bands = (band_t**) malloc(num_bands * sizeof(band_t*));
+	kpt->band_block = (band_t*) malloc(num_bands * sizeof(band_t));
+	CHECK_ALLOCATION(kpt->bands);
+	CHECK_ALLOCATION(kpt->band_block);
+	kpt->coeffs = NULL;
+	if (alloc_coeffs) {
+		kpt->coeffs = (float complex*) malloc((long) num_bands * kpt->num_waves
+			* sizeof(float complex));
+		CHECK_ALLOCATION(kpt->coeffs);
+	}
+	for (int b = 0; b < num_bands; b++) {
+		band_t* band = kpt->band_block + b;
+		band->num_waves = kpt->num_waves;
+		band->Cs = alloc_coeffs ? kpt->coeffs + (long) b * kpt->num_waves : NULL;
+		band->CRs = NULL;
+		band->CAs = NULL;
+		band->projections = NULL;
+		band->up_projections = NULL;
+		band->down_projections = NULL;
+		band->wave_projections = NULL;
+		kpt->bands[b] = band;
+	}
+}
+
+void alloc_projection_block(pswf_t* wf, int* num_projs, int* total_projs,
+	int* ns, int* ls, int* ms) {
+
+	if (wf->proj_block != NULL) {
+		return;
+	}
+	int num_sites = wf->num_sites;
+	int num_lists = wf->is_ncl ? 3 : 1;
+	long num_bands = (long) wf->nwk * wf->nspin * wf->nband;
+	int nlm_size = 0;
+	for (int s = 0; s < num_sites; s++) {
+		nlm_size += total_projs[s];
+	}
+	wf->nlm_block = (int*) malloc(3 * nlm_size * sizeof(int));
+	wf->proj_block = (projection_t*) malloc(num_lists * num_bands * num_sites
+		* sizeof(projection_t));
+	wf->overlap_block = (double complex*) calloc(num_lists * num_bands * nlm_size,
+		sizeof(double complex));
+	CHECK_ALLOCATION(wf->nlm_block);
+	CHECK_ALLOCATION(wf->proj_block);
+	CHECK_ALLOCATION(wf->overlap_block);
+	memcpy(wf->nlm_block, ns, nlm_size * sizeof(int));
+	memcpy(wf->nlm_block + nlm_size, ls, nlm_size * sizeof(int));
+	memcpy(wf->nlm_block + 2 * nlm_size, ms, nlm_size * sizeof(int));
+
+	for (long w = 0; w < num_lists * num_bands; w++) {
+		projection_t* projs = wf->proj_block + w * num_sites;
+		double complex* overlaps = wf->overlap_block + w * nlm_size;
+		int offset = 0;
+		for (int s = 0; s < num_sites; s++) {
+			projs[s].num_projs = num_projs[s];
+			projs[s].total_projs = total_projs[s];
+			projs[s].ns = wf->nlm_block + offset;
+			projs[s].ls = wf->nlm_block + nlm_size + offset;
+			projs[s].ms = wf->nlm_block + 2 * nlm_size + offset;
+			projs[s].overlaps = overlaps + offset;
+			offset += total_projs[s];
+		}
+		int list_num = w / num_bands;
+		int k = (w % num_bands) / wf->nband;
+		int b = w % wf->nband;
+		band_t* band = wf->kpts[k]->bands[b];
+		if (list_num == 0) band->projections = projs;
+		else if (list_num == 1) band->up_projections = projs;
+		else band->down_projections = projs;
+	}
+}
+
 void free_ppot(ppot_t* pp) {
+	free_site_templates(pp->funcs);
+	free_offsite_tables(pp->funcs);
 	for (int i = 0; i < pp->num_projs; i++) {
 		free(pp->funcs[i].proj);
 		free(pp->funcs[i].pswave);
@@ -234,6 +350,7 @@ void free_ppot(ppot_t* pp) {
 		free(pp->funcs[i].diffwave);
 		free(pp->funcs[i].kwave);
 		free(pp->funcs[i].smooth_diffwave);
+		free(pp->funcs[i].kproj);
 		for (int j = 0; j < 3; j++) {
 			free(pp->funcs[i].proj_spline[j]);
 			free(pp->funcs[i].aewave_spline[j]);
@@ -241,6 +358,7 @@ void free_ppot(ppot_t* pp) {
 			free(pp->funcs[i].diffwave_spline[j]);
 			free(pp->funcs[i].kwave_spline[j]);
 			free(pp->funcs[i].smooth_diffwave_spline[j]);
+			free(pp->funcs[i].kproj_spline[j]);
 		}
 		free(pp->funcs[i].proj_spline);
 		free(pp->funcs[i].aewave_spline);
@@ -248,12 +366,14 @@ void free_ppot(ppot_t* pp) {
 		free(pp->funcs[i].diffwave_spline);
 		free(pp->funcs[i].kwave_spline);
 		free(pp->funcs[i].smooth_diffwave_spline);
+		free(pp->funcs[i].kproj_spline);
 	}
 	free(pp->funcs);
 	free(pp->wave_grid);
 	free(pp->kwave_grid);
 	free(pp->proj_grid);
 	free(pp->smooth_grid);
+	free(pp->kproj_grid);
 	free(pp->pspw_overlap_matrix);
 	free(pp->aepw_overlap_matrix);
 	free(pp->diff_overlap_matrix);
@@ -264,16 +384,43 @@ void free_real_proj(real_proj_t* proj) {
 }
 
 void free_pswf(pswf_t* wf) {
+	if (wf->wc_map != NULL) {
+		// the coefficients point into the WAVECAR map,
+		// which is released as a whole below
+		for (int i = 0; i < wf->nwk * wf->nspin; i++) {
+			for (int b = 0; b < wf->kpts[i]->num_bands; b++)
+				wf->kpts[i]->bands[b]->Cs = NULL;
+			wf->kpts[i]->coeffs = NULL;
+		}
+	}
+	if (wf->proj_block != NULL) {
+		// the projections point into proj_block, freed below
+		for (int i = 0; i < wf->nwk * wf->nspin; i++) {
+			for (int b = 0; b < wf->kpts[i]->num_bands; b++) {
+				wf->kpts[i]->bands[b]->projections = NULL;
+				wf->kpts[i]->bands[b]->up_projections = NULL;
+				wf->kpts[i]->bands[b]->down_projections = NULL;
+			}
+		}
+	}
 	for (int i = 0; i < wf->nwk * wf->nspin; i++)
 		free_kpoint(wf->kpts[i], wf->num_elems, wf->num_sites, wf->wp_num, wf->num_projs);
-	if (wf->overlaps != NULL) {
-		for (int i = 0; i < wf->num_aug_overlap_sites; i++)
-			free(wf->overlaps[i]);
-		free(wf->overlaps);
+	if (wf->wc_map != NULL) {
+		munmap(wf->wc_map, wf->wc_map_size);
 	}
 	if (wf->num_projs != NULL) {
 		free(wf->num_projs);
 	}
+	free(wf->proj_block);
+	free(wf->overlap_block);
+	free(wf->nlm_block);
+	free(wf->proj_done);
+	free(wf->proj_labels);
+	free(wf->proj_coords);
+	if (wf->proj_sites != NULL) {
+		free_real_proj_site_list(wf->proj_sites, wf->num_sites);
+	}
+	free_overlap_caches(wf);
 	free(wf->kpts);
 	free(wf->G_bounds);
 	free(wf->lattice);
@@ -281,9 +428,6 @@ void free_pswf(pswf_t* wf) {
 	if (wf->pps != NULL) {
 		free_ppot_list(wf->pps, wf->num_elems);
 	}
-	if (wf->dcoords != NULL) {
-		free(wf->dcoords);
-	}
 	if (wf->fftg != NULL) {
 		free(wf->fftg);
 	}
@@ -291,8 +435,9 @@ void free_pswf(pswf_t* wf) {
 }
 
 void free_real_proj_site(real_proj_site_t* site) {
-	for (int i = 0; i < site->total_projs; i++) {
-		free_real_proj(site->projs + i);
+	if (site->total_projs > 0) {
+		// the values of all the projectors are in one block (see setup_site)
+		free(site->projs[0].values);
 	}
 	free(site->projs);
 	free(site->indices);
@@ -313,7 +458,9 @@ void free_real_proj_site_list(real_proj_site_t* sites, int length) {
 
 void free_ppot_list(ppot_t* pps, int length) {
 	for (int i = 0; i < length; i++) {
-		free_ppot(pps + i);
+		if (!pps[i].shared_data) {
+			free_ppot(pps + i);
+		}
 	}
 	free(pps);
 }
@@ -349,6 +496,10 @@ int get_nband(pswf_t* wf) {
 	return wf->nband;
 }
 
+int get_band_start(pswf_t* wf) {
+	return wf->band_start;
+}
+
 int get_nwk(pswf_t* wf) {
 	return wf->nwk;
 }
@@ -567,6 +718,142 @@ double complex smooth_wave_value(funcset_t funcs, double* x, int m, double rmax,
 		funcs.smooth_diffwave_spline, funcs.l, m);
 }
 
+/*
+The real space grid points within the projector (pr0_pw1=0) or partial
+wave difference (pr0_pw1=1) sphere of a site, and the values of each
+function at those points. These only depend on the element, the offset
+of the site from the nearest FFT grid point, the lattice and the FFT
+grid, so setup_site computes them once and copies them to every site
+(of any wavefunction) with the same element and offset.
+*/
+typedef struct site_template {
+	funcset_t* funcs; ///< radial data of the element
+	int pr0_pw1; ///< 0 for projectors, 1 for partial wave differences
+	double offset[3]; ///< fractional offset of the site from the nearest grid point
+	double lattice[9]; ///< lattice
+	int fftg[3]; ///< FFT grid dimensions
+	int num_indices; ///< number of grid points in the sphere
+	int total_projs; ///< number of functions
+	int* deltas; ///< grid point positions relative to the nearest grid point, in sets of three
+	double* paths; ///< cartesian vectors from the site to each grid point
+	double complex* values; ///< [total_projs][num_indices] function values
+	long size; ///< number of bytes allocated for the arrays above
+	struct site_template* next; ///< next template in the cache
+} site_template_t;
+
+static site_template_t* site_templates = NULL;
+static long site_templates_size = 0;
+
+static int site_template_matches(site_template_t* tmp, funcset_t* funcs,
+	int pr0_pw1, double* offset, double* lattice, int* fftg) {
+
+	if (tmp->funcs != funcs || tmp->pr0_pw1 != pr0_pw1) return 0;
+	for (int d = 0; d < 3; d++) {
+		if (tmp->fftg[d] != fftg[d]) return 0;
+		if (fabs(tmp->offset[d] - offset[d]) * fftg[d] > SITE_TEMPLATE_TOL) return 0;
+	}
+	for (int d = 0; d < 9; d++) {
+		if (tmp->lattice[d] != lattice[d]) return 0;
+	}
+	return 1;
+}
+
+static void free_site_template(site_template_t* tmp) {
+	free(tmp->deltas);
+	free(tmp->paths);
+	free(tmp->values);
+	free(tmp);
+}
+
+void free_site_templates(funcset_t* funcs) {
+	site_template_t** tmp_ptr = &site_templates;
+	while (*tmp_ptr != NULL) {
+		site_template_t* tmp = *tmp_ptr;
+		if (funcs == NULL || tmp->funcs == funcs) {
+			*tmp_ptr = tmp->next;
+			site_templates_size -= tmp->size;
+			free_site_template(tmp);
+		}
+		else {
+			tmp_ptr = &(tmp->next);
+		}
+	}
+}
+
+static void make_site_template(site_template_t* tmp, ppot_t* pp,
+	int max_indices, double vol) {
+
+	double* lattice = tmp->lattice;
+	int* fftg = tmp->fftg;
+	double rmax = tmp->pr0_pw1 ? pp->wave_rmax : pp->rmax;
+	double res[3] = {0,0,0};
+	double frac[3] = {0,0,0};
+	double testcoord[3] = {0,0,0};
+	vcross(res, lattice+3, lattice+6);
+	int grid1 = (int) (mag(res) * rmax / vol * fftg[0]) + 1;
+	vcross(res, lattice+0, lattice+6);
+	int grid2 = (int) (mag(res) * rmax / vol * fftg[1]) + 1;
+	vcross(res, lattice+0, lattice+3);
+	int grid3 = (int) (mag(res) * rmax / vol * fftg[2]) + 1;
+	double R0 = (pp->proj_gridsize-1) * rmax / pp->proj_gridsize;
+
+	tmp->total_projs = pp->total_projs;
+	tmp->num_indices = 0;
+	tmp->deltas = (int*) malloc(3 * max_indices * sizeof(int));
+	tmp->paths = (double*) malloc(3 * max_indices * sizeof(double));
+	CHECK_ALLOCATION(tmp->deltas);
+	CHECK_ALLOCATION(tmp->paths);
+	for (int i = -grid1; i <= grid1; i++) {
+		for (int j = -grid2; j <= grid2; j++) {
+			for (int k = -grid3; k <= grid3; k++) {
+				testcoord[0] = (double) i / fftg[0] - tmp->offset[0];
+				testcoord[1] = (double) j / fftg[1] - tmp->offset[1];
+				testcoord[2] = (double) k / fftg[2] - tmp->offset[2];
+				frac_to_cartesian(testcoord, lattice);
+				if (mag(testcoord) < R0) {
+					int ind = tmp->num_indices;
+					tmp->deltas[3*ind+0] = i;
+					tmp->deltas[3*ind+1] = j;
+					tmp->deltas[3*ind+2] = k;
+					tmp->paths[3*ind+0] = testcoord[0];
+					tmp->paths[3*ind+1] = testcoord[1];
+					tmp->paths[3*ind+2] = testcoord[2];
+					tmp->num_indices++;
+				}
+			}
+		}
+	}
+
+	tmp->deltas = (int*) realloc(tmp->deltas, 3 * tmp->num_indices * sizeof(int));
+	tmp->paths = (double*) realloc(tmp->paths, 3 * tmp->num_indices * sizeof(double));
+	tmp->values = (double complex*) malloc(tmp->total_projs * tmp->num_indices
+		* sizeof(double complex));
+	CHECK_ALLOCATION(tmp->deltas);
+	CHECK_ALLOCATION(tmp->paths);
+	CHECK_ALLOCATION(tmp->values);
+
+	int n = 0;
+	for (int j = 0; j < pp->num_projs; j++) {
+		for (int m = -pp->funcs[j].l; m <= pp->funcs[j].l; m++) {
+			double complex* values = tmp->values + n * tmp->num_indices;
+			for (int ind = 0; ind < tmp->num_indices; ind++) {
+				frac[0] = (double) tmp->deltas[3*ind+0] / fftg[0];
+				frac[1] = (double) tmp->deltas[3*ind+1] / fftg[1];
+				frac[2] = (double) tmp->deltas[3*ind+2] / fftg[2];
+				if (tmp->pr0_pw1)
+					values[ind] = smooth_wave_value(pp->funcs[j], pp->smooth_grid,
+						m, rmax, pp->proj_gridsize, tmp->offset, frac, lattice);
+				else
+					values[ind] = proj_value(pp->funcs[j], pp->proj_grid,
+						m, rmax, pp->proj_gridsize, tmp->offset, frac, lattice);
+			}
+			n++;
+		}
+	}
+	tmp->size = tmp->num_indices * (3 * sizeof(int) + 3 * sizeof(double)
+		+ tmp->total_projs * sizeof(double complex));
+}
+
 void setup_site(real_proj_site_t* sites, ppot_t* pps, int num_sites, int* site_nums,
 	int* labels, double* coords, double* lattice, int* fftg, int pr0_pw1) {
 
@@ -587,80 +874,122 @@ void setup_site(real_proj_site_t* sites, ppot_t* pps, int num_sites, int* site_n
 		sites[s].coord[0] = coords[3*i+0];
 		sites[s].coord[1] = coords[3*i+1];
 		sites[s].coord[2] = coords[3*i+2];
-		sites[s].indices = calloc(pps[labels[i]].num_cart_gridpts, sizeof(int));
-		CHECK_ALLOCATION(sites[s].indices);
 		sites[s].projs = (real_proj_t*) malloc(sites[s].total_projs * sizeof(real_proj_t));
 		int p = 0;
-		sites[s].paths = malloc(3*pps[labels[i]].num_cart_gridpts * sizeof(double));
-		CHECK_ALLOCATION(sites[s].paths);
 		for (int j = 0; j < sites[s].num_projs; j++) {
 			for (int m = -pps[labels[i]].funcs[j].l; m <= pps[labels[i]].funcs[j].l; m++) {
 				sites[s].projs[p].l = pps[labels[i]].funcs[j].l;
 				sites[s].projs[p].m = m;
 				sites[s].projs[p].func_num = j;
-				sites[s].projs[p].values = malloc(pps[labels[i]].num_cart_gridpts * sizeof(double complex));
-				CHECK_ALLOCATION(sites[s].projs[p].values);
+				sites[s].projs[p].values = NULL;
 				p++;
 			}
 		}
 	}
 
-	//#pragma omp parallel for
+	// find the template for each site, and make the ones not in the cache
+	site_template_t** site_tmps = (site_template_t**) malloc(num_sites * sizeof(site_template_t*));
+	site_template_t** new_tmps = (site_template_t**) malloc(num_sites * sizeof(site_template_t*));
+	int* new_labels = (int*) malloc(num_sites * sizeof(int));
+	int* centers = (int*) malloc(3 * num_sites * sizeof(int));
+	CHECK_ALLOCATION(site_tmps);
+	CHECK_ALLOCATION(new_tmps);
+	CHECK_ALLOCATION(new_labels);
+	CHECK_ALLOCATION(centers);
+	int num_new = 0;
 	for (int s = 0; s < num_sites; s++) {
 		int p = site_nums[s];
-		double res[3] = {0,0,0};
-		double frac[3] = {0,0,0};
-		double testcoord[3] = {0,0,0};
-		vcross(res, lattice+3, lattice+6);
-		int grid1 = (int) (mag(res) * sites[s].rmax / vol * fftg[0]) + 1;
-		vcross(res, lattice+0, lattice+6);
-		int grid2 = (int) (mag(res) * sites[s].rmax / vol * fftg[1]) + 1;
-		vcross(res, lattice+0, lattice+3);
-		int grid3 = (int) (mag(res) * sites[s].rmax / vol * fftg[2]) + 1;
-		int center1 = (int) round(coords[3*p+0] * fftg[0]);
-		int center2 = (int) round(coords[3*p+1] * fftg[1]);
-		int center3 = (int) round(coords[3*p+2] * fftg[2]);
-		int ii=0, jj=0, kk=0;
-		double R0 = (pps[labels[p]].proj_gridsize-1) * sites[s].rmax
-			/ pps[labels[s]].proj_gridsize;
-		for (int i = -grid1 + center1; i <= grid1 + center1; i++) {
-			for (int j = -grid2 + center2; j <= grid2 + center2; j++) {
-				for (int k = -grid3 + center3; k <= grid3 + center3; k++) {
-					testcoord[0] = (double) i / fftg[0] - coords[3*p+0];
-					testcoord[1] = (double) j / fftg[1] - coords[3*p+1];
-					testcoord[2] = (double) k / fftg[2] - coords[3*p+2];
-					frac_to_cartesian(testcoord, lattice);
-					if (mag(testcoord) < R0) {
-						ii = (i%fftg[0] + fftg[0]) % fftg[0];
-						jj = (j%fftg[1] + fftg[1]) % fftg[1];
-						kk = (k%fftg[2] + fftg[2]) % fftg[2];
-						frac[0] = (double) ii / fftg[0];
-						frac[1] = (double) jj / fftg[1];
-						frac[2] = (double) kk / fftg[2];
-						sites[s].indices[sites[s].num_indices] = ii*fftg[1]*fftg[2] + jj*fftg[2] + kk;
-						sites[s].paths[3*sites[s].num_indices+0] = testcoord[0];
-						sites[s].paths[3*sites[s].num_indices+1] = testcoord[1];
-						sites[s].paths[3*sites[s].num_indices+2] = testcoord[2];
-						for (int n = 0; n < sites[s].total_projs; n++) {
-							if (pr0_pw1)
-								sites[s].projs[n].values[sites[s].num_indices] = smooth_wave_value(
-									pps[labels[p]].funcs[sites[s].projs[n].func_num],
-									pps[labels[p]].smooth_grid, sites[s].projs[n].m, sites[s].rmax,
-									pps[labels[p]].proj_gridsize, coords+3*p, frac, lattice);
-							else
-								sites[s].projs[n].values[sites[s].num_indices] = proj_value(
-									pps[labels[p]].funcs[sites[s].projs[n].func_num],
-									pps[labels[p]].proj_grid, sites[s].projs[n].m, sites[s].rmax,
-									pps[labels[p]].proj_gridsize, coords+3*p, frac, lattice);
-						}
-						sites[s].num_indices++;
-						//if (sites[s].num_indices >= pps[labels[p]].num_cart_gridpts)
-						//	printf("SETUP_SITE ERROR %d %d %d\n", sites[s].num_indices, p, pr0_pw1);
-					}
-				}
+		funcset_t* funcs = pps[labels[p]].funcs;
+		double offset[3] = {0,0,0};
+		for (int d = 0; d < 3; d++) {
+			centers[3*s+d] = (int) round(coords[3*p+d] * fftg[d]);
+			offset[d] = coords[3*p+d] - (double) centers[3*s+d] / fftg[d];
+		}
+		site_template_t* tmp = site_templates;
+		while (tmp != NULL && !site_template_matches(tmp, funcs, pr0_pw1, offset, lattice, fftg)) {
+			tmp = tmp->next;
+		}
+		for (int t = 0; tmp == NULL && t < num_new; t++) {
+			if (site_template_matches(new_tmps[t], funcs, pr0_pw1, offset, lattice, fftg))
+				tmp = new_tmps[t];
+		}
+		if (tmp == NULL) {
+			tmp = (site_template_t*) malloc(sizeof(site_template_t));
+			CHECK_ALLOCATION(tmp);
+			tmp->funcs = funcs;
+			tmp->pr0_pw1 = pr0_pw1;
+			for (int d = 0; d < 3; d++) {
+				tmp->offset[d] = offset[d];
+				tmp->fftg[d] = fftg[d];
 			}
+			for (int d = 0; d < 9; d++) {
+				tmp->lattice[d] = lattice[d];
+			}
+			tmp->next = NULL;
+			new_tmps[num_new] = tmp;
+			new_labels[num_new] = labels[p];
+			num_new++;
+		}
+		site_tmps[s] = tmp;
+	}
+
+	#pragma omp parallel for schedule(dynamic)
+	for (int t = 0; t < num_new; t++) {
+		make_site_template(new_tmps[t], pps + new_labels[t],
+			pps[new_labels[t]].num_cart_gridpts, vol);
+	}
+
+	#pragma omp parallel for
+	for (int s = 0; s < num_sites; s++) {
+		site_template_t* tmp = site_tmps[s];
+		int* center = centers + 3*s;
+		int ii=0, jj=0, kk=0;
+		sites[s].indices = (int*) malloc(max(tmp->num_indices, 1) * sizeof(int));
+		sites[s].paths = (double*) malloc(3 * max(tmp->num_indices, 1) * sizeof(double));
+		CHECK_ALLOCATION(sites[s].indices);
+		CHECK_ALLOCATION(sites[s].paths);
+		for (int ind = 0; ind < tmp->num_indices; ind++) {
+			ii = ((center[0] + tmp->deltas[3*ind+0]) % fftg[0] + fftg[0]) % fftg[0];
+			jj = ((center[1] + tmp->deltas[3*ind+1]) % fftg[1] + fftg[1]) % fftg[1];
+			kk = ((center[2] + tmp->deltas[3*ind+2]) % fftg[2] + fftg[2]) % fftg[2];
+			sites[s].indices[ind] = ii*fftg[1]*fftg[2] + jj*fftg[2] + kk;
 		}
+		memcpy(sites[s].paths, tmp->paths, 3 * tmp->num_indices * sizeof(double));
+		// the values of all the projectors at the site are stored in one
+		// [total_projs][num_indices] block, so they can be used as a matrix
+		double complex* values = (double complex*) malloc(
+			max(sites[s].total_projs * tmp->num_indices, 1) * sizeof(double complex));
+		CHECK_ALLOCATION(values);
+		memcpy(values, tmp->values,
+			sites[s].total_projs * tmp->num_indices * sizeof(double complex));
+		for (int n = 0; n < sites[s].total_projs; n++) {
+			sites[s].projs[n].values = values + n * tmp->num_indices;
+		}
+		sites[s].num_indices = tmp->num_indices;
+	}
+
+	// add the new templates to the end of the cache, then remove
+	// the oldest templates if the cache is too large
+	site_template_t** tail = &site_templates;
+	while (*tail != NULL) {
+		tail = &((*tail)->next);
+	}
+	for (int t = 0; t < num_new; t++) {
+		*tail = new_tmps[t];
+		tail = &(new_tmps[t]->next);
+		site_templates_size += new_tmps[t]->size;
+	}
+	while (site_templates != NULL && site_templates_size > MAX_SITE_TEMPLATE_BYTES) {
+		site_template_t* tmp = site_templates;
+		site_templates = tmp->next;
+		site_templates_size -= tmp->size;
+		free_site_template(tmp);
 	}
+
+	free(site_tmps);
+	free(new_tmps);
+	free(new_labels);
+	free(centers);
 }
 
 //adapted from VASP source code
@@ -804,6 +1133,7 @@ pswf_t* expand_symm_wf(pswf_t* rwf, int num_kpts, int* maps,
 	wf->kpts = (kpoint_t**) malloc(num_kpts * rwf->nspin * sizeof(kpoint_t*));
 	wf->nspin = rwf->nspin;
 	wf->nband = rwf->nband;
+	wf->band_start = rwf->band_start;
 	wf->nwk = num_kpts;
 	wf->lattice = (double*) malloc(9*sizeof(double));
 	wf->reclattice = (double*) malloc(9*sizeof(double));
@@ -814,11 +1144,22 @@ pswf_t* expand_symm_wf(pswf_t* rwf, int num_kpts, int* maps,
 	wf->fftg = NULL;
 
 	wf->is_ncl = rwf->is_ncl;
+	wf->wc_map = NULL;
+	wf->wc_map_size = 0;
 
-	wf->num_aug_overlap_sites = 0;
-	wf->dcoords = NULL;
-	wf->overlaps = NULL;
 	wf->num_projs = NULL;
+	wf->proj_block = NULL;
+	wf->overlap_block = NULL;
+	wf->nlm_block = NULL;
+	wf->proj_done = NULL;
+	wf->proj_method = 0;
+	wf->proj_labels = NULL;
+	wf->proj_coords = NULL;
+	wf->proj_sites = NULL;
+	wf->wp_cache = NULL;
+	wf->aug_cache = NULL;
+	wf->wp_clock = 0;
+	wf->wp_hits = 0;
 	wf->wp_num = 0;
 
 	//#pragma omp parallel for
@@ -857,65 +1198,22 @@ pswf_t* expand_symm_wf(pswf_t* rwf, int num_kpts, int* maps,
 		//kpt->Gs = (int*) malloc(3 * kpt->num_waves * sizeof(int));
 
 		kpt->weight = kws[knum%num_kpts];
-		kpt->num_bands = rkpt->num_bands;
-		kpt->bands = (band_t**) malloc(kpt->num_bands * sizeof(band_t*));
+		alloc_kpoint_bands(kpt, rkpt->num_bands, 1);
 		kpt->expansion = NULL;
 
-		int* igall = malloc(3*kpt->num_waves*sizeof(int));
-		if (igall == NULL) {
-		    	ALLOCATION_FAILED();
+		int ncnt = 0;
+		int gbounds[6];
+		int* igall = get_gsphere(reclattice, rwf->encut, kpt->k, 1, &ncnt, gbounds);
+		for (int i = 0; i < 6; i += 2) {
+			wf->G_bounds[i] = min(wf->G_bounds[i], gbounds[i]);
+			wf->G_bounds[i+1] = max(wf->G_bounds[i+1], gbounds[i+1]);
 		}
-		int nb1max = rwf->G_bounds[1] - rwf->G_bounds[0] + 2;
-		int nb2max = rwf->G_bounds[3] - rwf->G_bounds[2] + 2;
-		int nb3max = rwf->G_bounds[5] - rwf->G_bounds[4] + 2;
-		double encut = rwf->encut;
-		double* b1 = reclattice;
-		double* b2 = reclattice+3;
-		double* b3 = reclattice+6;
-		int ncnt = -1;
-		for (int ig3 = 0; ig3 <= 2 * nb3max; ig3++) {
-			int ig3p = ig3;
-			if (ig3 > nb3max) ig3p = ig3 - 2 * nb3max - 1;
-			for (int ig2 = 0; ig2 <= 2 * nb2max; ig2++) {
-				int ig2p = ig2;
-				if (ig2 > nb2max) ig2p = ig2 - 2 * nb2max - 1;
-				for (int ig1 = 0; ig1 <= 2 * nb1max; ig1++) {
-					int ig1p = ig1;
-					if (ig1 > nb1max) ig1p = ig1 - 2 * nb1max - 1;
-					double sumkg[3];
-					for (int j = 0; j < 3; j++) {
-						sumkg[j] = (kpt->k[0]+ig1p) * b1[j]
-									+ (kpt->k[1]+ig2p) * b2[j]
-									+ (kpt->k[2]+ig3p) * b3[j];
-					}
-					double gtot = mag(sumkg);
-					double etot = pow(gtot,2.0) / CCONST;
-					//printf("%lf %lf\n", etot, gtot);
-					if (etot <= encut) {
-						ncnt++;
-						igall[ncnt*3+0] = ig1p;
-						igall[ncnt*3+1] = ig2p;
-						igall[ncnt*3+2] = ig3p;
-						if (ig1p < wf->G_bounds[0]) wf->G_bounds[0] = ig1p;
-						else if (ig1p > wf->G_bounds[1]) wf->G_bounds[1] = ig1p;
-						if (ig2p < wf->G_bounds[2]) wf->G_bounds[2] = ig2p;
-						else if (ig2p > wf->G_bounds[3]) wf->G_bounds[3] = ig2p;
-						if (ig3p < wf->G_bounds[4]) wf->G_bounds[4] = ig3p;
-						else if (ig3p > wf->G_bounds[5]) wf->G_bounds[5] = ig3p;
-					}
-				}
-			}
-		}
-		ncnt++;
 
 		if (ncnt * 2 == rkpt->num_waves) {
 			printf("This is an NCL wavefunction!\n");
 			wf->is_ncl = 1;
-			for (int iplane = 0; iplane < rkpt->num_waves/2; iplane++) {
-				igall[3*(rkpt->num_waves/2+iplane)+0] = igall[3*iplane+0];
-				igall[3*(rkpt->num_waves/2+iplane)+1] = igall[3*iplane+1];
-				igall[3*(rkpt->num_waves/2+iplane)+2] = igall[3*iplane+2];
-			}
+			release_gsphere(igall);
+			igall = get_gsphere(reclattice, rwf->encut, kpt->k, 2, &ncnt, gbounds);
 		} else if (ncnt != rkpt->num_waves) {
 			printf("ERROR %d %d %lf %lf %lf %lf\n", ncnt, kpt->num_waves,
 				kpt->k[0], kpt->k[1], kpt->k[2], CCONST);
@@ -992,19 +1290,9 @@ pswf_t* expand_symm_wf(pswf_t* rwf, int num_kpts, int* maps,
 		}
 
 		for (int b = 0; b < kpt->num_bands; b++) {
-			kpt->bands[b] = (band_t*) malloc(sizeof(band_t));
 			kpt->bands[b]->n = rkpt->bands[b]->n;
-			kpt->bands[b]->num_waves = rkpt->bands[b]->num_waves;
 			kpt->bands[b]->occ = rkpt->bands[b]->occ;
 			kpt->bands[b]->energy = rkpt->bands[b]->energy;
-			kpt->bands[b]->Cs = (float complex*) malloc(
-				kpt->num_waves * sizeof(float complex));
-			kpt->bands[b]->CRs = NULL;
-			kpt->bands[b]->CAs = NULL;
-			kpt->bands[b]->projections = NULL;
-			kpt->bands[b]->up_projections = NULL;
-			kpt->bands[b]->down_projections = NULL;
-			kpt->bands[b]->wave_projections = NULL;
 			//double total = 0;
 			for (int w = 0; w < kpt->num_waves; w++) {
 				if (gmaps[w] < 0) {
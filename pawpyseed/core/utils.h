@@ -43,6 +43,8 @@ typedef struct funcset {
 	double** smooth_diffwave_spline; ///< spline coefficients for smooth_diffwave
 	double* dense_kwave; ///< unused
 	double** dense_kwave_spline; ///< unused
+	double* kproj; ///< Spherical Bessel transform of proj on kproj_grid
+	double** kproj_spline; ///< spline coefficients for kproj
 } funcset_t;
 
 typedef struct ppot {
@@ -63,6 +65,10 @@ typedef struct ppot {
 	double* proj_grid; ///< real radial grid for projector functions
 	double* smooth_grid; ///< Grid for Fourier-filtered partial wave differences
 	double* dense_kgrid; ///< unused
+	int kproj_gridsize; ///< number of points on kproj_grid
+	double kproj_max; ///< maximum reciprocal space radius of kproj_grid
+	double* kproj_grid; ///< linear reciprocal radial grid for projector functions
+	int shared_data; ///< 1 if the arrays above belong to another ppot_t (see share_projector_list)
 } ppot_t;
 
 typedef struct projection {
@@ -107,32 +113,11 @@ typedef struct kpoint {
 	double weight; ///< k-point weight
 	int num_bands; ///< number of bands
 	band_t** bands; ///< bands with this k-point
+	band_t* band_block; ///< contiguous storage for the bands, NULL if each band is allocated separately
+	float complex* coeffs; ///< contiguous [num_bands][num_waves] block that the Cs of each band point into, or NULL
 	rayleigh_set_t** expansion;
 } kpoint_t;
 
-typedef struct pswf {
-	double encut;
-	int num_elems; ///< number of elements in the structure
-	int* num_projs; ///< number of projectors for each element
-	int num_sites; ///< number of sites in the structure
-	ppot_t* pps; ///< list of ppot_t objects, one for each element
-	int* G_bounds; ///< highest-frequency plane-waves in basis set (xmin, xmax, ymin, ymax, zmin, zmax)
-	kpoint_t** kpts; ///< list of kpoint_t objects for the structure
-	int nspin; ///< 1 for non-spin-polarized/noncollinear, 2 for spin-polarized
-	int nband; ///< number of bands
-	int nwk; ///< number of kpoints
-	double* lattice; ///< lattice (length 9, each row is a lattice, vector, row major)
-	double* reclattice; ///< reciprocal lattice (with 2pi factor!), formatted like lattice
-	int* fftg; ///< FFT grid dimensions
-
-	int is_ncl; ///< 1 if noncollinear, 0 otherwise
-
-	int wp_num; ///< length==size of wave_projections in each band
-	int num_aug_overlap_sites; ///< used for Projector operations
-	double* dcoords; ///< used for Projector operations
-	double complex** overlaps; ///< used for Projector operations
-} pswf_t;
-
 typedef struct projgrid {
 	double complex* values;
 } projgrid_t;
@@ -158,6 +143,80 @@ typedef struct real_proj_site {
 	real_proj_t* projs;
 } real_proj_site_t;
 
+/**
+Projections of the bands of a wavefunction onto the smooth partial
+waves of one site (see smooth_pw_values), cached on the wavefunction
+so that the overlap setups for many structures can share them
+(see overlap_setup_real)
+*/
+typedef struct wave_proj_cache {
+	int elem; ///< element of the site in the pps of the wavefunction, -1 if the entry cannot be reused
+	double coord[3]; ///< fractional coordinates of the site
+	int fftg[3]; ///< FFT grid the partial waves were evaluated on
+	int total_projs; ///< number of partial waves at the site
+	int refs; ///< number of overlap contexts using the entry
+	int cached; ///< 1 while the entry is in wp_cache, 0 once the wavefunction has been freed
+	long last_use; ///< value of wp_clock when the entry was last used
+	double complex* overlaps; ///< [kpt][band][total_projs] overlaps of the bands with the partial waves
+	struct wave_proj_cache* next; ///< next entry in the cache
+} wave_proj_cache_t;
+
+/**
+Reciprocal space smooth partial waves of a list of sites, weighted by
+the projections of each band of a wavefunction onto the sites (see
+get_aug_freqs_block), cached on the wavefunction so that the overlap
+setups for many structures can share them (see overlap_setup_recip)
+*/
+typedef struct aug_freqs_cache {
+	int num_sites; ///< number of sites
+	int* sites; ///< indices of the sites in the structure
+	int refs; ///< number of overlap contexts using the entry
+	int cached; ///< 1 while the entry is in aug_cache, 0 once the wavefunction has been freed
+	long last_use; ///< value of wp_clock when the entry was last used
+	int num_states; ///< number of k-points times number of bands
+	long size; ///< total number of coefficients in CAs
+	float complex** CAs; ///< [kpt][band] plane wave coefficients, like the Cs of each band
+	struct aug_freqs_cache* next; ///< next entry in the cache
+} aug_freqs_cache_t;
+
+typedef struct pswf {
+	double encut;
+	int num_elems; ///< number of elements in the structure
+	int* num_projs; ///< number of projectors for each element
+	int num_sites; ///< number of sites in the structure
+	ppot_t* pps; ///< list of ppot_t objects, one for each element
+	int* G_bounds; ///< highest-frequency plane-waves in basis set (xmin, xmax, ymin, ymax, zmin, zmax)
+	kpoint_t** kpts; ///< list of kpoint_t objects for the structure
+	int nspin; ///< 1 for non-spin-polarized/noncollinear, 2 for spin-polarized
+	int nband; ///< number of bands
+	int band_start; ///< WAVECAR index of band 0 (nonzero if only a band range was read)
+	int nwk; ///< number of kpoints
+	double* lattice; ///< lattice (length 9, each row is a lattice, vector, row major)
+	double* reclattice; ///< reciprocal lattice (with 2pi factor!), formatted like lattice
+	int* fftg; ///< FFT grid dimensions
+
+	int is_ncl; ///< 1 if noncollinear, 0 otherwise
+
+	char* wc_map; ///< memory map of the WAVECAR file if read lazily, NULL otherwise
+	long wc_map_size; ///< length of wc_map in bytes
+
+	projection_t* proj_block; ///< [kpt][band][site] block that the projections of each band point into, or NULL
+	double complex* overlap_block; ///< [kpt][band][site projector] block of the overlaps in proj_block
+	int* nlm_block; ///< ns, ls and ms of the projectors at each site, shared by all projections in proj_block
+	char* proj_done; ///< [kpt][band], 1 if the projections of the band in proj_block have been evaluated
+	int proj_method; ///< 0 if projections are evaluated in real space, 1 if in reciprocal space
+	int* proj_labels; ///< element of each site, used to evaluate projections
+	double* proj_coords; ///< fractional coordinates of each site, used to evaluate projections
+	real_proj_site_t* proj_sites; ///< real space projector values at each site, or NULL if not set up
+
+	int wp_num; ///< length==size of wave_projections in each band
+	wave_proj_cache_t* wp_cache; ///< cached projections onto the smooth partial waves of sites
+	aug_freqs_cache_t* aug_cache; ///< cached reciprocal space smooth partial waves of lists of sites
+	long wp_clock; ///< number of overlap setups, used to evict old entries of wp_cache and aug_cache
+	long wp_hits; ///< number of times overlap setups reused an entry of wp_cache or aug_cache
+} pswf_t;
+
+
 void affine_transform(double* out, double* op, double* inv);
 
 void rotation_transform(double* out, double* op, double* inv);
@@ -220,8 +279,41 @@ void free_projection_list(projection_t* projlist, int num);
 
 void clean_wave_projections(pswf_t* wf);
 
+/**
+Frees an entry of aug_cache (see aug_freqs_cache)
+*/
+void free_aug_freqs_entry(aug_freqs_cache_t* entry);
+
+/**
+Frees the entries of wp_cache and aug_cache of wf. Entries still used by
+an overlap context are only removed from the cache, and are freed when
+the context releases them (see free_overlap_context).
+*/
+void free_overlap_caches(pswf_t* wf);
+
 void free_kpoint(kpoint_t* kpt, int num_elems, int num_sites, int wp_num, int* num_projs);
 
+/**
+Allocates num_bands bands for kpt in one block. If alloc_coeffs is nonzero,
+the coefficients of all the bands are allocated as one [num_bands][num_waves]
+block (kpt->coeffs), so kpt->num_waves must be set first; otherwise the Cs of
+each band are left NULL. All other pointers in the bands are set to NULL.
+*/
+void alloc_kpoint_bands(kpoint_t* kpt, int num_bands, int alloc_coeffs);
+
+/**
+Allocates the projections of every band of wf (and the spin up and down
+projections if wf is noncollinear) in contiguous blocks, so that
+band->projections[s].overlaps for band b at k-point k starts at
+overlap_block + (k * nband + b) * (total number of projectors) + (offset of site s).
+For noncollinear wavefunctions the up and down projections follow in
+the same layout. num_projs and total_projs have length wf->num_sites, and
+ns, ls and ms list the projectors of each site in order of the sites.
+The overlaps are set to zero. Does nothing if the blocks are already allocated.
+*/
+void alloc_projection_block(pswf_t* wf, int* num_projs, int* total_projs,
+	int* ns, int* ls, int* ms);
+
 void free_ppot(ppot_t* pp);
 
 void free_real_proj(real_proj_t* proj);
@@ -234,6 +326,10 @@ void free_ptr(void* ptr);
 
 void free_real_proj_site_list(real_proj_site_t* sites, int length);
 
+/**
+Frees the list pps of length ppot_t objects, including their radial
+data unless it is shared (see share_projector_list).
+*/
 void free_ppot_list(ppot_t* pps, int length);
 
 /**
@@ -248,6 +344,12 @@ double* get_occs(pswf_t* wf);
 /** Return the number of bands in the wavefunction. */
 int get_nband(pswf_t* wf);
 
+/**
+Return the index in the WAVECAR of the first band in the wavefunction,
+i.e. band b of wf is band b + get_band_start(wf) of the WAVECAR.
+*/
+int get_band_start(pswf_t* wf);
+
 /** Return the number of kpoins in the wavefunction. */
 int get_nwk(pswf_t* wf);
 
@@ -338,11 +440,21 @@ double complex wave_value2(double* x, double* wave, double** spline, int size,
 	int l, int m, double* pos);
 
 /**
-Convenience function for setting up real_proj_site_t* lists
+Convenience function for setting up real_proj_site_t* lists.
+The grid points and values of each site are copied from a
+site_template_t, which is computed (in parallel) only for sites
+without a matching template in the cache.
 */
 void setup_site(real_proj_site_t* sites, ppot_t* pps, int num_sites, int* site_nums,
     int* labels, double* coords, double* lattice, int* fftg, int pr0_pw1);
 
+/**
+Frees the cached site templates (see setup_site) for the element with
+radial data funcs, or every cached template if funcs is NULL.
+Called by free_ppot.
+*/
+void free_site_templates(funcset_t* funcs);
+
 /**
 Set up spline coefficients for spline interpolation.
 Essentially a translation into C of the VASP SPLCOF function.
@@ -361,6 +473,12 @@ double spline_integral(double* x, double* a, double** s, int size);
 
 void frac_from_index(int index, double* coord, int* fftg);
 
+/**
+Stores the polar and azimuthal angles of the nonzero cartesian
+vector cart (length 3) in dir[0] and dir[1].
+*/
+void direction(double* cart, double* dir);
+
 double sph_bessel(double k, double r, int l);
 
 /**
@@ -0,0 +1,217 @@
+# coding: utf-8
+
+## @package pawpyseed.core.vasprun
+# Lightweight reader for the parts of vasprun.xml used by
+# pawpyseed (FFT grid, symmetry precision, k-points,
+# eigenvalues and total DOS). Parsing a full pymatgen Vasprun
+# is slow for large runs, especially with projected DOS or
+# projected eigenvalues, so the file is parsed incrementally
+# and everything else is skipped. Results are cached by path.
+
+import xml.etree.ElementTree as ET
+from collections import OrderedDict
+from monty.io import zopen
+from pymatgen.electronic_structure.core import Spin
+from pymatgen.electronic_structure.dos import Dos
+import numpy as np
+import os
+
+_VASPRUN_CACHE = OrderedDict()
+MAX_CACHED_VASPRUNS = 128
+
+class VasprunData:
+	"""
+	Subset of pymatgen.io.vasp.outputs.Vasprun read from vasprun.xml.
+	The attributes below have the same names and formats as in Vasprun,
+	so a VasprunData object can be used in place of a Vasprun
+	object anywhere in pawpyseed.
+
+	Attributes:
+		filename (str): path to the vasprun.xml file
+		parameters (dict): run parameters (the <parameters> section)
+		actual_kpoints (list): fractional k-points used in the run
+		actual_kpoints_weights (list): weight of each k-point
+		eigenvalues (dict): final eigenvalues, with Spin keys and
+			values of shape (number of k-points, number of bands, 2),
+			where the last axis is (energy, occupation)
+		efermi (float): Fermi level from the final DOS
+		tdos (pymatgen.electronic_structure.dos.Dos): final total DOS
+		occu_tol (float): occupation above which a state is considered
+			occupied by eigenvalue_band_properties
+	"""
+
+	def __init__(self, filename, occu_tol = 1e-8):
+		"""
+		Arguments:
+			filename (str): vasprun.xml file path (may be compressed)
+			occu_tol (float, 1e-8): Same as for pymatgen Vasprun
+		"""
+		self.filename = filename
+		self.occu_tol = occu_tol
+		self.parameters = {}
+		self.actual_kpoints = []
+		self.actual_kpoints_weights = []
+		self.eigenvalues = {}
+		self.efermi = None
+		self.tdos = None
+		with zopen(filename, 'rt') as f:
+			self._parse(f)
+
+	@staticmethod
+	def _keep(path):
+		"""
+		Whether the element at path (list of tags from the root)
+		is part of a section that is read, so it must not be cleared
+		before the end of the section is reached.
+		"""
+		if 'parameters' in path:
+			return True
+		if path[1:2] == ['kpoints']:
+			return True
+		if 'calculation' in path:
+			sub = path[path.index('calculation')+1:]
+			if sub[:1] == ['eigenvalues'] or sub == ['dos']:
+				return True
+			if sub[:2] == ['dos', 'total'] or sub == ['dos', 'i']:
+				return True
+		return False
+
+	def _parse(self, f):
+		path = []
+		for event, elem in ET.iterparse(f, events=('start', 'end')):
+			if event == 'start':
+				path.append(elem.tag)
+				continue
+			tag = elem.tag
+			if tag == 'parameters':
+				self.parameters = self._parse_parameters(elem)
+			elif tag == 'kpoints' and len(path) == 2:
+				self._parse_kpoints(elem)
+			elif tag == 'eigenvalues' and path[-2] == 'calculation':
+				self.eigenvalues = self._parse_eigen(elem)
+			elif tag == 'dos' and path[-2] == 'calculation':
+				self._parse_dos(elem)
+			if tag in ('parameters', 'kpoints', 'eigenvalues', 'dos')\
+					or not self._keep(path):
+				elem.clear()
+			path.pop()
+
+	@staticmethod
+	def _parse_value(text, vtype):
+		text = text.strip()
+		try:
+			if vtype == 'int':
+				return int(text)
+			elif vtype == 'logical':
+				return 'T' in text
+			elif vtype == 'string':
+				return text
+			return float(text)
+		except ValueError:
+			return text
+
+	def _parse_parameters(self, elem):
+		parameters = {}
+		for item in elem.iter():
+			name = item.attrib.get('name')
+			if name is None or item.text is None:
+				continue
+			vtype = item.attrib.get('type')
+			if item.tag == 'i':
+				parameters[name] = self._parse_value(item.text, vtype)
+			elif item.tag == 'v':
+				parameters[name] = [self._parse_value(v, vtype)\
+									for v in item.text.split()]
+		return parameters
+
+	@staticmethod
+	def _parse_varray(elem):
+		return [[float(x) for x in v.text.split()] for v in elem.findall('v')]
+
+	@staticmethod
+	def _parse_array(elem):
+		return [[float(x) for x in r.text.split()] for r in elem.findall('r')]
+
+	def _parse_kpoints(self, elem):
+		for va in elem.findall('varray'):
+			if va.attrib.get('name') == 'kpointlist':
+				self.actual_kpoints = self._parse_varray(va)
+			elif va.attrib.get('name') == 'weights':
+				self.actual_kpoints_weights = [w[0] for w in self._parse_varray(va)]
+
+	def _parse_eigen(self, elem):
+		eigenvalues = {}
+		for s in elem.find('array').find('set').findall('set'):
+			spin = Spin.up if s.attrib['comment'] == 'spin 1' else Spin.down
+			eigenvalues[spin] = np.array([self._parse_array(ss)\
+											for ss in s.findall('set')])
+		return eigenvalues
+
+	def _parse_dos(self, elem):
+		self.efermi = float(elem.find('i').text)
+		energies = None
+		densities = {}
+		for s in elem.find('total').find('array').find('set').findall('set'):
+			data = np.array(self._parse_array(s))
+			energies = data[:,0]
+			spin = Spin.up if s.attrib['comment'] == 'spin 1' else Spin.down
+			densities[spin] = data[:,1]
+		self.tdos = Dos(self.efermi, energies, densities)
+
+	@property
+	def is_spin(self):
+		"""
+		True if the run is spin-polarized.
+		"""
+		return self.parameters.get('ISPIN', 1) == 2
+
+	@property
+	def eigenvalue_band_properties(self):
+		"""
+		(band gap, cbm, vbm, is_band_gap_direct), evaluated
+		in the same way as in pymatgen Vasprun.
+		"""
+		vbm = -float('inf')
+		vbm_kpoint = None
+		cbm = float('inf')
+		cbm_kpoint = None
+		for d in self.eigenvalues.values():
+			for k, val in enumerate(d):
+				for eigenval, occu in val:
+					if occu > self.occu_tol and eigenval > vbm:
+						vbm = eigenval
+						vbm_kpoint = k
+					elif occu <= self.occu_tol and eigenval < cbm:
+						cbm = eigenval
+						cbm_kpoint = k
+		return max(cbm - vbm, 0), cbm, vbm, vbm_kpoint == cbm_kpoint
+
+
+def read_vasprun(path):
+	"""
+	Returns a VasprunData object for the vasprun.xml file path,
+	or for the vasprun.xml file in path if path is a directory.
+	Results are cached, so reading the same unmodified file again
+	(e.g. once for each Wavefunction and analysis object set up
+	from the same directory) does not parse it again.
+	"""
+	path = str(path)
+	if os.path.isdir(path):
+		path = os.path.join(path, 'vasprun.xml')
+	path = os.path.abspath(path)
+	stat = os.stat(path)
+	key = (path, stat.st_mtime_ns, stat.st_size)
+	if key in _VASPRUN_CACHE:
+		_VASPRUN_CACHE.move_to_end(key)
+		return _VASPRUN_CACHE[key]
+	vr = VasprunData(path)
+	_VASPRUN_CACHE[key] = vr
+	while len(_VASPRUN_CACHE) > MAX_CACHED_VASPRUNS:
+		_VASPRUN_CACHE.popitem(last=False)
+	return vr
+
+def clear_vasprun_cache():
+	"""
+	Empties the cache used by read_vasprun.
+	"""
+	_VASPRUN_CACHE.clear()
@@ -10,9 +10,11 @@ from pymatgen.core.structure import Structure
 import numpy as np
 from pawpyseed.core.utils import *
 import pawpyseed.core.symmetry as pawpy_symm
+from pawpyseed.core.vasprun import read_vasprun
 import os, time
 import numpy as np
 import json
+import hashlib
 
 import sys
 
@@ -141,6 +143,101 @@ class Pseudopotential:
 	def make_nums(self, numstring):
 		return np.fromstring(numstring, dtype = np.float64, sep = ' ')
 
+	def to_arrays(self):
+		"""
+		Returns a dict of the parsed arrays of the Pseudopotential,
+		which can be saved with np.savez and passed to from_arrays.
+		"""
+		arrays = {}
+		for name in PSEUDOPOTENTIAL_ARRAYS:
+			arrays[name] = np.asarray(getattr(self, name))
+		for name in PSEUDOPOTENTIAL_LISTS:
+			lst = getattr(self, name)
+			arrays[name + '_count'] = np.array(len(lst))
+			for i, arr in enumerate(lst):
+				arrays['%s_%d' % (name, i)] = arr
+		return arrays
+
+	@staticmethod
+	def from_arrays(arrays):
+		"""
+		Returns a Pseudopotential from the output of to_arrays
+		(or an npz file containing it), without parsing any text.
+		"""
+		pp = Pseudopotential.__new__(Pseudopotential)
+		for name in PSEUDOPOTENTIAL_ARRAYS:
+			pp.__dict__[name] = np.array(arrays[name])
+		for name in PSEUDOPOTENTIAL_LISTS:
+			count = int(arrays[name + '_count'])
+			pp.__dict__[name] = [np.array(arrays['%s_%d' % (name, i)])\
+									for i in range(count)]
+		pp.ls = [float(l) for l in pp.ls]
+		pp.rmax = float(pp.rmax)
+		pp.T = float(pp.T)
+		pp.ndata = int(pp.ndata)
+		pp.step = (pp.projgrid[0], pp.projgrid[1])
+		return pp
+
+PSEUDOPOTENTIAL_ARRAYS = ['grid', 'augs', 'rmax', 'T', 'ndata', 'projgrid']
+PSEUDOPOTENTIAL_LISTS = ['pswaves', 'aewaves', 'recipprojs', 'realprojs',
+	'nonlocalprojs', 'ls']
+
+_PSEUDOPOTENTIAL_CACHE = {}
+_PSEUDOPOTENTIAL_CACHE_DIR = os.environ.get('PAWPYSEED_CACHE_DIR')
+
+def set_pseudopotential_cache_dir(path):
+	"""
+	Sets the directory in which load_pseudopotential stores parsed
+	pseudopotentials, so that they are not parsed again by later
+	processes. If path is None, only the in-memory cache is used.
+	Defaults to the PAWPYSEED_CACHE_DIR environment variable, if set.
+	"""
+	global _PSEUDOPOTENTIAL_CACHE_DIR
+	_PSEUDOPOTENTIAL_CACHE_DIR = path
+
+def clear_pseudopotential_cache():
+	"""
+	Empties the in-memory cache used by load_pseudopotential.
+	Files in the cache directory are not removed.
+	"""
+	_PSEUDOPOTENTIAL_CACHE.clear()
+
+def load_pseudopotential(data):
+	"""
+	Returns a Pseudopotential for the single-element POTCAR string data.
+	Results are cached by the SHA-256 hash of data, in memory and
+	(see set_pseudopotential_cache_dir) on disk, so the POTCAR text is
+	only parsed the first time it is seen. Pseudopotentials returned
+	by this function are shared and should not be modified.
+	The hash is stored in the hash attribute of the Pseudopotential.
+	"""
+	key = hashlib.sha256(data.encode('utf-8')).hexdigest()
+	if key in _PSEUDOPOTENTIAL_CACHE:
+		return _PSEUDOPOTENTIAL_CACHE[key]
+	pp = None
+	path = None
+	if _PSEUDOPOTENTIAL_CACHE_DIR is not None:
+		path = os.path.join(_PSEUDOPOTENTIAL_CACHE_DIR, key + '.pp1.npz')
+		if os.path.isfile(path):
+			try:
+				with np.load(path) as arrays:
+					pp = Pseudopotential.from_arrays(arrays)
+			except Exception:
+				# unreadable cache file, parse the POTCAR again
+				pp = None
+	if pp is None:
+		pp = Pseudopotential(data)
+		if path is not None:
+			os.makedirs(_PSEUDOPOTENTIAL_CACHE_DIR, exist_ok=True)
+			# write to a temporary file first so that other processes
+			# never read a partially written file
+			tmppath = '%s.%d.tmp.npz' % (path[:-4], os.getpid())
+			np.savez(tmppath, **pp.to_arrays())
+			os.replace(tmppath, path)
+	pp.hash = key
+	_PSEUDOPOTENTIAL_CACHE[key] = pp
+	return pp
+
 
 class CoreRegion:
 	"""
@@ -149,6 +246,8 @@ class CoreRegion:
 	Attributes:
 		pps (dict of Pseudopotential): keys are element symbols,
 			values are Pseudopotential objects
+		data (dict of str): keys are element symbols, values are
+			the POTCAR data used to construct each Pseudopotential
 	"""
 
 	def __init__(self, potcar):
@@ -164,9 +263,113 @@ class CoreRegion:
 			CoreRegion object based on potcar
 		"""
 		self.pps = {}
+		self.data = {}
 		for potsingle in potcar:
-			self.pps[potsingle.element] = Pseudopotential(potsingle.data[:-15])
+			self.data[potsingle.element] = potsingle.data[:-15]
+			self.pps[potsingle.element] = load_pseudopotential(potsingle.data[:-15])
+
+	@staticmethod
+	def from_data(data):
+		"""
+		Returns a new CoreRegion object from the data attribute
+		of another CoreRegion, e.g. one stored by Wavefunction.save.
+
+		Arguments:
+			data (dict of str): keys are element symbols, values
+				are the POTCAR data for each element
+
+		Returns:
+			CoreRegion object
+		"""
+		cr = CoreRegion.__new__(CoreRegion)
+		cr.pps = {}
+		cr.data = {}
+		for element in data:
+			cr.data[element] = data[element]
+			cr.pps[element] = load_pseudopotential(data[element])
+		return cr
+
+
+class WavecarHeader:
+	"""
+	Metadata of a WAVECAR, read from its header records only. No
+	plane-wave coefficients are read, so this is much faster than
+	constructing a Wavefunction and can be used to inspect many
+	calculations before choosing which bands to load.
+
+	Attributes:
+		nspin (int): number of spins
+		nwk (int): number of k-points
+		nband (int): number of bands
+		encut (float): plane-wave cutoff (eV)
+		lattice (np.ndarray, 3x3): lattice vectors (Angstroms), one per row
+		kpts (np.ndarray, nwk x 3): fractional k-points
+		num_waves (np.ndarray, nwk): number of plane-wave coefficients
+			stored for each k-point
+		energies (np.ndarray, nspin x nwk x nband): band energies (eV)
+		occupations (np.ndarray, nspin x nwk x nband): band occupations
+	"""
+
+	def __init__(self, filename="WAVECAR"):
+		"""
+		Arguments:
+			filename (str, "WAVECAR"): WAVECAR file path; may be
+				gzip or bzip2 compressed
+		"""
+		if not os.path.isfile(filename):
+			raise FileNotFoundError("File {} does not exist.".format(filename))
+		header = pawpyc.read_wavecar_header(filename)
+		self.nspin = header['nspin']
+		self.nwk = header['nwk']
+		self.nband = header['nband']
+		self.encut = header['encut']
+		self.lattice = header['lattice']
+		self.kpts = header['kpts']
+		self.num_waves = header['num_waves']
+		self.energies = header['energies']
+		self.occupations = header['occupations']
+
+	def band_edges(self, occ_tol=0.5):
+		"""
+		Returns the valence band maximum and conduction band minimum
+		(eV), where states with occupations above occ_tol are
+		considered occupied.
+		"""
+		occupied = self.occupations > occ_tol
+		vbm = np.max(self.energies[occupied]) if np.any(occupied) else None
+		cbm = np.min(self.energies[~occupied]) if not np.all(occupied) else None
+		return vbm, cbm
+
+	def vbm_band(self, occ_tol=0.5):
+		"""
+		Returns the index of the highest band that is occupied at
+		the first k-point and spin, the same choice of VBM band as
+		Projector.defect_band_analysis.
+		"""
+		occupied = np.where(self.occupations[0,0] > occ_tol)[0]
+		return int(occupied[-1]) if occupied.shape[0] > 0 else 0
+
+	def bands_in_window(self, emin, emax):
+		"""
+		Returns the first and last index of the smallest range of bands
+		containing every band with an energy between emin and emax at any
+		k-point and spin, i.e. the bands that Wavefunction.from_files
+		reads for energy_window=(emin, emax). Returns None if
+		no band is in the window.
+		"""
+		inwindow = np.logical_and(self.energies >= emin, self.energies <= emax)
+		bands = np.where(np.any(inwindow, axis=(0,1)))[0]
+		if bands.shape[0] == 0:
+			return None
+		return int(bands[0]), int(bands[-1])
+
 
+WAVEFUNCTION_FILE_MAGIC = b'PAWPYWF1'
+
+def _snapshot_offset(pos):
+	# the C snapshot in a saved Wavefunction file starts at
+	# the first multiple of 64 bytes after the metadata
+	return (pos + 63) // 64 * 64
 
 class Wavefunction(pawpyc.CWavefunction):
 	"""
@@ -183,8 +386,12 @@ class Wavefunction(pawpyc.CWavefunction):
 		band_props (np.ndarray): 4-item array of containing the information
 			(band gap, cbm, vbm, is_band_gap_direct). This object contains the same
 			information as pymatgen.io.vasp.outputs.Vasprun.eigenvalue_band_properties
+		projector_method (str): 'real' or 'recip', how the projections onto
+			the PAW projectors are evaluated (see set_projector_method)
 	"""
 
+	projector_method = 'real'
+
 	def __init__(self, struct, pwf, cr, dim, symprec = 1e-4, setup_projectors=False):
 		"""
 		Arguments:
@@ -234,6 +441,28 @@ class Wavefunction(pawpyc.CWavefunction):
 		self.check_kpoint_index(k)
 		self.check_spin_index(s)
 
+	def set_projector_method(self, method):
+		"""
+		Sets how the projections <p_i|psit_nk> are evaluated when the
+		projectors are set up. With 'real' (the default), each band is
+		transformed to real space and integrated with the projector
+		functions on the FFT grid. With 'recip', the projector functions
+		are transformed to reciprocal space once for each k-point, and the
+		projections of all bands are evaluated as one matrix product with
+		the plane-wave coefficients, like VASP with LREAL=.FALSE.
+		This avoids the FFTs and real space grids entirely, and is
+		usually faster for large numbers of bands.
+		Must be called before the projectors are set up.
+
+		Arguments:
+			method (str): 'real' or 'recip'
+		"""
+		if method not in ('real', 'recip'):
+			raise ValueError("Invalid projector method %s, should be 'real' or 'recip'" % method)
+		if self.projector_owner:
+			raise PAWpyError("Projectors have already been set up")
+		self.projector_method = method
+
 	def update_dim(self, dim):
 		self.dim = np.array(dim, dtype=np.int32)
 		self.update_dimv(dim)
@@ -261,11 +490,13 @@ class Wavefunction(pawpyc.CWavefunction):
 		pwf = self._desymmetrized_pwf(self.structure, self.band_props, allkpts, weights,
 										symprec, time_reversal_symmetry)
 		new_wf = Wavefunction(self.structure, pwf, self.cr, self.dim, symprec=symprec)
+		new_wf.projector_method = self.projector_method
 		return new_wf
 
 	@staticmethod
 	def from_files(struct="CONTCAR", wavecar="WAVECAR", cr="POTCAR",
-		vr="vasprun.xml", setup_projectors=False):
+		vr="vasprun.xml", setup_projectors=False, lazy=False,
+		bands=None, energy_window=None):
 		"""
 		Construct a Wavefunction object from file paths.
 
@@ -279,6 +510,20 @@ class Wavefunction(pawpyc.CWavefunction):
 				components of the wavefunctions. Pawpyseed will set up the projectors
 				automatically when they are first needed, so this generally
 				can be left as False.
+			lazy (bool, False): Whether to memory map the WAVECAR and only
+				read the plane-wave coefficients of a band from disk when
+				they are first used. Useful for very large WAVECARs.
+				Ignored for compressed WAVECARs.
+			bands (int or (int, int), None): If not None, only read this
+				band, or the bands from bands[0] to bands[1] (inclusive,
+				0-indexed), from the WAVECAR. The band indices of the
+				resulting object then start at 0 at bands[0]; the WAVECAR
+				index of band 0 is stored in the band_start attribute.
+			energy_window ((float, float), None): If not None, only read the
+				bands with energies (in eV, same reference as the
+				eigenvalues in vasprun.xml) between energy_window[0] and
+				energy_window[1] at any k-point, along with any bands
+				in between them. Can be combined with bands.
 
 		Returns:
 			Wavefunction object
@@ -286,16 +531,17 @@ class Wavefunction(pawpyc.CWavefunction):
 		for fname in [struct, wavecar, cr, vr]:
 			if not os.path.isfile(fname):
 				raise FileNotFoundError("File {} does not exist.".format(fname))
-		vr = Vasprun(vr)
+		vr = read_vasprun(vr)
 		dim = np.array([vr.parameters["NGX"], vr.parameters["NGY"], vr.parameters["NGZ"]])
 		symprec = vr.parameters["SYMPREC"]
-		pwf = pawpyc.PWFPointer(wavecar, vr)
+		pwf = pawpyc.PWFPointer(wavecar, vr, lazy, bands, energy_window)
 		return Wavefunction(Poscar.from_file(struct).structure,
 			pwf, CoreRegion(Potcar.from_file(cr)),
 			dim, symprec, setup_projectors)
 
 	@staticmethod
-	def from_directory(path, setup_projectors = False):
+	def from_directory(path, setup_projectors = False, lazy = False,
+		bands = None, energy_window = None):
 		"""
 		Assumes VASP output has the default filenames and is located
 		in the directory specificed by path.
@@ -306,6 +552,12 @@ class Wavefunction(pawpyc.CWavefunction):
 				components of the wavefunctions. Pawpyseed will set up the projectors
 				automatically when they are first needed, so this generally
 				can be left as False.
+			lazy (bool, False): Whether to memory map the WAVECAR,
+				see from_files
+			bands (int or (int, int), None): Range of bands to read,
+				see from_files
+			energy_window ((float, float), None): Energy window of bands
+				to read, see from_files
 
 		Returns:
 			Wavefunction object
@@ -314,10 +566,12 @@ class Wavefunction(pawpyc.CWavefunction):
 		for d in ["CONTCAR", "WAVECAR", "POTCAR", "vasprun.xml"]:
 			filepaths.append(str(os.path.join(path, d)))
 		args = filepaths + [setup_projectors]
-		return Wavefunction.from_files(*args)
+		return Wavefunction.from_files(*args, lazy=lazy,
+			bands=bands, energy_window=energy_window)
 
 	@staticmethod
-	def from_atomate_directory(path, setup_projectors = False):
+	def from_atomate_directory(path, setup_projectors = False, lazy = False,
+		bands = None, energy_window = None):
 		"""
 		Assumes VASP output has the default filenames and is located
 		in the directory specificed by path. Checks for
@@ -329,6 +583,12 @@ class Wavefunction(pawpyc.CWavefunction):
 				components of the wavefunctions. Pawpyseed will set up the projectors
 				automatically when they are first needed, so this generally
 				can be left as False.
+			lazy (bool, False): Whether to memory map the WAVECAR,
+				see from_files
+			bands (int or (int, int), None): Range of bands to read,
+				see from_files
+			energy_window ((float, float), None): Energy window of bands
+				to read, see from_files
 
 		Returns:
 			Wavefunction object
@@ -352,17 +612,21 @@ class Wavefunction(pawpyc.CWavefunction):
 		    paths.append(filepat)
 
 		args = paths + [setup_projectors]
-		wf = Wavefunction.from_files(*args)
+		wf = Wavefunction.from_files(*args, lazy=lazy,
+			bands=bands, energy_window=energy_window)
 
 		return wf
 
-	def _make_c_projectors(self):
+	def _make_c_projectors(self, compute_projections=True):
 		"""
 		Uses the CoreRegion objects in self
 		to construct C representations of the projectors and partial waves
 		for a structure. Also assigns numerical labels for each element and
 		setups up a list of indices and positions which can be easily converted
-		to C lists for projection routines.
+		to C lists for projection routines. If compute_projections is False,
+		the projections onto the projectors are only evaluated when they
+		are needed, and projections that are loaded already (see load)
+		are not recomputed.
 		"""
 
 		pps = {}
@@ -384,18 +648,148 @@ class Wavefunction(pawpyc.CWavefunction):
 		grid_encut = (np.pi * self.dim / self.structure.lattice.abc)**2 / 0.262
 
 		self._c_projector_setup(self.num_elems, self.num_sites, max(grid_encut),
-								nums, coords, self.dim, pps)
+								nums, coords, self.dim, pps, compute_projections,
+								self.projector_method == 'recip')
+
+	def projections(self, k, s=0):
+		"""
+		Returns the projections <p_i|psit_nk> of every band onto every
+		PAW projector in the structure, at k-point k and spin s, as a
+		read-only complex128 array of shape (nband, number of projectors).
+		The array is a view of the projections stored by the wavefunction,
+		not a copy. The projectors are set up first if needed.
+		Use projection_indices to find the site, n, l and m of each column.
+
+		Arguments:
+			k (int): k-point index
+			s (int, 0): spin index
+		"""
+		if not self.projector_owner:
+			self._make_c_projectors(compute_projections=False)
+		self._evaluate_projections(k, s)
+		return self._get_projections(k, s)
+
+	def projection_indices(self):
+		"""
+		Returns an integer array of shape (number of projectors, 4),
+		where each row is the site index, projector function index
+		(in the POTCAR), l and m of the corresponding column
+		of the arrays returned by projections.
+		"""
+		if not self.projector_owner:
+			self._make_c_projectors(compute_projections=False)
+		return self._get_projection_indices()
+
+	def save(self, filename):
+		"""
+		Saves the wavefunction to a binary file, which can be read
+		with Wavefunction.load much faster than the VASP output files.
+		The file contains the structure, pseudopotentials, plane-wave
+		coefficients, k-points, band energies and occupations, and the
+		projections onto the PAW projectors if the projectors have been
+		set up (call check_c_projectors first to store them), so they do not
+		need to be recomputed after loading. Projections of bands that
+		have not been evaluated yet are evaluated first.
+
+		Arguments:
+			filename (str): path of the file to write
+		"""
+		if self.projector_owner:
+			self.check_c_projectors()
+		metadata = {
+			'structure' : self.structure.as_dict(),
+			'core_region' : self.cr.data,
+			'dim' : [int(d) for d in self.dim],
+			'symprec' : self.symprec,
+			'band_props' : np.array(self.band_props, dtype=np.float64).tolist(),
+			'kpts' : np.array(self.kpts).tolist(),
+			'weights' : np.array(self.kws).tolist(),
+			'ncl' : bool(self.ncl),
+			'projections' : bool(self.projector_owner),
+			'projector_method' : self.projector_method,
+		}
+		header = json.dumps(metadata).encode('utf-8')
+		# write to a temporary file first, because the coefficients of a
+		# loaded wavefunction are memory mapped from the file it was loaded
+		# from, which may be filename; the old mapping keeps the replaced
+		# file alive
+		tmpname = '%s.%d.tmp' % (filename, os.getpid())
+		try:
+			with open(tmpname, 'wb') as f:
+				f.write(WAVEFUNCTION_FILE_MAGIC)
+				f.write(np.array([len(header)], dtype='<i8').tobytes())
+				f.write(header)
+				offset = _snapshot_offset(f.tell())
+				f.write(b'\0' * (offset - f.tell()))
+			self._write_snapshot(tmpname, offset)
+			os.replace(tmpname, filename)
+		except BaseException:
+			if os.path.exists(tmpname):
+				os.remove(tmpname)
+			raise
+
+	@staticmethod
+	def load(filename):
+		"""
+		Loads a wavefunction written by Wavefunction.save. The plane-wave
+		coefficients are memory mapped, so they are only read from disk
+		when they are used. If projections were saved, the projectors
+		are set up without recomputing them.
+
+		Arguments:
+			filename (str): path of the file written by save
+
+		Returns:
+			Wavefunction object, or NCLWavefunction object if the saved
+			wavefunction was noncollinear
+		"""
+		if not os.path.isfile(filename):
+			raise FileNotFoundError("File {} does not exist.".format(filename))
+		with open(filename, 'rb') as f:
+			if f.read(len(WAVEFUNCTION_FILE_MAGIC)) != WAVEFUNCTION_FILE_MAGIC:
+				raise PAWpyError("{} is not a saved Wavefunction".format(filename))
+			size = int(np.frombuffer(f.read(8), dtype='<i8')[0])
+			metadata = json.loads(f.read(size).decode('utf-8'))
+			offset = _snapshot_offset(f.tell())
+		pwf = pawpyc.PWFPointer.from_snapshot(filename, offset,
+			metadata['kpts'], metadata['weights'], metadata['band_props'])
+		structure = Structure.from_dict(metadata['structure'])
+		cr = CoreRegion.from_data(metadata['core_region'])
+		if metadata['ncl']:
+			from pawpyseed.core.noncollinear import NCLWavefunction
+			wf = NCLWavefunction(structure, pwf, cr, metadata['dim'],
+				metadata['symprec'])
+		else:
+			wf = Wavefunction(structure, pwf, cr, metadata['dim'],
+				metadata['symprec'])
+		wf.set_projector_method(metadata.get('projector_method', 'real'))
+		if metadata['projections']:
+			wf._make_c_projectors(compute_projections=False)
+		return wf
 
 	def check_c_projectors(self):
 		"""
-		Check to see if the projector functions have been read in and set up.
-		If not, do so.
+		Check to see if the projector functions have been read in and set up,
+		and the projections of every band evaluated. If not, do so.
 		"""
 		if not self.projector_owner:
 			start = time.monotonic()
 			self._make_c_projectors()
 			end = time.monotonic()
 			print('--------------\nran setup_projections in %f seconds\n---------------' % (end-start))
+		else:
+			self._evaluate_projections()
+
+	def check_band_projectors(self, b, k, s):
+		"""
+		Same as check_c_projectors, but only evaluates the projections
+		of band b at k-point k and spin s, so that quantities for
+		a single state are cheap to evaluate even if there are many bands.
+		The projections of the other bands are evaluated when they are needed.
+		"""
+		if not self.projector_owner:
+			self._make_c_projectors(compute_projections=False)
+		self._evaluate_projections(k, s, b)
 
 	def get_state_realspace(self, b, k, s, dim=None, remove_phase = False):
 		"""
@@ -410,7 +804,7 @@ class Wavefunction(pawpyc.CWavefunction):
 				with complex double values for the realspace wavefunction
 		"""
 
-		self.check_c_projectors()
+		self.check_band_projectors(b, k, s)
 		if dim is not None:
 			self.update_dim(np.array(dim))
 		return self._get_realspace_state(b, k, s, remove_phase)
@@ -428,7 +822,7 @@ class Wavefunction(pawpyc.CWavefunction):
 				with complex double values for the realspace wavefunction
 		"""
 
-		self.check_c_projectors()
+		self.check_band_projectors(b, k, s)
 		if dim is not None:
 			self.update_dim(np.array(dim)//2)
 		return self._get_realspace_state_density(b, k, s)
@@ -503,7 +897,7 @@ class Wavefunction(pawpyc.CWavefunction):
 				with complex double values for the realspace wavefunction
 			The wavefunction is written in two files with z the slow index.
 		"""
-		self.check_c_projectors()
+		self.check_band_projectors(b, k, s)
 		if dim is not None:
 			self.update_dim(np.array(dim))
 		filename_base = "%sB%dK%dS%d" % (fileprefix, b, k, s)
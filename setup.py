@@ -19,8 +19,8 @@ DEBUG = True
 
 reqs = "numpy>=1.14,scipy>=1.0,pymatgen>=2018.2.13,sympy>=1.1.1,matplotlib>=0.2.5".split(',')
 
-srcfiles = ['density', 'gaunt', 'linalg', 'projector', 'pseudoprojector', 'quadrature',\
-			'radial', 'reader', 'sbt', 'utils', 'momentum']
+srcfiles = ['density', 'gaunt', 'gsphere', 'linalg', 'projector', 'pseudoprojector', 'quadrature',\
+			'radial', 'reader', 'sbt', 'utils', 'momentum', 'snapshot']
 
 # READ CONFIGURATION FILE
 config = configparser.ConfigParser()
@@ -75,6 +75,9 @@ else:
 	link_args = '%s %s -lmkl_core %s -lpthread -lm -ldl' % (interfacelib, threadlib, omplib)
 	link_args = platform_link_args + link_args.split()
 
+# zlib and bzip2 are used to read compressed WAVECARs
+link_args += ['-lz', '-lbz2']
+
 # set compiler openmp flag
 extra_args = '-std=c11 -fPIC -Wall'.split()
 if omp_loops: